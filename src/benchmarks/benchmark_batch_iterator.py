@@ -0,0 +1,45 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from utils.network_training_util import create_sampler, create_view_data_loader
+from utils.omics_view import OmicsView
+
+
+def epochs_per_second(train_loader, epochs):
+    start_time = time.perf_counter()
+    for _ in range(epochs):
+        for _ in train_loader:
+            pass
+    return epochs / (time.perf_counter() - start_time)
+
+
+def benchmark_batch_iterator(samples, features, batch_size, epochs):
+    rng = np.random.default_rng(42)
+    omics = tuple(
+        rng.standard_normal((samples, features), dtype=np.float32) for _ in range(3)
+    )
+    response = (rng.random(samples) < 0.3).astype(np.float32)
+    view = OmicsView(omics, response)
+    sampler = create_sampler(view.labels)
+
+    for name, in_process in (("DataLoader", False), ("OmicsBatchIterator", True)):
+        train_loader = create_view_data_loader(
+            view, batch_size, False, sampler, in_process=in_process
+        )
+        print(f"{name}: {epochs_per_second(train_loader, epochs):.2f} epochs/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", default=800, type=int)
+    parser.add_argument("--features", default=5000, type=int)
+    parser.add_argument("--mini_batch", default=32, type=int)
+    parser.add_argument("--epochs", default=10, type=int)
+    args = parser.parse_args()
+    benchmark_batch_iterator(args.samples, args.features, args.mini_batch, args.epochs)
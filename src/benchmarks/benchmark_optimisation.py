@@ -0,0 +1,228 @@
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+source_directory = Path(__file__).resolve().parent.parent
+sys.path.append(str(source_directory))
+for experiment_directory in sorted((source_directory / "experiments").iterdir()):
+    if experiment_directory.is_dir() and not experiment_directory.name.startswith("_"):
+        sys.path.append(str(experiment_directory))
+from utils import multi_omics_data
+from utils.choose_gpu import create_device
+from utils.experiment_utils import run_optimisation
+from utils.fold_pruning import FoldPruner
+from utils.omics_view import OmicsView
+from utils.phase_timer import phase_timer
+from utils.searchspaces import (
+    create_early_integration_search_space,
+    create_moli_search_space,
+    create_moma_search_space,
+    create_omi_embed_search_space,
+    create_pca_search_space,
+    create_stacking_search_space,
+)
+from utils.synthetic_data import generate_drug_data
+
+model_names = (
+    "moli",
+    "stacking",
+    "early_integration",
+    "moma",
+    "omiEmbed",
+    "pca",
+    "super.felt",
+)
+drug = "Synthetic"
+dataset = "SYNTHETIC"
+random_seed = 42
+
+
+def create_evaluation_function(model_name, data, device, pin_memory, pruner):
+    if model_name == "moli":
+        import train_moli
+
+        evaluation_function = partial(
+            train_moli.optimise_hyperparameter, pin_memory=pin_memory
+        )
+        search_space = create_moli_search_space(False)
+    elif model_name == "stacking":
+        import train_stacking
+
+        evaluation_function = partial(
+            train_stacking.optimise_hyperparameter,
+            pin_memory=pin_memory,
+            stacking_type="less_stacking",
+        )
+        search_space = create_stacking_search_space(False)
+    elif model_name == "early_integration":
+        import train_early_integration
+
+        data = OmicsView(
+            (np.concatenate([data.array(0), data.array(1), data.array(2)], axis=1),),
+            data.labels,
+        )
+        evaluation_function = partial(
+            train_early_integration.optimise_hyperparameter, pin_memory=pin_memory
+        )
+        search_space = create_early_integration_search_space(False)
+    elif model_name == "moma":
+        import train_moma
+
+        evaluation_function = partial(
+            train_moma.optimise_hyperparameter, pin_memory=pin_memory
+        )
+        search_space = create_moma_search_space(False)
+    elif model_name == "omiEmbed":
+        import train_omiEmbed
+
+        evaluation_function = partial(
+            train_omiEmbed.optimise_hyperparameter, pin_memory=pin_memory
+        )
+        search_space = create_omi_embed_search_space(False)
+    elif model_name == "pca":
+        import train_pca
+
+        evaluation_function = train_pca.optimise_hyperparameter
+        search_space = create_pca_search_space()
+    else:
+        raise ValueError(f"Unknown model {model_name}")
+    evaluation_function = partial(
+        evaluation_function, data=data, device=device, pruner=pruner
+    )
+    return evaluation_function, search_space
+
+
+def run_sweep(model_name, data, search_iterations, device, pin_memory):
+    if model_name == "super.felt":
+        import train_super_felt
+
+        train_super_felt.optimise_super_felt_parameter(
+            search_iterations, data, device, False, random_seed
+        )
+        return
+    pruner = FoldPruner()
+    evaluation_function, search_space = create_evaluation_function(
+        model_name, data, device, pin_memory, pruner
+    )
+    run_optimisation(
+        evaluation_function,
+        search_space,
+        f"Benchmark {model_name}",
+        search_iterations,
+        random_seed,
+        pruner=pruner,
+    )
+
+
+def benchmark_model(model_name, data_path, search_iterations, gpu_number):
+    """
+    Runs a reduced sweep of model_name on the synthetic data in a fresh
+    process and returns its throughput, peak memory and phase times.
+    """
+    device, pin_memory = create_device(gpu_number)
+    torch.manual_seed(random_seed)
+    np.random.seed(random_seed)
+    gdsc_e, gdsc_m, gdsc_c, gdsc_r, *_ = multi_omics_data.load_drug_data_with_elbow(
+        Path(data_path), drug, dataset
+    )
+    data = OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r)
+
+    start_time = time.perf_counter()
+    run_sweep(model_name, data, search_iterations, device, pin_memory)
+    seconds = time.perf_counter() - start_time
+    peak_gpu_memory = 0
+    if device.type == "cuda":
+        peak_gpu_memory = torch.cuda.max_memory_allocated(device) / 2**20
+    return {
+        "model": model_name,
+        "trials": search_iterations,
+        "seconds": seconds,
+        "trials_per_hour": search_iterations / seconds * 3600,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_gpu_mb": peak_gpu_memory,
+        "features": [gdsc_e.shape[1], gdsc_m.shape[1], gdsc_c.shape[1]],
+        "phase_times": phase_timer.phase_times(),
+    }
+
+
+def print_report(results):
+    print(
+        f"{'model':<20}{'trials/h':>10}{'seconds':>10}{'peak RSS MB':>13}"
+        f"{'peak GPU MB':>13}  top phases"
+    )
+    for result in results:
+        phase_times = sorted(result["phase_times"].items(), key=lambda item: -item[1])
+        top_phases = ", ".join(f"{name} {total:.1f}s" for name, total in phase_times[:3])
+        print(
+            f"{result['model']:<20}{result['trials_per_hour']:>10.1f}"
+            f"{result['seconds']:>10.1f}{result['peak_rss_mb']:>13.0f}"
+            f"{result['peak_gpu_mb']:>13.0f}  {top_phases}"
+        )
+
+
+def benchmark_optimisation(args):
+    data_path = Path(args.data_path or tempfile.mkdtemp(prefix="synthetic_data_"))
+    generate_drug_data(
+        data_path,
+        drug,
+        dataset,
+        args.train_samples,
+        args.extern_samples,
+        args.genes,
+        args.mutation_rate,
+        args.cna_rate,
+        args.response_rate,
+        random_seed=random_seed,
+        overwrite=args.force,
+    )
+    print(f"Synthetic data in {data_path}")
+    results = []
+    context = torch.multiprocessing.get_context("spawn")
+    for model_name in args.models:
+        # one process per model, so that peak RSS is not shared between models
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(
+                executor.submit(
+                    benchmark_model,
+                    model_name,
+                    data_path,
+                    args.search_iterations,
+                    args.gpu_number,
+                ).result()
+            )
+    print_report(results)
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", default=model_names, choices=model_names)
+    parser.add_argument("--search_iterations", default=3, type=int)
+    parser.add_argument("--data_path")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="overwrite existing files in --data_path",
+    )
+    parser.add_argument("--train_samples", default=600, type=int)
+    parser.add_argument("--extern_samples", default=80, type=int)
+    parser.add_argument("--genes", default=5000, type=int)
+    parser.add_argument("--mutation_rate", default=0.05, type=float)
+    parser.add_argument("--cna_rate", default=0.3, type=float)
+    parser.add_argument("--response_rate", default=0.3, type=float)
+    parser.add_argument("--gpu_number", type=int)
+    parser.add_argument("--output")
+    benchmark_optimisation(parser.parse_args())
@@ -0,0 +1,48 @@
+import argparse
+import sys
+from pathlib import Path
+
+import yaml
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from utils.synthetic_data import generate_drug_data
+
+file_directory = Path(__file__).parent
+
+with open((file_directory / "../config/hyperparameter.yaml"), "r") as stream:
+    parameter = yaml.safe_load(stream)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # never the data folder, which holds the downloaded data sets
+    parser.add_argument(
+        "--data_path", default=file_directory / ".." / ".." / "synthetic_data"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="overwrite existing files"
+    )
+    parser.add_argument("--drug", default="all", choices=["all", *parameter["drugs"]])
+    parser.add_argument("--train_samples", default=600, type=int)
+    parser.add_argument("--extern_samples", default=80, type=int)
+    parser.add_argument("--genes", default=5000, type=int)
+    parser.add_argument("--mutation_rate", default=0.05, type=float)
+    parser.add_argument("--cna_rate", default=0.3, type=float)
+    parser.add_argument("--response_rate", default=0.3, type=float)
+    args = parser.parse_args()
+    drugs = parameter["drugs"] if args.drug == "all" else [args.drug]
+    for drug in drugs:
+        generate_drug_data(
+            args.data_path,
+            drug,
+            parameter["drugs"][drug],
+            args.train_samples,
+            args.extern_samples,
+            args.genes,
+            args.mutation_rate,
+            args.cna_rate,
+            args.response_rate,
+            random_seed=parameter["random_seed"],
+            overwrite=args.force,
+        )
+        print(f"Wrote synthetic data for {drug} to {args.data_path}")
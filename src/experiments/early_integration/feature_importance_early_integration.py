@@ -4,19 +4,21 @@ import torch
 from pathlib import Path
 import numpy as np
 import sys
-from captum.attr import ShapleyValueSampling
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 from models.early_integration_model import EarlyIntegration
 from utils.network_training_util import create_sampler, get_loss_fn
 from utils.input_arguments import get_cmd_arguments
 from utils import multi_omics_data
+from utils.omics_view import OmicsBatchIterator
 from utils.interpretability import (
-    compute_importances_values_single_input,
+    compute_importances,
+    compute_omics_shapley_values,
     save_importance_results,
 )
 from train_early_integration import train_early_integration
-from utils.visualisation import visualize_importances
+from utils.feature_groups import create_feature_groups
+from utils.visualisation import save_omics_shapley_values, visualize_importances
 from utils.choose_gpu import create_device
 
 file_directory = Path(__file__).parent
@@ -106,6 +108,14 @@ def early_integration_feature_importance(
     extern_dataset_name,
     convert_ids,
     gpu_number,
+    rebuild_data_cache,
+    attribution_workers,
+    shard_size,
+    attribute_test,
+    group_by,
+    gene_set_file,
+    attribution_method,
+    compare_with_shapley,
 ):
     hyperparameter = best_hyperparameter[drug_name]
     mini_batch = hyperparameter["mini_batch"]
@@ -141,7 +151,14 @@ def early_integration_feature_importance(
         extern_c,
         _,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name, return_data_frames=True
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        return_data_frames=True,
+        rebuild_cache=rebuild_data_cache,
+    )
+    feature_groups = create_feature_groups(
+        group_by, gene_set_file, (gdsc_e.columns, gdsc_m.columns, gdsc_c.columns)
     )
     # get columns names
     expression_columns = gdsc_e.columns
@@ -178,15 +195,12 @@ def early_integration_feature_importance(
 
     # Initialisation
     sampler = create_sampler(gdsc_r)
-    dataset = torch.utils.data.TensorDataset(gdsc_concat_scaled, torch.Tensor(gdsc_r))
-    train_loader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=mini_batch,
-        shuffle=False,
-        num_workers=8,
-        pin_memory=pin_memory,
-        drop_last=True,
-        sampler=sampler,
+    train_loader = OmicsBatchIterator(
+        (gdsc_concat_scaled, torch.Tensor(gdsc_r)),
+        mini_batch,
+        sampler,
+        True,
+        pin_memory,
     )
     _, ie_dim = gdsc_concat_scaled.shape
 
@@ -214,26 +228,66 @@ def early_integration_feature_importance(
     early_integration_model.eval()
 
     gdsc_concat_scaled = gdsc_concat_scaled.to(device)
-    integradet_gradients = ShapleyValueSampling(early_integration_model)
-
-    """ all_attributions_test = compute_importances_values_single_input(
-        gdsc_concat_scaled,
-        integradet_gradients,
+    extern_concat_scaled = extern_concat_scaled.to(device)
+    omics_sizes = (
+        number_of_expression_features,
+        number_of_mutation_features,
+        gdsc_c.shape[1],
+    )
+    omics_shapley_values_test = None
+    if attribute_test:
+        omics_shapley_values_test = compute_omics_shapley_values(
+            gdsc_concat_scaled, early_integration_model, omics_sizes
+        )
+    omics_shapley_values_extern = compute_omics_shapley_values(
+        extern_concat_scaled, early_integration_model, omics_sizes
     )
+    if attribution_method == "omics_shapley":
+        if attribute_test:
+            save_omics_shapley_values(
+                omics_shapley_values_test, result_path, "all_attributions_test"
+            )
+        save_omics_shapley_values(
+            omics_shapley_values_extern, result_path, "all_attributions_extern"
+        )
+        return
 
-    visualize_importances(
-        all_columns,
-        all_attributions_test,
-        path=result_path,
-        file_name="all_attributions_test",
-        convert_ids=convert_ids,
-        number_of_expression_features=number_of_expression_features,
-        number_of_mutation_features=number_of_mutation_features,
-    ) """
+    shard_path = result_path / "shards"
+    if attribute_test:
+        all_attributions_test = compute_importances(
+            gdsc_concat_scaled,
+            early_integration_model,
+            attribution_method,
+            shard_path / "test",
+            attribution_workers,
+            shard_size,
+            feature_groups=feature_groups,
+            report_file=result_path / "attribution_report_test.json",
+            compare_with_shapley=compare_with_shapley,
+        )
 
-    extern_concat_scaled = extern_concat_scaled.to(device)
-    all_attributions_extern = compute_importances_values_single_input(
-        extern_concat_scaled, integradet_gradients
+        visualize_importances(
+            all_columns,
+            all_attributions_test,
+            path=result_path,
+            file_name="all_attributions_test",
+            convert_ids=convert_ids,
+            number_of_expression_features=number_of_expression_features,
+            number_of_mutation_features=number_of_mutation_features,
+            feature_groups=feature_groups,
+            omics_shapley_values=omics_shapley_values_test,
+        )
+
+    all_attributions_extern = compute_importances(
+        extern_concat_scaled,
+        early_integration_model,
+        attribution_method,
+        shard_path / "extern",
+        attribution_workers,
+        shard_size,
+        feature_groups=feature_groups,
+        report_file=result_path / "attribution_report_extern.json",
+        compare_with_shapley=compare_with_shapley,
     )
 
     visualize_importances(
@@ -244,10 +298,25 @@ def early_integration_feature_importance(
         convert_ids=convert_ids,
         number_of_expression_features=number_of_expression_features,
         number_of_mutation_features=number_of_mutation_features,
+        feature_groups=feature_groups,
+        omics_shapley_values=omics_shapley_values_extern,
     )
 
-    # save_importance_results(all_attributions_test, all_columns, result_path, "extern")
-    save_importance_results(all_attributions_extern, all_columns, result_path, "test")
+    if attribute_test:
+        save_importance_results(
+            all_attributions_test,
+            all_columns,
+            result_path,
+            "gdsc_test",
+            feature_groups=feature_groups,
+        )
+    save_importance_results(
+        all_attributions_extern,
+        all_columns,
+        result_path,
+        "test",
+        feature_groups=feature_groups,
+    )
 
 
 if __name__ == "__main__":
@@ -261,6 +330,14 @@ if __name__ == "__main__":
                 extern_dataset,
                 args.convert_ids,
                 args.gpu_number,
+                args.rebuild_data_cache,
+                args.attribution_workers,
+                args.shard_size,
+                args.attribute_test,
+                args.feature_groups,
+                args.gene_set_file,
+                args.attribution_method,
+                args.compare_with_shapley,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -270,4 +347,12 @@ if __name__ == "__main__":
             extern_dataset,
             args.convert_ids,
             args.gpu_number,
+            args.rebuild_data_cache,
+            args.attribution_workers,
+            args.shard_size,
+            args.attribute_test,
+            args.feature_groups,
+            args.gene_set_file,
+            args.attribution_method,
+            args.compare_with_shapley,
         )
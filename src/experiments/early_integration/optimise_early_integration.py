@@ -1,28 +1,37 @@
 import sys
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 import torch
-import pickle
 import time
 import numpy as np
 import yaml
 from tqdm import tqdm
-from ax import optimize
 from ax.storage.json_store.save import save_experiment
 from sklearn.model_selection import StratifiedKFold
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
-from utils.experiment_utils import create_generation_strategy
+from utils.experiment_utils import (
+    ax_checkpoint_file,
+    full_budget_objectives,
+    load_outer_fold_result,
+    run_optimisation,
+    save_outer_fold_result,
+)
+from utils.results_store import ResultsStore
+from utils.fold_pruning import FoldPruner
 from utils.input_arguments import get_cmd_arguments
 from utils.searchspaces import create_early_integration_search_space
 from utils.choose_gpu import create_device
 from train_early_integration import (
     train_final,
     optimise_hyperparameter,
-    reset_best_auroc,
+    optimise_hyperparameter_group,
+    architecture_parameters,
     test_early_integration,
 )
 from utils import multi_omics_data
+from utils.omics_view import OmicsView
 from utils.visualisation import save_auroc_plots, save_auroc_with_variance_plots
 from utils.network_training_util import calculate_mean_and_std_auc
 
@@ -40,6 +49,12 @@ def early_integration(
     extern_dataset_name,
     gpu_number,
     deactivate_triplet_loss,
+    rebuild_data_cache,
+    parallel_trials,
+    scheduler,
+    batched_folds,
+    trial_batch_size,
+    resume,
 ):
     device, pin_memory = create_device(gpu_number)
     result_path = Path(
@@ -55,6 +70,7 @@ def early_integration(
     result_path.mkdir(parents=True, exist_ok=True)
 
     result_file = open(result_path / "results.txt", "w")
+    results_store = ResultsStore(result_path, "early_integration", drug_name, experiment_name)
     log_file = open(result_path / "logs.txt", "w")
     checkpoint_path = result_path / "checkpoint.json"
     log_file.write(f"Start for {drug_name}\n")
@@ -71,11 +87,15 @@ def early_integration(
         extern_c,
         extern_r,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        rebuild_cache=rebuild_data_cache,
     )
 
     gdsc_concat = np.concatenate([gdsc_e, gdsc_m, gdsc_c], axis=1)
     extern_concat = np.concatenate([extern_e, extern_m, extern_c], axis=1)
+    gdsc_data = OmicsView((gdsc_concat,), gdsc_r)
 
     early_integration_search_space = create_early_integration_search_space(
         deactivate_triplet_loss
@@ -104,61 +124,103 @@ def early_integration(
         skf.split(gdsc_e, gdsc_r), total=skf.get_n_splits(), desc="Outer k-fold"
     ):
         result_file.write(f"\t{iteration = }. \n")
-        x_train_validate_concat = gdsc_concat[train_index]
-        y_train_validate = gdsc_r[train_index]
-        x_test_concat = gdsc_concat[test_index]
-        y_test = gdsc_r[test_index]
-
-        reset_best_auroc()
-        evaluation_function = lambda parameterization: optimise_hyperparameter(
-            parameterization,
-            x_train_validate_concat,
-            y_train_validate,
-            device,
-            pin_memory,
-        )
-        generation_strategy = create_generation_strategy()
-
-        best_parameters, _, experiment, _ = optimize(
-            total_trials=search_iterations,
-            experiment_name="Early-Integration",
-            objective_name="auroc",
-            parameters=early_integration_search_space,
-            evaluation_function=evaluation_function,
-            minimize=False,
-            generation_strategy=generation_strategy,
-        )
+        train_validate_data = gdsc_data.subset(train_index)
+        test_data = gdsc_data.subset(test_index)
 
-        # save results
-        max_objective = max(
-            np.array([trial.objective_mean for trial in experiment.trials.values()])
-        )
-        objectives = np.array(
-            [trial.objective_mean for trial in experiment.trials.values()]
-        )
-        save_experiment(experiment, str(checkpoint_path))
-        pickle.dump(objectives, open(result_path / "objectives", "wb"))
-        pickle.dump(best_parameters, open(result_path / "best_parameters", "wb"))
-        save_auroc_plots(objectives, result_path, iteration, search_iterations)
+        outer_fold_result = None
+        if resume:
+            outer_fold_result = load_outer_fold_result(
+                result_path, iteration, search_iterations
+            )
+        if outer_fold_result is None:
+            pruner = FoldPruner()
+            evaluation_function = partial(
+                optimise_hyperparameter,
+                data=train_validate_data,
+                device=device,
+                pin_memory=pin_memory,
+                pruner=pruner,
+                batched_folds=batched_folds,
+            )
+            group_evaluation_function = partial(
+                optimise_hyperparameter_group,
+                data=train_validate_data,
+                device=device,
+                pin_memory=pin_memory,
+                pruner=pruner,
+                batched_folds=max(1, batched_folds),
+            )
 
-        iteration += 1
+            best_parameters, experiment = run_optimisation(
+                evaluation_function,
+                early_integration_search_space,
+                "Early-Integration",
+                search_iterations,
+                parameter["random_seed"],
+                parallel_trials,
+                pruner,
+                scheduler,
+                trial_batch_size,
+                group_evaluation_function,
+                architecture_parameters,
+                checkpoint_file=ax_checkpoint_file(result_path, iteration),
+                resume=resume,
+            )
+            results_store.add_study(experiment, iteration)
 
-        result_file.write(f"\t\t{str(best_parameters) = }\n")
+            # save results
+            max_objective = max(full_budget_objectives(experiment))
+            objectives = full_budget_objectives(experiment)
+            save_experiment(experiment, str(checkpoint_path))
+            save_auroc_plots(objectives, result_path, iteration, search_iterations)
 
-        model_final, scaler_final = train_final(
+            model_final, scaler_final = train_final(
+                best_parameters,
+                train_validate_data,
+                device,
+                pin_memory,
+            )
+            auc_test, auprc_test = test_early_integration(
+                model_final, scaler_final, test_data.array(0), test_data.labels, device
+            )
+            auc_extern, auprc_extern = test_early_integration(
+                model_final, scaler_final, extern_concat, extern_r, device
+            )
+            outer_fold_result = (
+                best_parameters,
+                objectives,
+                max_objective,
+                auc_test,
+                auprc_test,
+                auc_extern,
+                auprc_extern,
+            )
+            save_outer_fold_result(
+                result_path, iteration, search_iterations, outer_fold_result
+            )
+            results_store.add_outer_fold(
+                iteration,
+                search_iterations,
+                best_parameters,
+                max_objective,
+                auc_test,
+                auprc_test,
+                auc_extern,
+                auprc_extern,
+            )
+            results_store.flush()
+        (
             best_parameters,
-            x_train_validate_concat,
-            y_train_validate,
-            device,
-            pin_memory,
-        )
-        auc_test, auprc_test = test_early_integration(
-            model_final, scaler_final, x_test_concat, y_test, device
-        )
-        auc_extern, auprc_extern = test_early_integration(
-            model_final, scaler_final, extern_concat, extern_r, device
-        )
+            objectives,
+            max_objective,
+            auc_test,
+            auprc_test,
+            auc_extern,
+            auprc_extern,
+        ) = outer_fold_result
+        iteration += 1
 
+        result_file.write(f"\t\t{str(best_parameters) = }\n")
         result_file.write(f"\t\tBest {drug_name} validation Auroc = {max_objective}\n")
         objectives_list.append(objectives)
         max_objective_list.append(max_objective)
@@ -207,7 +269,7 @@ def extract_best_parameter(experiment):
 
 
 if __name__ == "__main__":
-    args = get_cmd_arguments()
+    args = get_cmd_arguments(batched_training=True)
     if args.drug == "all":
         for drug, extern_dataset in parameter["drugs"].items():
             early_integration(
@@ -217,6 +279,12 @@ if __name__ == "__main__":
                 extern_dataset,
                 args.gpu_number,
                 args.deactivate_triplet_loss,
+                args.rebuild_data_cache,
+                args.parallel_trials,
+                args.scheduler,
+                args.batched_folds,
+                args.trial_batch_size,
+                args.resume,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -227,4 +295,10 @@ if __name__ == "__main__":
             extern_dataset,
             args.gpu_number,
             args.deactivate_triplet_loss,
+            args.rebuild_data_cache,
+            args.parallel_trials,
+            args.scheduler,
+            args.batched_folds,
+            args.trial_batch_size,
+            args.resume,
         )
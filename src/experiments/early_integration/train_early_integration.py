@@ -3,23 +3,23 @@ import torch
 from sklearn.metrics import roc_auc_score, average_precision_score
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from torch.utils.data.sampler import WeightedRandomSampler
 from tqdm import trange, tqdm
 from models.early_integration_model import EarlyIntegration
-from utils.network_training_util import get_loss_fn, create_sampler
+from utils.network_training_util import get_loss_fn, create_sampler, create_view_data_loader, mixed_class_batches
+from utils.fold_ensemble import MemberAdagrad, fold_ensemble_result, member_hyperparameter, \
+    train_validate_fold_ensemble
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler
 from scipy.stats import sem
 
-best_auroc = -1
 cv_splits_inner = 5
+# parameters that change layer shapes or the batch schedule of a trial
+architecture_parameters = ('mini_batch', 'epochs', 'h_dim')
 sigmoid = torch.nn.Sigmoid()
 
 
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
-
-
-def optimise_hyperparameter(parameterization, x, y, device, pin_memory):
+def optimise_hyperparameter(parameterization, data, device, pin_memory, pruner=None, batched_folds=0):
     mini_batch = parameterization['mini_batch']
     h_dim = parameterization['h_dim']
     lr = parameterization['lr']
@@ -29,28 +29,27 @@ def optimise_hyperparameter(parameterization, x, y, device, pin_memory):
     epochs = parameterization['epochs']
     margin = parameterization['margin']
 
+    if pruner is None:
+        pruner = FoldPruner()
+    if batched_folds > 0:
+        return optimise_hyperparameter_group([parameterization], data, device, pin_memory, pruner, batched_folds)[0]
+
     aucs_validate = []
-    iteration = 1
     skf = StratifiedKFold(n_splits=cv_splits_inner)
-    for train_index, validate_index in tqdm(skf.split(x, y), total=skf.get_n_splits(),
-                                            desc="k-fold"):
-        x_train_e = x[train_index]
-        y_train = y[train_index]
-
-        x_validate_e = x[validate_index]
-        y_validate = y[validate_index]
+    for train_index, validate_index in tqdm(skf.split(np.zeros(len(data)), data.labels),
+                                            total=skf.get_n_splits(), desc="k-fold"):
+        phase_timer.next_fold()
+        with phase('data slicing'):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
 
-        scaler_gdsc = StandardScaler()
-        x_train_e = scaler_gdsc.fit_transform(x_train_e)
+        scaler_gdsc = fit_scaler(train_data)
 
         # Initialisation
-        sampler = create_sampler(y_train)
-        dataset = torch.utils.data.TensorDataset(torch.FloatTensor(x_train_e), torch.FloatTensor(y_train))
-        train_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=mini_batch, shuffle=False,
-                                                   num_workers=8, pin_memory=pin_memory, drop_last=True,
-                                                   sampler=sampler)
+        sampler = create_sampler(train_data.labels)
+        train_loader = create_view_data_loader(train_data, mini_batch, pin_memory, sampler, scaler_gdsc)
 
-        _, ie_dim = x_train_e.shape
+        ie_dim, = data.dimensions
 
         loss_fn = get_loss_fn(margin, gamma)
 
@@ -62,37 +61,48 @@ def optimise_hyperparameter(parameterization, x, y, device, pin_memory):
             train_early_integration(train_loader, early_integration_model, moli_optimiser, loss_fn, device, gamma)
 
         # validate
-        auc_validate, _ = test_early_integration(early_integration_model, scaler_gdsc, x_validate_e, y_validate, device)
+        auc_validate, _ = test_early_integration(early_integration_model, scaler_gdsc, validate_data.array(0),
+                                                 validate_data.labels, device)
         aucs_validate.append(auc_validate)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(np.concatenate([aucs_validate, remaining_best_results]))
-            if check_best_auroc(best_possible_mean):
-                print('Skip remaining folds.')
-                break
-        iteration += 1
+        if pruner.should_stop(aucs_validate, cv_splits_inner):
+            print('Skip remaining folds.')
+            break
 
     mean = np.mean(aucs_validate)
-    set_best_auroc(mean)
+    pruner.report(aucs_validate, cv_splits_inner)
     standard_error_of_mean = sem(aucs_validate)
 
-    return {'auroc': (mean, standard_error_of_mean)}
+    return {'auroc': (mean, standard_error_of_mean), 'completed_folds': len(aucs_validate),
+            'pruned': len(aucs_validate) < cv_splits_inner}
 
 
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
+def optimise_hyperparameter_group(parameterizations, data, device, pin_memory, pruner=None, batched_folds=1):
+    """
+    Evaluates parameterizations that share the architecture_parameters in one
+    batched training run and returns one result per parameterization.
+    """
+    if pruner is None:
+        pruner = FoldPruner()
+    ie_dim, = data.dimensions
 
+    def create_model(parameterization):
+        return EarlyIntegration(ie_dim, parameterization['h_dim'], parameterization['dropout_rate'])
 
-def set_best_auroc(new_auroc):
-    global best_auroc
-    if new_auroc > best_auroc:
-        best_auroc = new_auroc
+    def create_optimiser(ensemble, member_parameterizations):
+        return MemberAdagrad(ensemble.parameters_of(), lr=member_hyperparameter(member_parameterizations, 'lr'),
+                             weight_decay=member_hyperparameter(member_parameterizations, 'weight_decay'))
 
+    def test_fn(model, scaler, validate_data):
+        auc_validate, _ = test_early_integration(model, scaler, validate_data.array(0), validate_data.labels, device)
+        return auc_validate
 
-def train_final(parameterization, x_train_e, y_train, device, pin_memory):
+    aucs_validate = train_validate_fold_ensemble(data, cv_splits_inner, batched_folds, parameterizations, create_model,
+                                                 create_optimiser, test_fn, device, pin_memory)
+    return [fold_ensemble_result(trial_aucs, cv_splits_inner, pruner) for trial_aucs in aucs_validate]
+
+
+def train_final(parameterization, train_data, device, pin_memory):
     mini_batch = parameterization['mini_batch']
     h_dim = parameterization['h_dim']
     lr = parameterization['lr']
@@ -103,10 +113,9 @@ def train_final(parameterization, x_train_e, y_train, device, pin_memory):
     margin = parameterization['margin']
 
     train_scaler_gdsc = StandardScaler()
-    train_scaler_gdsc.fit(x_train_e)
-    x_train_e = train_scaler_gdsc.transform(x_train_e)
+    train_scaler_gdsc.fit(train_data.array(0))
 
-    ie_dim = x_train_e.shape[-1]
+    ie_dim, = train_data.dimensions
 
     loss_fn = get_loss_fn(margin, gamma)
 
@@ -114,17 +123,8 @@ def train_final(parameterization, x_train_e, y_train, device, pin_memory):
 
     optimiser = torch.optim.Adagrad(early_integration_model.parameters(), lr=lr, weight_decay=weight_decay)
 
-    class_sample_count = np.array([len(np.where(y_train == t)[0]) for t in np.unique(y_train)])
-    weight = 1. / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-
-    samples_weight = torch.from_numpy(samples_weight)
-    sampler = WeightedRandomSampler(samples_weight.type('torch.DoubleTensor'), len(samples_weight),
-                                    replacement=True)
-    dataset = torch.utils.data.TensorDataset(torch.FloatTensor(x_train_e), torch.FloatTensor(y_train))
-    train_loader = torch.utils.data.DataLoader(dataset=dataset, batch_size=mini_batch, shuffle=False,
-                                               num_workers=8, pin_memory=pin_memory, drop_last=True,
-                                               sampler=sampler)
+    sampler = create_sampler(train_data.labels)
+    train_loader = create_view_data_loader(train_data, mini_batch, pin_memory, sampler, train_scaler_gdsc)
 
     for _ in range(epochs):
         train_early_integration(train_loader, early_integration_model, optimiser, loss_fn, device, gamma)
@@ -132,20 +132,19 @@ def train_final(parameterization, x_train_e, y_train, device, pin_memory):
 
 
 def train_early_integration(train_loader, model, optimiser, loss_fn, device, gamma):
-    y_true = []
     model.train()
-    for (data, target) in train_loader:
-        if torch.mean(target) != 0. and torch.mean(target) != 1.:
-            optimiser.zero_grad()
-            y_true.extend(target)
+    for (data, target) in mixed_class_batches(train_loader):
+        optimiser.zero_grad()
 
-            data = data.to(device)
-            target = target.to(device)
+        data = data.to(device)
+        target = target.to(device)
+        with phase('forward'):
             prediction = model.forward_with_features(data)
             if gamma > 0:
                 loss = loss_fn(prediction, target)
             else:
                 loss = loss_fn(prediction[0], target)
+        with phase('backward'):
             loss.backward()
             optimiser.step()
 
@@ -156,6 +155,7 @@ def test_early_integration(model, scaler, extern_concat, test_r, device):
     model.eval()
     predictions = model.forward_with_features(x_test_e)
     probabilities = sigmoid(predictions[0])
-    auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
-    auprc_validate = average_precision_score(test_y, probabilities.cpu().detach().numpy())
+    with phase('auroc'):
+        auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
+        auprc_validate = average_precision_score(test_y, probabilities.cpu().detach().numpy())
     return auc_validate, auprc_validate
@@ -1,17 +1,30 @@
 import sys
+from functools import partial
 from pathlib import Path
 import torch
 import numpy as np
 import yaml
-from ax import optimize
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
-from utils.experiment_utils import create_generation_strategy
+from utils.experiment_utils import (
+    ax_checkpoint_file,
+    full_budget_objectives,
+    run_optimisation,
+)
+from utils.results_store import ResultsStore
+from utils.fold_pruning import FoldPruner
 from utils.input_arguments import get_cmd_arguments
 from utils.searchspaces import create_moli_search_space
 from utils.choose_gpu import get_free_gpu
-from train_moli import optimise_hyperparameter, reset_best_auroc
+from train_moli import (
+    train_final,
+    optimise_hyperparameter,
+    optimise_hyperparameter_group,
+    architecture_parameters,
+)
 from utils import multi_omics_data
+from utils.model_artifact import save_model_artifact
+from utils.omics_view import OmicsView
 
 file_directory = Path(__file__).parent
 
@@ -26,6 +39,13 @@ def compute_final_hyperparameter(
     extern_dataset_name,
     gpu_number,
     deactivate_triplet_loss,
+    rebuild_data_cache,
+    parallel_trials,
+    scheduler,
+    batched_folds,
+    trial_batch_size,
+    resume,
+    export_model,
 ):
     device, pin_memory = create_device(gpu_number)
 
@@ -35,6 +55,7 @@ def compute_final_hyperparameter(
     result_path.mkdir(parents=True, exist_ok=True)
 
     result_file = open(result_path / "results.txt", "w")
+    results_store = ResultsStore(result_path, "moli", drug_name, experiment_name)
     log_file = open(result_path / "logs.txt", "w")
     log_file.write(f"Start for {drug_name}\n")
 
@@ -49,40 +70,72 @@ def compute_final_hyperparameter(
         _,
         _,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        rebuild_cache=rebuild_data_cache,
     )
 
+    gdsc_data = OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r)
+
     moli_search_space = create_moli_search_space(deactivate_triplet_loss)
 
     torch.manual_seed(parameter["random_seed"])
     np.random.seed(parameter["random_seed"])
 
-    reset_best_auroc()
-    evaluation_function = lambda parameterization: optimise_hyperparameter(
-        parameterization,
-        gdsc_e,
-        gdsc_m,
-        gdsc_c,
-        gdsc_r,
-        device,
-        pin_memory,
+    pruner = FoldPruner()
+    evaluation_function = partial(
+        optimise_hyperparameter,
+        data=gdsc_data,
+        device=device,
+        pin_memory=pin_memory,
+        pruner=pruner,
+        batched_folds=batched_folds,
     )
-    generation_strategy = create_generation_strategy()
-
-    best_parameters, _, experiment, _ = optimize(
-        total_trials=search_iterations,
-        experiment_name="Moli",
-        objective_name="auroc",
-        parameters=moli_search_space,
-        evaluation_function=evaluation_function,
-        minimize=False,
-        generation_strategy=generation_strategy,
+    group_evaluation_function = partial(
+        optimise_hyperparameter_group,
+        data=gdsc_data,
+        device=device,
+        pin_memory=pin_memory,
+        pruner=pruner,
+        batched_folds=max(1, batched_folds),
     )
 
-    # save results
-    max_objective = max(
-        np.array([trial.objective_mean for trial in experiment.trials.values()])
+    best_parameters, experiment = run_optimisation(
+        evaluation_function,
+        moli_search_space,
+        "Moli",
+        search_iterations,
+        parameter["random_seed"],
+        parallel_trials,
+        pruner,
+        scheduler,
+        trial_batch_size,
+        group_evaluation_function,
+        architecture_parameters,
+        checkpoint_file=ax_checkpoint_file(result_path),
+        resume=resume,
     )
+    results_store.add_study(experiment)
+    results_store.flush()
+
+    if export_model:
+        model_final, scaler_final = train_final(
+            best_parameters, gdsc_data, device, pin_memory
+        )
+        save_model_artifact(
+            result_path / "model.pt",
+            "moli",
+            best_parameters,
+            multi_omics_data.load_feature_names(
+                data_path, drug_name, extern_dataset_name
+            ),
+            scaler_final,
+            {"model": model_final},
+        )
+
+    # save results
+    max_objective = max(full_budget_objectives(experiment))
     result_file.write(f"\t\t{str(best_parameters) = }\n")
     result_file.write(f"\t\tBest {drug_name} test Auroc = {max_objective}\n")
 
@@ -105,7 +158,7 @@ def create_device(gpu_number):
 
 
 if __name__ == "__main__":
-    args = get_cmd_arguments()
+    args = get_cmd_arguments(batched_training=True)
     if args.drug == "all":
         for drug, extern_dataset in parameter["drugs"].items():
             compute_final_hyperparameter(
@@ -115,6 +168,13 @@ if __name__ == "__main__":
                 extern_dataset,
                 args.gpu_number,
                 args.deactivate_triplet_loss,
+                args.rebuild_data_cache,
+                args.parallel_trials,
+                args.scheduler,
+                args.batched_folds,
+                args.trial_batch_size,
+                args.resume,
+                args.export_model,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -124,4 +184,12 @@ if __name__ == "__main__":
             args.drug,
             extern_dataset,
             args.gpu_number,
+            args.deactivate_triplet_loss,
+            args.rebuild_data_cache,
+            args.parallel_trials,
+            args.scheduler,
+            args.batched_folds,
+            args.trial_batch_size,
+            args.resume,
+            args.export_model,
         )
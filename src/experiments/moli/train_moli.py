@@ -2,27 +2,33 @@ import numpy as np
 import torch
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from torch.utils.data.sampler import WeightedRandomSampler
 from tqdm import trange, tqdm
 from models.moli_model import Moli
 from utils import network_training_util
 from utils.network_training_util import (
     get_loss_fn,
-    create_data_loader,
+    create_view_data_loader,
     create_sampler,
 )
+from utils.fold_ensemble import (
+    MemberAdagrad,
+    fold_ensemble_result,
+    member_hyperparameter,
+    train_validate_fold_ensemble,
+)
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler
 from scipy.stats import sem
 
-best_auroc = -1
 cv_splits_inner = 5
+# parameters that change layer shapes or the batch schedule of a trial
+architecture_parameters = ("mini_batch", "epochs", "h_dim1", "h_dim2", "h_dim3")
 
 
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
-
-
-def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memory):
+def optimise_hyperparameter(
+    parameterization, data, device, pin_memory, pruner=None, batched_folds=0
+):
     mini_batch = parameterization["mini_batch"]
     h_dim1 = parameterization["h_dim1"]
     h_dim2 = parameterization["h_dim2"]
@@ -40,41 +46,34 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memo
     epochs = parameterization["epochs"]
     margin = parameterization["margin"]
 
+    if pruner is None:
+        pruner = FoldPruner()
+    if batched_folds > 0:
+        return optimise_hyperparameter_group(
+            [parameterization], data, device, pin_memory, pruner, batched_folds
+        )[0]
+
     aucs_validate = []
-    iteration = 1
     skf = StratifiedKFold(n_splits=cv_splits_inner)
     for train_index, validate_index in tqdm(
-        skf.split(x_e, y), total=skf.get_n_splits(), desc="k-fold"
+        skf.split(np.zeros(len(data)), data.labels),
+        total=skf.get_n_splits(),
+        desc="k-fold",
     ):
-        x_train_e = x_e[train_index]
-        x_train_m = x_m[train_index]
-        x_train_c = x_c[train_index]
-        y_train = y[train_index]
-
-        x_validate_e = x_e[validate_index]
-        x_validate_m = x_m[validate_index]
-        x_validate_c = x_c[validate_index]
-        y_validate = y[validate_index]
+        phase_timer.next_fold()
+        with phase("data slicing"):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
 
-        scaler_gdsc = StandardScaler()
-        scaler_gdsc.fit(x_train_e)
-        x_train_e = scaler_gdsc.transform(x_train_e)
+        scaler_gdsc = fit_scaler(train_data)
 
         # Initialisation
-        sampler = create_sampler(y_train)
-        train_loader = create_data_loader(
-            torch.FloatTensor(x_train_e),
-            torch.FloatTensor(x_train_m),
-            torch.FloatTensor(x_train_c),
-            torch.FloatTensor(y_train),
-            mini_batch,
-            pin_memory,
-            sampler,
+        sampler = create_sampler(train_data.labels)
+        train_loader = create_view_data_loader(
+            train_data, mini_batch, pin_memory, sampler, scaler_gdsc
         )
 
-        _, ie_dim = x_train_e.shape
-        _, im_dim = x_train_m.shape
-        _, ic_dim = x_train_c.shape
+        ie_dim, im_dim, ic_dim = data.dimensions
 
         loss_fn = get_loss_fn(margin, gamma)
 
@@ -100,53 +99,112 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memo
 
         for _ in trange(epochs, desc="Epoch"):
             network_training_util.train(
-                train_loader, moli_model, moli_optimiser, loss_fn, device, gamma
+                train_loader,
+                moli_model,
+                moli_optimiser,
+                loss_fn,
+                device,
+                gamma,
+                device_resident=True,
             )
 
         # validate
         auc_validate, _ = network_training_util.test(
             moli_model,
             scaler_gdsc,
-            x_validate_e,
-            x_validate_m,
-            x_validate_c,
-            y_validate,
+            validate_data.array(0),
+            validate_data.array(1),
+            validate_data.array(2),
+            validate_data.labels,
             device,
         )
         aucs_validate.append(auc_validate)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(
-                np.concatenate([aucs_validate, remaining_best_results])
-            )
-            if check_best_auroc(best_possible_mean):
-                print("Skip remaining folds.")
-                break
-        iteration += 1
+        if pruner.should_stop(aucs_validate, cv_splits_inner):
+            print("Skip remaining folds.")
+            break
 
     mean = np.mean(aucs_validate)
-    set_best_auroc(mean)
+    pruner.report(aucs_validate, cv_splits_inner)
     standard_error_of_mean = sem(aucs_validate)
 
-    return {"auroc": (mean, standard_error_of_mean)}
+    return {
+        "auroc": (mean, standard_error_of_mean),
+        "completed_folds": len(aucs_validate),
+        "pruned": len(aucs_validate) < cv_splits_inner,
+    }
 
 
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
+def optimise_hyperparameter_group(
+    parameterizations, data, device, pin_memory, pruner=None, batched_folds=1
+):
+    """
+    Evaluates parameterizations that share the architecture_parameters in one
+    batched training run and returns one result per parameterization.
+    """
+    if pruner is None:
+        pruner = FoldPruner()
+    ie_dim, im_dim, ic_dim = data.dimensions
+    input_sizes = [ie_dim, im_dim, ic_dim]
 
+    def create_model(parameterization):
+        dropout_rates = [
+            parameterization["dropout_rate_e"],
+            parameterization["dropout_rate_m"],
+            parameterization["dropout_rate_c"],
+            parameterization["dropout_rate_clf"],
+        ]
+        output_sizes = [
+            parameterization["h_dim1"],
+            parameterization["h_dim2"],
+            parameterization["h_dim3"],
+        ]
+        return Moli(input_sizes, output_sizes, dropout_rates)
+
+    def create_optimiser(ensemble, member_parameterizations):
+        def lr(name):
+            return member_hyperparameter(member_parameterizations, name)
+
+        return MemberAdagrad(
+            [
+                {"params": ensemble.parameters_of("expression_encoder"), "lr": lr("lr_e")},
+                {"params": ensemble.parameters_of("mutation_encoder"), "lr": lr("lr_m")},
+                {"params": ensemble.parameters_of("cna_encoder"), "lr": lr("lr_c")},
+                {"params": ensemble.parameters_of("classifier"), "lr": lr("lr_cl")},
+            ],
+            weight_decay=member_hyperparameter(member_parameterizations, "weight_decay"),
+        )
 
-def set_best_auroc(new_auroc):
-    global best_auroc
-    if new_auroc > best_auroc:
-        best_auroc = new_auroc
+    def test_fn(model, scaler, validate_data):
+        auc_validate, _ = network_training_util.test(
+            model,
+            scaler,
+            validate_data.array(0),
+            validate_data.array(1),
+            validate_data.array(2),
+            validate_data.labels,
+            device,
+        )
+        return auc_validate
+
+    aucs_validate = train_validate_fold_ensemble(
+        data,
+        cv_splits_inner,
+        batched_folds,
+        parameterizations,
+        create_model,
+        create_optimiser,
+        test_fn,
+        device,
+        pin_memory,
+    )
+    return [
+        fold_ensemble_result(trial_aucs, cv_splits_inner, pruner)
+        for trial_aucs in aucs_validate
+    ]
 
 
-def train_final(
-    parameterization, x_train_e, x_train_m, x_train_c, y_train, device, pin_memory
-):
+def train_final(parameterization, train_data, device, pin_memory):
     mini_batch = parameterization["mini_batch"]
     h_dim1 = parameterization["h_dim1"]
     h_dim2 = parameterization["h_dim2"]
@@ -165,12 +223,9 @@ def train_final(
     margin = parameterization["margin"]
 
     train_scaler_gdsc = StandardScaler()
-    train_scaler_gdsc.fit(x_train_e)
-    x_train_e = train_scaler_gdsc.transform(x_train_e)
+    train_scaler_gdsc.fit(train_data.array(0))
 
-    ie_dim = x_train_e.shape[-1]
-    im_dim = x_train_m.shape[-1]
-    ic_dim = x_train_c.shape[-1]
+    ie_dim, im_dim, ic_dim = train_data.dimensions
 
     loss_fn = get_loss_fn(margin, gamma)
 
@@ -194,28 +249,19 @@ def train_final(
         weight_decay=weight_decay,
     )
 
-    class_sample_count = np.array(
-        [len(np.where(y_train == t)[0]) for t in np.unique(y_train)]
-    )
-    weight = 1.0 / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-
-    samples_weight = torch.from_numpy(samples_weight)
-    sampler = WeightedRandomSampler(
-        samples_weight.type("torch.DoubleTensor"), len(samples_weight), replacement=True
-    )
-    train_loader = create_data_loader(
-        torch.FloatTensor(x_train_e),
-        torch.FloatTensor(x_train_m),
-        torch.FloatTensor(x_train_c),
-        torch.FloatTensor(y_train),
-        mini_batch,
-        pin_memory,
-        sampler,
+    sampler = create_sampler(train_data.labels)
+    train_loader = create_view_data_loader(
+        train_data, mini_batch, pin_memory, sampler, train_scaler_gdsc
     )
 
     for _ in range(epochs):
         network_training_util.train(
-            train_loader, moli_model, moli_optimiser, loss_fn, device, gamma
+            train_loader,
+            moli_model,
+            moli_optimiser,
+            loss_fn,
+            device,
+            gamma,
+            device_resident=True,
         )
     return moli_model, train_scaler_gdsc
@@ -3,25 +3,25 @@ import torch
 from sklearn.metrics import roc_auc_score, average_precision_score
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from torch.utils.data.sampler import WeightedRandomSampler
 from tqdm import tqdm
 from models.omiEmbed_model import VaeClassifierModel
-from siamese_triplet.utils import AllTripletSelector
-from utils.network_training_util import create_sampler, create_data_loader
+from siamese_triplet.losses import BatchAllTripletLoss
+from utils.network_training_util import (
+    create_sampler,
+    create_view_data_loader,
+    mixed_class_batches,
+)
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler
 from scipy.stats import sem
 
-best_auroc = -1
 cv_splits_inner = 5
 lossFuncRecon = torch.nn.BCEWithLogitsLoss()
 classifier_loss = torch.nn.BCEWithLogitsLoss()
 
 
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
-
-
-def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memory):
+def optimise_hyperparameter(parameterization, data, device, pin_memory, pruner=None):
     torch.multiprocessing.set_sharing_strategy("file_system")
     mini_batch = parameterization["mini_batch"]
     lr_vae = parameterization["lr_vae"]
@@ -42,41 +42,29 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memo
 
     epochs_phase = int(epochs_phase / 3) if int(epochs_phase / 3) > 0 else 1
 
+    if pruner is None:
+        pruner = FoldPruner()
     aucs_validate = []
-    iteration = 1
     skf = StratifiedKFold(n_splits=cv_splits_inner)
     for train_index, validate_index in tqdm(
-        skf.split(x_e, y), total=skf.get_n_splits(), desc="k-fold"
+        skf.split(np.zeros(len(data)), data.labels),
+        total=skf.get_n_splits(),
+        desc="k-fold",
     ):
-        x_train_e = x_e[train_index]
-        x_train_m = x_m[train_index]
-        x_train_c = x_c[train_index]
-        y_train = y[train_index]
-
-        x_validate_e = x_e[validate_index]
-        x_validate_m = x_m[validate_index]
-        x_validate_c = x_c[validate_index]
-        y_validate = y[validate_index]
+        phase_timer.next_fold()
+        with phase("data slicing"):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
 
-        scaler_gdsc = StandardScaler()
-        x_train_e = scaler_gdsc.fit_transform(x_train_e)
+        scaler_gdsc = fit_scaler(train_data)
 
         # Initialisation
-        sampler = create_sampler(y_train)
-        train_loader = create_data_loader(
-            torch.FloatTensor(x_train_e),
-            torch.FloatTensor(x_train_m),
-            torch.FloatTensor(x_train_c),
-            torch.FloatTensor(y_train),
-            mini_batch,
-            pin_memory,
-            sampler,
+        sampler = create_sampler(train_data.labels)
+        train_loader = create_view_data_loader(
+            train_data, mini_batch, pin_memory, sampler, scaler_gdsc
         )
 
-        e_in = x_train_e.shape[-1]
-        m_in = x_train_m.shape[-1]
-        c_in = x_train_c.shape[-1]
-        omic_dims = (e_in, m_in, c_in)
+        omic_dims = data.dimensions
 
         omi_embed_model = VaeClassifierModel(
             omic_dims,
@@ -118,45 +106,29 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device, pin_memo
         auc_validate, _ = test_omi_embed(
             omi_embed_model,
             scaler_gdsc,
-            torch.FloatTensor(x_validate_e),
-            torch.FloatTensor(x_validate_m),
-            torch.FloatTensor(x_validate_c),
-            y_validate,
+            validate_data.array(0),
+            validate_data.array(1),
+            validate_data.array(2),
+            validate_data.labels,
         )
         aucs_validate.append(auc_validate)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(
-                np.concatenate([aucs_validate, remaining_best_results])
-            )
-            if check_best_auroc(best_possible_mean):
-                print("Skip remaining folds.")
-                break
-        iteration += 1
+        if pruner.should_stop(aucs_validate, cv_splits_inner):
+            print("Skip remaining folds.")
+            break
 
     mean = np.mean(aucs_validate)
-    set_best_auroc(mean)
+    pruner.report(aucs_validate, cv_splits_inner)
     standard_error_of_mean = sem(aucs_validate)
 
-    return {"auroc": (mean, standard_error_of_mean)}
-
-
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
-
+    return {
+        "auroc": (mean, standard_error_of_mean),
+        "completed_folds": len(aucs_validate),
+        "pruned": len(aucs_validate) < cv_splits_inner,
+    }
 
-def set_best_auroc(new_auroc):
-    global best_auroc
-    if new_auroc > best_auroc:
-        best_auroc = new_auroc
 
-
-def train_final(
-    parameterization, x_train_e, x_train_m, x_train_c, y_train, device, pin_memory
-):
+def train_final(parameterization, train_data, device, pin_memory):
     mini_batch = parameterization["mini_batch"]
     lr_vae = parameterization["lr_vae"]
     lr_classifier = parameterization["lr_classifier"]
@@ -177,10 +149,9 @@ def train_final(
     epochs_phase = int(epochs_phase / 3) if int(epochs_phase / 3) > 0 else 1
 
     train_scaler_gdsc = StandardScaler()
-    train_scaler_gdsc.fit(x_train_e)
-    x_train_e = train_scaler_gdsc.transform(x_train_e)
+    train_scaler_gdsc.fit(train_data.array(0))
 
-    omic_dims = (x_train_e.shape[-1], x_train_m.shape[-1], x_train_c.shape[-1])
+    omic_dims = train_data.dimensions
     omi_embed_model = VaeClassifierModel(
         omic_dims,
         dropout,
@@ -204,24 +175,9 @@ def train_final(
         weight_decay=weight_decay,
     )
 
-    class_sample_count = np.array(
-        [len(np.where(y_train == t)[0]) for t in np.unique(y_train)]
-    )
-    weight = 1.0 / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-
-    samples_weight = torch.from_numpy(samples_weight)
-    sampler = WeightedRandomSampler(
-        samples_weight.type("torch.DoubleTensor"), len(samples_weight), replacement=True
-    )
-    train_loader = create_data_loader(
-        torch.FloatTensor(x_train_e),
-        torch.FloatTensor(x_train_m),
-        torch.FloatTensor(x_train_c),
-        torch.FloatTensor(y_train),
-        mini_batch,
-        pin_memory,
-        sampler,
+    sampler = create_sampler(train_data.labels)
+    train_loader = create_view_data_loader(
+        train_data, mini_batch, pin_memory, sampler, train_scaler_gdsc
     )
 
     train_omi_embed(
@@ -253,73 +209,62 @@ def train_omi_embed(
 ):
 
     if gamma > 0:
-        triplet_loss_fn = torch.nn.TripletMarginLoss(margin=margin, p=2)
-        triplet_selector = AllTripletSelector()
+        triplet_loss_fn = BatchAllTripletLoss(margin)
     else:
         triplet_loss_fn = None
-        triplet_selector = None
 
-    y_true = []
     for _ in range(epochs):
         model.netEmbed.train()
         model.netDown.eval()
-        for (data_e, data_m, data_c, target) in train_loader:
-            if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                    optimiser_embedding.zero_grad()
-                    y_true.extend(target)
-                    data_e = data_e.to(device)
-                    data_m = data_m.to(device)
-                    data_c = data_c.to(device)
-                    _, recon_x, mean, log_var = model.encode(data_e, data_m, data_c)
-                    loss_kl = kl_loss(mean, log_var)
-                    reconstruction_loss = (
-                        lossFuncRecon(recon_x[0], data_e)
-                        + lossFuncRecon(recon_x[1], data_m)
-                        + lossFuncRecon(recon_x[2], data_c)
-                    )
-                    loss = k_kl * loss_kl + reconstruction_loss
-
-                    if gamma > 0:
-                        triplets = triplet_selector.get_triplets(mean, target)
-                        triplet_loss = triplet_loss_fn(
-                            mean[triplets[:, 0], :],
-                            mean[triplets[:, 1], :],
-                            mean[triplets[:, 2], :],
-                        )
-                        loss += triplet_loss
-                    loss.backward()
-                    optimiser_embedding.step()
+        for (data_e, data_m, data_c, target) in mixed_class_batches(train_loader):
+            optimiser_embedding.zero_grad()
+            data_e = data_e.to(device)
+            data_m = data_m.to(device)
+            data_c = data_c.to(device)
+            with phase("forward"):
+                _, recon_x, mean, log_var = model.encode(data_e, data_m, data_c)
+                loss_kl = kl_loss(mean, log_var)
+                reconstruction_loss = (
+                    lossFuncRecon(recon_x[0], data_e)
+                    + lossFuncRecon(recon_x[1], data_m)
+                    + lossFuncRecon(recon_x[2], data_c)
+                )
+                loss = k_kl * loss_kl + reconstruction_loss
+
+            if gamma > 0:
+                with phase("forward"):
+                    loss += triplet_loss_fn(mean, target)
+            with phase("backward"):
+                loss.backward()
+                optimiser_embedding.step()
 
     for _ in range(epochs):
         model.netEmbed.eval()
         model.netDown.train()
-        for (data_e, data_m, data_c, target) in train_loader:
-            if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                    optimiser_classifier.zero_grad()
-                    y_true.extend(target)
-                    data_e = data_e.to(device)
-                    data_m = data_m.to(device)
-                    data_c = data_c.to(device)
-                    target = target.to(device)
-                    logit = model.classify(data_e, data_m, data_c)
-                    loss = classifier_loss(target, torch.squeeze(logit))
-                    loss.backward()
-                    optimiser_classifier.step()
+        for (data_e, data_m, data_c, target) in mixed_class_batches(train_loader):
+            optimiser_classifier.zero_grad()
+            data_e = data_e.to(device)
+            data_m = data_m.to(device)
+            data_c = data_c.to(device)
+            target = target.to(device)
+            with phase("forward"):
+                logit = model.classify(data_e, data_m, data_c)
+                loss = classifier_loss(target, torch.squeeze(logit))
+            with phase("backward"):
+                loss.backward()
+                optimiser_classifier.step()
 
     for _ in range(epochs):
         model.netEmbed.train()
         model.netDown.train()
-        for (data_e, data_m, data_c, target) in train_loader:
-            if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                optimiser_embedding.zero_grad()
-                optimiser_classifier.zero_grad()
-                y_true.extend(target)
-                data_e = data_e.to(device)
-                data_m = data_m.to(device)
-                data_c = data_c.to(device)
-                target = target.to(device)
+        for (data_e, data_m, data_c, target) in mixed_class_batches(train_loader):
+            optimiser_embedding.zero_grad()
+            optimiser_classifier.zero_grad()
+            data_e = data_e.to(device)
+            data_m = data_m.to(device)
+            data_c = data_c.to(device)
+            target = target.to(device)
+            with phase("forward"):
                 z, recon_x, mean, log_var, logit = model.encode_and_classify(
                     data_e, data_m, data_c
                 )
@@ -334,6 +279,7 @@ def train_omi_embed(
                     k_embed * (k_kl * loss_kl + reconstruction_loss)
                     + classification_loss
                 )
+            with phase("backward"):
                 loss.backward()
                 optimiser_embedding.step()
                 optimiser_classifier.step()
@@ -353,8 +299,9 @@ def test_omi_embed(model, scaler, extern_e, extern_m, extern_c, test_r):
     with torch.no_grad():
         logit = model.classify(extern_e, extern_m, extern_c)
     probabilities = sigmoid(logit)
-    auc_validate = roc_auc_score(test_y, probabilities)
-    auprc_validate = average_precision_score(test_y, probabilities)
+    with phase("auroc"):
+        auc_validate = roc_auc_score(test_y, probabilities)
+        auprc_validate = average_precision_score(test_y, probabilities)
     return auc_validate, auprc_validate
 
 
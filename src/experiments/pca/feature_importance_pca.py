@@ -3,18 +3,20 @@ import torch
 from pathlib import Path
 import numpy as np
 import sys
-from captum.attr import ShapleyValueSampling
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 from utils.input_arguments import get_cmd_arguments
 from utils import multi_omics_data
+from utils.omics_view import OmicsView
 from utils.interpretability import (
-    compute_importances_values_multiple_inputs,
+    compute_linear_importances_multiple_inputs,
+    compute_omics_shapley_values,
     save_importance_results,
 )
 from train_pca import train_final
 from models.pca_model import PcaModel
-from utils.visualisation import visualize_importances
+from utils.feature_groups import create_feature_groups
+from utils.visualisation import save_omics_shapley_values, visualize_importances
 from utils.choose_gpu import create_device
 
 
@@ -100,7 +102,16 @@ np.random.seed(parameter["random_seed"])
 
 
 def pca_feature_importance(
-    experiment_name, drug_name, extern_dataset_name, convert_ids, gpu_number
+    experiment_name,
+    drug_name,
+    extern_dataset_name,
+    convert_ids,
+    gpu_number,
+    rebuild_data_cache,
+    attribute_test,
+    group_by,
+    gene_set_file,
+    attribution_method,
 ):
     hyperparameter = best_hyperparameter[drug_name]
     device, _ = create_device(gpu_number)
@@ -127,7 +138,14 @@ def pca_feature_importance(
         extern_c,
         _,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name, return_data_frames=True
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        return_data_frames=True,
+        rebuild_cache=rebuild_data_cache,
+    )
+    feature_groups = create_feature_groups(
+        group_by, gene_set_file, (gdsc_e.columns, gdsc_m.columns, gdsc_c.columns)
     )
     # get columns names
     expression_columns = gdsc_e.columns
@@ -157,10 +175,7 @@ def pca_feature_importance(
 
     pca_model, train_scaler_gdsc, pca_e, pca_m, pca_c = train_final(
         hyperparameter,
-        gdsc_e,
-        gdsc_m,
-        gdsc_c,
-        gdsc_r,
+        OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r),
         device,
         pin_memory=False,
     )
@@ -172,27 +187,52 @@ def pca_feature_importance(
 
     extern_e_scaled = torch.Tensor(train_scaler_gdsc.transform(extern_e)).to(device)
 
-    full_pca_model = PcaModel(pca_e, pca_m, pca_c, pca_model, device)
+    full_pca_model = PcaModel(pca_e, pca_m, pca_c, pca_model).to(device)
+    full_pca_model.eval()
 
-    shapley = ShapleyValueSampling(full_pca_model)
-
-    """ all_attributions_test = compute_importances_values_multiple_inputs(
-        (gdsc_e_scaled, gdsc_m, gdsc_c),
-        shapley,
+    omics_shapley_values_test = None
+    if attribute_test:
+        omics_shapley_values_test = compute_omics_shapley_values(
+            (gdsc_e_scaled, gdsc_m, gdsc_c), full_pca_model
+        )
+    omics_shapley_values_extern = compute_omics_shapley_values(
+        (extern_e_scaled, extern_m, extern_c), full_pca_model
     )
+    if attribution_method == "omics_shapley":
+        if attribute_test:
+            save_omics_shapley_values(
+                omics_shapley_values_test, result_path, "all_attributions_test"
+            )
+        save_omics_shapley_values(
+            omics_shapley_values_extern, result_path, "all_attributions_extern"
+        )
+        return
 
-    visualize_importances(
-        all_columns,
-        all_attributions_test,
-        path=result_path,
-        file_name="all_attributions_test",
-        convert_ids=convert_ids,
-        number_of_expression_features=number_of_expression_features,
-        number_of_mutation_features=number_of_mutation_features,
-    ) """
+    # PCA and classifier are linear, the Shapley values are exact and need
+    # no sampling
+    if attribute_test:
+        all_attributions_test = compute_linear_importances_multiple_inputs(
+            (gdsc_e_scaled, gdsc_m, gdsc_c),
+            full_pca_model,
+            feature_groups=feature_groups,
+        )
+
+        visualize_importances(
+            all_columns,
+            all_attributions_test,
+            path=result_path,
+            file_name="all_attributions_test",
+            convert_ids=convert_ids,
+            number_of_expression_features=number_of_expression_features,
+            number_of_mutation_features=number_of_mutation_features,
+            feature_groups=feature_groups,
+            omics_shapley_values=omics_shapley_values_test,
+        )
 
-    all_attributions_extern = compute_importances_values_multiple_inputs(
-        (extern_e_scaled, extern_m, extern_c), shapley
+    all_attributions_extern = compute_linear_importances_multiple_inputs(
+        (extern_e_scaled, extern_m, extern_c),
+        full_pca_model,
+        feature_groups=feature_groups,
     )
 
     visualize_importances(
@@ -203,22 +243,27 @@ def pca_feature_importance(
         convert_ids=convert_ids,
         number_of_expression_features=number_of_expression_features,
         number_of_mutation_features=number_of_mutation_features,
+        feature_groups=feature_groups,
+        omics_shapley_values=omics_shapley_values_extern,
     )
 
-    """ save_importance_results(
-        all_attributions_test,
-        all_columns,
-        result_path,
-        "extern",
-    ) """
+    if attribute_test:
+        save_importance_results(
+            all_attributions_test,
+            all_columns,
+            result_path,
+            "gdsc_test",
+            feature_groups=feature_groups,
+        )
+
     save_importance_results(
         all_attributions_extern,
         all_columns,
         result_path,
         "test",
+        feature_groups=feature_groups,
     )
 
-
 if __name__ == "__main__":
     args = get_cmd_arguments()
 
@@ -230,6 +275,11 @@ if __name__ == "__main__":
                 extern_dataset,
                 args.convert_ids,
                 args.gpu_number,
+                args.rebuild_data_cache,
+                args.attribute_test,
+                args.feature_groups,
+                args.gene_set_file,
+                args.attribution_method,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -239,4 +289,9 @@ if __name__ == "__main__":
             extern_dataset,
             args.convert_ids,
             args.gpu_number,
+            args.rebuild_data_cache,
+            args.attribute_test,
+            args.feature_groups,
+            args.gene_set_file,
+            args.attribution_method,
         )
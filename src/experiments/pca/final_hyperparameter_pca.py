@@ -1,25 +1,44 @@
 import sys
+from functools import partial
 from pathlib import Path
 import torch
 import numpy as np
 import yaml
-from ax import optimize
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
-from utils.experiment_utils import create_generation_strategy
+from utils.experiment_utils import (
+    ax_checkpoint_file,
+    full_budget_objectives,
+    run_optimisation,
+)
+from utils.results_store import ResultsStore
+from utils.fold_pruning import FoldPruner
 from utils.input_arguments import get_cmd_arguments
 from utils.searchspaces import create_pca_search_space
 from utils.choose_gpu import get_free_gpu
-from train_pca import optimise_hyperparameter, reset_best_auroc
+from train_pca import optimise_hyperparameter, train_final
 from utils import multi_omics_data
+from utils.model_artifact import pca_head, save_model_artifact
+from utils.omics_view import OmicsView
 
 file_directory = Path(__file__).parent
 with open((file_directory / "../../config/hyperparameter.yaml"), "r") as stream:
     parameter = yaml.safe_load(stream)
 
 
-def pca(search_iterations, experiment_name, drug_name, extern_dataset_name, gpu_number):
-    device, _ = create_device(gpu_number)
+def pca(
+    search_iterations,
+    experiment_name,
+    drug_name,
+    extern_dataset_name,
+    gpu_number,
+    rebuild_data_cache,
+    parallel_trials,
+    scheduler,
+    resume,
+    export_model,
+):
+    device, pin_memory = create_device(gpu_number)
 
     result_path = Path(
         file_directory, "..", "..", "..", "results", "pca", drug_name, experiment_name
@@ -27,6 +46,7 @@ def pca(search_iterations, experiment_name, drug_name, extern_dataset_name, gpu_
     result_path.mkdir(parents=True, exist_ok=True)
 
     result_file = open(result_path / "results.txt", "w")
+    results_store = ResultsStore(result_path, "pca", drug_name, experiment_name)
     log_file = open(result_path / "logs.txt", "w")
     log_file.write(f"Start for {drug_name}\n")
 
@@ -41,39 +61,60 @@ def pca(search_iterations, experiment_name, drug_name, extern_dataset_name, gpu_
         _,
         _,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        rebuild_cache=rebuild_data_cache,
     )
 
+    gdsc_data = OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r)
+
     pca_search_space = create_pca_search_space()
 
     torch.manual_seed(parameter["random_seed"])
     np.random.seed(parameter["random_seed"])
 
-    reset_best_auroc()
-    evaluation_function = lambda parameterization: optimise_hyperparameter(
-        parameterization,
-        gdsc_e,
-        gdsc_m,
-        gdsc_c,
-        gdsc_r,
-        device,
+    pruner = FoldPruner()
+    evaluation_function = partial(
+        optimise_hyperparameter,
+        data=gdsc_data,
+        device=device,
+        pruner=pruner,
     )
-    generation_strategy = create_generation_strategy()
-
-    best_parameters, _, experiment, _ = optimize(
-        total_trials=search_iterations,
-        experiment_name="PCA",
-        objective_name="auroc",
-        parameters=pca_search_space,
-        evaluation_function=evaluation_function,
-        minimize=False,
-        generation_strategy=generation_strategy,
+
+    best_parameters, experiment = run_optimisation(
+        evaluation_function,
+        pca_search_space,
+        "PCA",
+        search_iterations,
+        parameter["random_seed"],
+        parallel_trials,
+        pruner,
+        scheduler,
+        checkpoint_file=ax_checkpoint_file(result_path),
+        resume=resume,
     )
+    results_store.add_study(experiment)
+    results_store.flush()
+
+    if export_model:
+        model_final, scaler_final, pca_e, pca_m, pca_c = train_final(
+            best_parameters, gdsc_data, device, pin_memory
+        )
+        save_model_artifact(
+            result_path / "model.pt",
+            "pca",
+            best_parameters,
+            multi_omics_data.load_feature_names(
+                data_path, drug_name, extern_dataset_name
+            ),
+            scaler_final,
+            {"model": model_final},
+            head=pca_head(pca_e, pca_m, pca_c),
+        )
 
     # save results
-    max_objective = max(
-        np.array([trial.objective_mean for trial in experiment.trials.values()])
-    )
+    max_objective = max(full_budget_objectives(experiment))
 
     result_file.write(f"\t\t{str(best_parameters) = }\n")
     result_file.write(f"\t\tBest {drug_name} test Auroc = {max_objective}\n")
@@ -106,6 +147,11 @@ if __name__ == "__main__":
                 drug,
                 extern_dataset,
                 args.gpu_number,
+                args.rebuild_data_cache,
+                args.parallel_trials,
+                args.scheduler,
+                args.resume,
+                args.export_model,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -115,4 +161,9 @@ if __name__ == "__main__":
             args.drug,
             extern_dataset,
             args.gpu_number,
+            args.rebuild_data_cache,
+            args.parallel_trials,
+            args.scheduler,
+            args.resume,
+            args.export_model,
         )
@@ -2,7 +2,6 @@ import numpy as np
 import torch
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from torch.utils.data.sampler import WeightedRandomSampler
 from sklearn.metrics import roc_auc_score, average_precision_score
 from tqdm import trange, tqdm
 from models.pca_model import Classifier
@@ -10,21 +9,19 @@ from utils.network_training_util import (
     get_loss_fn,
     create_data_loader,
     create_sampler,
+    mixed_class_batches,
 )
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler, pca_projection
 from scipy.stats import sem
 from sklearn.decomposition import PCA
 
-best_auroc = -1
 cv_splits_inner = 5
 sigmoid = torch.nn.Sigmoid()
 
 
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
-
-
-def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device):
+def optimise_hyperparameter(parameterization, data, device, pruner=None):
     variance_e = parameterization["variance_e"]
     variance_m = parameterization["variance_m"]
     variance_c = parameterization["variance_c"]
@@ -34,32 +31,35 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device):
     epochs = parameterization["epochs"]
     mini_batch = parameterization["mini_batch"]
 
+    if pruner is None:
+        pruner = FoldPruner()
     aucs_validate = []
-    iteration = 1
     skf = StratifiedKFold(n_splits=cv_splits_inner)
     for train_index, validate_index in tqdm(
-        skf.split(x_e, y), total=skf.get_n_splits(), desc="k-fold"
+        skf.split(np.zeros(len(data)), data.labels),
+        total=skf.get_n_splits(),
+        desc="k-fold",
     ):
-        x_train_e = x_e[train_index]
-        x_train_m = x_m[train_index]
-        x_train_c = x_c[train_index]
-        y_train = y[train_index]
-
-        x_validate_e = x_e[validate_index]
-        x_validate_m = x_m[validate_index]
-        x_validate_c = x_c[validate_index]
-        y_validate = y[validate_index]
+        phase_timer.next_fold()
+        with phase("data slicing"):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
+        y_train = train_data.labels
 
-        scaler_gdsc = StandardScaler()
-        scaler_gdsc.fit(x_train_e)
-        x_train_e = scaler_gdsc.transform(x_train_e)
+        scaler_gdsc = fit_scaler(train_data)
 
         # Initialisation
         loss_fn = get_loss_fn(None, 0)
 
-        pca_e = PCA(n_components=variance_e).fit(x_train_e)
-        pca_m = PCA(n_components=variance_m).fit(x_train_m)
-        pca_c = PCA(n_components=variance_c).fit(x_train_c)
+        pca_e, transformed_e, validate_e = pca_projection(
+            train_data, validate_data, 0, variance_e, scaler_gdsc
+        )
+        pca_m, transformed_m, validate_m = pca_projection(
+            train_data, validate_data, 1, variance_m
+        )
+        pca_c, transformed_c, validate_c = pca_projection(
+            train_data, validate_data, 2, variance_c
+        )
 
         e_dimension = pca_e.n_components_
         m_dimension = pca_m.n_components_
@@ -75,16 +75,12 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device):
             weight_decay=weight_decay,
         )
 
-        transformed_e = pca_e.transform(x_train_e)
-        transformed_m = pca_m.transform(x_train_m)
-        transformed_c = pca_c.transform(x_train_c)
-
         sampler = create_sampler(y_train)
         train_loader = create_data_loader(
-            torch.FloatTensor(transformed_e),
-            torch.FloatTensor(transformed_m),
-            torch.FloatTensor(transformed_c),
-            torch.FloatTensor(y_train),
+            transformed_e,
+            transformed_m,
+            transformed_c,
+            y_train,
             mini_batch,
             True,
             sampler,
@@ -96,46 +92,30 @@ def optimise_hyperparameter(parameterization, x_e, x_m, x_c, y, device):
         # validate
         auc_validate, _ = test_pca(
             classifier_model,
-            pca_e.transform(scaler_gdsc.transform(x_validate_e)),
-            pca_m.transform(x_validate_m),
-            pca_c.transform(x_validate_c),
-            y_validate,
+            validate_e,
+            validate_m,
+            validate_c,
+            validate_data.labels,
             device,
         )
         aucs_validate.append(auc_validate)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(
-                np.concatenate([aucs_validate, remaining_best_results])
-            )
-            if check_best_auroc(best_possible_mean):
-                print("Skip remaining folds.")
-                break
-        iteration += 1
+        if pruner.should_stop(aucs_validate, cv_splits_inner):
+            print("Skip remaining folds.")
+            break
 
     mean = np.mean(aucs_validate)
-    set_best_auroc(mean)
+    pruner.report(aucs_validate, cv_splits_inner)
     standard_error_of_mean = sem(aucs_validate)
 
-    return {"auroc": (mean, standard_error_of_mean)}
-
-
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
-
-
-def set_best_auroc(new_auroc):
-    global best_auroc
-    if new_auroc > best_auroc:
-        best_auroc = new_auroc
+    return {
+        "auroc": (mean, standard_error_of_mean),
+        "completed_folds": len(aucs_validate),
+        "pruned": len(aucs_validate) < cv_splits_inner,
+    }
 
 
-def train_final(
-    parameterization, x_train_e, x_train_m, x_train_c, y_train, device, pin_memory
-):
+def train_final(parameterization, train_data, device, pin_memory):
     variance_e = parameterization["variance_e"]
     variance_m = parameterization["variance_m"]
     variance_c = parameterization["variance_c"]
@@ -145,9 +125,11 @@ def train_final(
     epochs = parameterization["epochs"]
     mini_batch = parameterization["mini_batch"]
 
+    x_train_m = train_data.array(1)
+    x_train_c = train_data.array(2)
+
     train_scaler_gdsc = StandardScaler()
-    train_scaler_gdsc.fit(x_train_e)
-    x_train_e = train_scaler_gdsc.transform(x_train_e)
+    x_train_e = train_scaler_gdsc.fit_transform(train_data.array(0))
 
     pca_e = PCA(n_components=variance_e).fit(x_train_e)
     pca_m = PCA(n_components=variance_m).fit(x_train_m)
@@ -171,22 +153,12 @@ def train_final(
         weight_decay=weight_decay,
     )
 
-    class_sample_count = np.array(
-        [len(np.where(y_train == t)[0]) for t in np.unique(y_train)]
-    )
-    weight = 1.0 / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-
-    samples_weight = torch.from_numpy(samples_weight)
-    sampler = WeightedRandomSampler(
-        samples_weight.type("torch.DoubleTensor"), len(samples_weight), replacement=True
-    )
-
+    sampler = create_sampler(train_data.labels)
     train_loader = create_data_loader(
-        torch.FloatTensor(transformed_e),
-        torch.FloatTensor(transformed_m),
-        torch.FloatTensor(transformed_c),
-        torch.FloatTensor(y_train),
+        transformed_e,
+        transformed_m,
+        transformed_c,
+        train_data.labels,
         mini_batch,
         pin_memory,
         sampler,
@@ -197,33 +169,43 @@ def train_final(
     return pca_model, train_scaler_gdsc, pca_e, pca_m, pca_c
 
 
-def train_pca(train_loader, model, optimiser, loss_fn, device):
-    y_true = []
-    predictions = []
+def train_pca(train_loader, model, optimiser, loss_fn, device, compute_auroc=False):
     model.train()
-    for (data_e, data_m, data_c, target) in train_loader:
-        if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-            optimiser.zero_grad()
-            y_true.extend(target)
-
-            data_e = data_e.to(device)
-            data_m = data_m.to(device)
-            data_c = data_c.to(device)
-            target = target.to(device)
-
-            input = torch.concat([data_e, data_m, data_c], axis=1)
-
+    if compute_auroc:
+        # preallocated on the device, read back once after the epoch
+        maximal_samples = len(train_loader) * train_loader.batch_size
+        y_true = torch.empty(maximal_samples, device=device)
+        predictions = torch.empty(maximal_samples, device=device)
+        number_of_samples = 0
+    for (data_e, data_m, data_c, target) in mixed_class_batches(train_loader):
+        optimiser.zero_grad()
+
+        data_e = data_e.to(device)
+        data_m = data_m.to(device)
+        data_c = data_c.to(device)
+        target = target.to(device)
+
+        input = torch.concat([data_e, data_m, data_c], axis=1)
+
+        with phase("forward"):
             prediction = model.forward(input)
             loss = loss_fn(torch.squeeze(prediction), target)
-            prediction = sigmoid(prediction)
 
-            predictions.extend(prediction.cpu().detach())
+        if compute_auroc:
+            batch_size = len(target)
+            batch_slice = slice(number_of_samples, number_of_samples + batch_size)
+            y_true[batch_slice] = target.detach().view(-1)
+            predictions[batch_slice] = sigmoid(prediction).detach().view(-1)
+            number_of_samples += batch_size
+        with phase("backward"):
             loss.backward()
             optimiser.step()
-    y_true = torch.FloatTensor(y_true)
-    predictions = torch.FloatTensor(predictions)
-    auroc = roc_auc_score(y_true, predictions)
-    return auroc
+    if not compute_auroc:
+        return None
+    y_true = y_true[:number_of_samples].cpu()
+    predictions = predictions[:number_of_samples].cpu()
+    with phase("auroc"):
+        return roc_auc_score(y_true, predictions)
 
 
 def test_pca(
@@ -243,8 +225,9 @@ def test_pca(
     input = torch.concat([x_test_e, x_test_m, x_test_c], axis=1)
     predictions = model.forward(input)
     probabilities = sigmoid(predictions)
-    auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
-    auprc_validate = average_precision_score(
-        test_y, probabilities.cpu().detach().numpy()
-    )
+    with phase("auroc"):
+        auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
+        auprc_validate = average_precision_score(
+            test_y, probabilities.cpu().detach().numpy()
+        )
     return auc_validate, auprc_validate
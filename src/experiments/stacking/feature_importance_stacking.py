@@ -3,17 +3,19 @@ import torch
 from pathlib import Path
 import numpy as np
 import sys
-from captum.attr import ShapleyValueSampling
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 from utils.input_arguments import get_cmd_arguments
 from utils import multi_omics_data
+from utils.omics_view import OmicsView
 from utils.interpretability import (
-    compute_importances_values_multiple_inputs,
+    compute_importances,
+    compute_omics_shapley_values,
     save_importance_results,
 )
 from train_stacking import train_final
-from utils.visualisation import visualize_importances
+from utils.feature_groups import create_feature_groups
+from utils.visualisation import save_omics_shapley_values, visualize_importances
 from utils.choose_gpu import create_device
 
 file_directory = Path(__file__).parent
@@ -154,7 +156,19 @@ np.random.seed(parameter["random_seed"])
 
 
 def stacking_feature_importance(
-    experiment_name, drug_name, extern_dataset_name, convert_ids, gpu_number
+    experiment_name,
+    drug_name,
+    extern_dataset_name,
+    convert_ids,
+    gpu_number,
+    rebuild_data_cache,
+    attribution_workers,
+    shard_size,
+    attribute_test,
+    group_by,
+    gene_set_file,
+    attribution_method,
+    compare_with_shapley,
 ):
     hyperparameter = best_hyperparameter[drug_name]
     device, _ = create_device(gpu_number)
@@ -181,7 +195,14 @@ def stacking_feature_importance(
         extern_c,
         __,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name, return_data_frames=True
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        return_data_frames=True,
+        rebuild_cache=rebuild_data_cache,
+    )
+    feature_groups = create_feature_groups(
+        group_by, gene_set_file, (gdsc_e.columns, gdsc_m.columns, gdsc_c.columns)
     )
     # get columns names
     expression_columns = gdsc_e.columns
@@ -211,10 +232,7 @@ def stacking_feature_importance(
 
     stacking_model, scaler_gdsc = train_final(
         hyperparameter,
-        gdsc_e,
-        gdsc_m,
-        gdsc_c,
-        gdsc_r,
+        OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r),
         device,
         pin_memory=False,
         stacking_type="less_stacking",
@@ -227,28 +245,60 @@ def stacking_feature_importance(
 
     extern_e_scaled = torch.Tensor(scaler_gdsc.transform(extern_e)).to(device)
 
-    shapley = ShapleyValueSampling(stacking_model)
-
-    """ all_attributions_test = compute_importances_values_multiple_inputs(
-        (gdsc_e_scaled, gdsc_m, gdsc_c),
-        shapley,
+    omics_shapley_values_test = None
+    if attribute_test:
+        omics_shapley_values_test = compute_omics_shapley_values(
+            (gdsc_e_scaled, gdsc_m, gdsc_c), stacking_model
+        )
+    omics_shapley_values_extern = compute_omics_shapley_values(
+        (extern_e_scaled, extern_m, extern_c), stacking_model
     )
+    if attribution_method == "omics_shapley":
+        if attribute_test:
+            save_omics_shapley_values(
+                omics_shapley_values_test, result_path, "all_attributions_test"
+            )
+        save_omics_shapley_values(
+            omics_shapley_values_extern, result_path, "all_attributions_extern"
+        )
+        return
 
-    visualize_importances(
-        all_columns,
-        all_attributions_test,
-        path=result_path,
-        file_name="all_attributions_test",
-        convert_ids=convert_ids,
-        number_of_expression_features=number_of_expression_features,
-        number_of_mutation_features=number_of_mutation_features,
-    ) """
+    shard_path = result_path / "shards"
+    if attribute_test:
+        all_attributions_test = compute_importances(
+            (gdsc_e_scaled, gdsc_m, gdsc_c),
+            stacking_model,
+            attribution_method,
+            shard_path / "test",
+            attribution_workers,
+            shard_size,
+            feature_groups=feature_groups,
+            report_file=result_path / "attribution_report_test.json",
+            compare_with_shapley=compare_with_shapley,
+        )
 
-    extern_e_scaled.requires_grad_()
-    extern_m.requires_grad_()
-    extern_c.requires_grad_()
-    all_attributions_extern = compute_importances_values_multiple_inputs(
-        (extern_e_scaled, extern_m, extern_c), shapley
+        visualize_importances(
+            all_columns,
+            all_attributions_test,
+            path=result_path,
+            file_name="all_attributions_test",
+            convert_ids=convert_ids,
+            number_of_expression_features=number_of_expression_features,
+            number_of_mutation_features=number_of_mutation_features,
+            feature_groups=feature_groups,
+            omics_shapley_values=omics_shapley_values_test,
+        )
+
+    all_attributions_extern = compute_importances(
+        (extern_e_scaled, extern_m, extern_c),
+        stacking_model,
+        attribution_method,
+        shard_path / "extern",
+        attribution_workers,
+        shard_size,
+        feature_groups=feature_groups,
+        report_file=result_path / "attribution_report_extern.json",
+        compare_with_shapley=compare_with_shapley,
     )
 
     visualize_importances(
@@ -259,19 +309,25 @@ def stacking_feature_importance(
         convert_ids=convert_ids,
         number_of_expression_features=number_of_expression_features,
         number_of_mutation_features=number_of_mutation_features,
+        feature_groups=feature_groups,
+        omics_shapley_values=omics_shapley_values_extern,
     )
 
-    """ save_importance_results(
-        all_attributions_test,
-        all_columns,
-        result_path,
-        "extern",
-    ) """
+    if attribute_test:
+        save_importance_results(
+            all_attributions_test,
+            all_columns,
+            result_path,
+            "gdsc_test",
+            feature_groups=feature_groups,
+        )
+
     save_importance_results(
         all_attributions_extern,
         all_columns,
         result_path,
         "test",
+        feature_groups=feature_groups,
     )
 
 
@@ -286,6 +342,14 @@ if __name__ == "__main__":
                 extern_dataset,
                 args.convert_ids,
                 args.gpu_number,
+                args.rebuild_data_cache,
+                args.attribution_workers,
+                args.shard_size,
+                args.attribute_test,
+                args.feature_groups,
+                args.gene_set_file,
+                args.attribution_method,
+                args.compare_with_shapley,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -295,4 +359,12 @@ if __name__ == "__main__":
             extern_dataset,
             args.convert_ids,
             args.gpu_number,
+            args.rebuild_data_cache,
+            args.attribution_workers,
+            args.shard_size,
+            args.attribute_test,
+            args.feature_groups,
+            args.gene_set_file,
+            args.attribution_method,
+            args.compare_with_shapley,
         )
@@ -2,29 +2,45 @@ import numpy as np
 import torch
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from torch.utils.data.sampler import WeightedRandomSampler
 from tqdm import trange, tqdm
 from models.stacking_model import StackingModel
 from utils.network_training_util import (
     get_loss_fn,
-    create_data_loader,
+    create_view_data_loader,
     create_sampler,
     train,
     test,
 )
+from utils.fold_ensemble import (
+    MemberAdagrad,
+    fold_ensemble_result,
+    member_hyperparameter,
+    train_validate_fold_ensemble,
+)
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler
 from scipy.stats import sem
 
-best_auroc = -1
 cv_splits_inner = 5
-
-
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
+# parameters that change layer shapes or the batch schedule of a trial
+architecture_parameters = (
+    "mini_batch",
+    "epochs",
+    "h_dim_e_encode",
+    "h_dim_m_encode",
+    "h_dim_c_encode",
+)
 
 
 def optimise_hyperparameter(
-    parameterization, x_e, x_m, x_c, y, device, pin_memory, stacking_type
+    parameterization,
+    data,
+    device,
+    pin_memory,
+    stacking_type,
+    pruner=None,
+    batched_folds=0,
 ):
     mini_batch = parameterization["mini_batch"]
     h_dim_e_encode = parameterization["h_dim_e_encode"]
@@ -43,40 +59,40 @@ def optimise_hyperparameter(
     epochs = parameterization["epochs"]
     margin = parameterization["margin"]
 
+    if pruner is None:
+        pruner = FoldPruner()
+    if batched_folds > 0:
+        return optimise_hyperparameter_group(
+            [parameterization],
+            data,
+            device,
+            pin_memory,
+            stacking_type,
+            pruner,
+            batched_folds,
+        )[0]
+
     aucs_validate = []
-    iteration = 1
     skf = StratifiedKFold(n_splits=cv_splits_inner)
     for train_index, validate_index in tqdm(
-        skf.split(x_e, y), total=skf.get_n_splits(), desc="k-fold"
+        skf.split(np.zeros(len(data)), data.labels),
+        total=skf.get_n_splits(),
+        desc="k-fold",
     ):
-        x_train_e = x_e[train_index]
-        x_train_m = x_m[train_index]
-        x_train_c = x_c[train_index]
-        y_train = y[train_index]
+        phase_timer.next_fold()
+        with phase("data slicing"):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
 
-        x_validate_e = x_e[validate_index]
-        x_validate_m = x_m[validate_index]
-        x_validate_c = x_c[validate_index]
-        y_validate = y[validate_index]
-
-        scaler_gdsc = StandardScaler()
-        x_train_e = scaler_gdsc.fit_transform(x_train_e)
+        scaler_gdsc = fit_scaler(train_data)
 
         # Initialisation
-        sampler = create_sampler(y_train)
-        train_loader = create_data_loader(
-            torch.FloatTensor(x_train_e),
-            torch.FloatTensor(x_train_m),
-            torch.FloatTensor(x_train_c),
-            torch.FloatTensor(y_train),
-            mini_batch,
-            pin_memory,
-            sampler,
+        sampler = create_sampler(train_data.labels)
+        train_loader = create_view_data_loader(
+            train_data, mini_batch, pin_memory, sampler, scaler_gdsc
         )
 
-        _, ie_dim = x_train_e.shape
-        _, im_dim = x_train_m.shape
-        _, ic_dim = x_train_c.shape
+        ie_dim, im_dim, ic_dim = data.dimensions
 
         loss_fn = get_loss_fn(margin, gamma)
 
@@ -97,55 +113,121 @@ def optimise_hyperparameter(
             weight_decay=weight_decay,
         )
         for _ in trange(epochs, desc="Epoch"):
-            train(train_loader, stacking_model, moli_optimiser, loss_fn, device, gamma)
+            train(
+                train_loader,
+                stacking_model,
+                moli_optimiser,
+                loss_fn,
+                device,
+                gamma,
+                device_resident=True,
+            )
 
         # validate
         auc_validate, _ = test(
             stacking_model,
             scaler_gdsc,
-            x_validate_e,
-            x_validate_m,
-            x_validate_c,
-            y_validate,
+            validate_data.array(0),
+            validate_data.array(1),
+            validate_data.array(2),
+            validate_data.labels,
             device,
         )
         aucs_validate.append(auc_validate)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(
-                np.concatenate([aucs_validate, remaining_best_results])
-            )
-            if check_best_auroc(best_possible_mean):
-                print("Skip remaining folds.")
-                break
-        iteration += 1
+        if pruner.should_stop(aucs_validate, cv_splits_inner):
+            print("Skip remaining folds.")
+            break
 
     mean = np.mean(aucs_validate)
-    set_best_auroc(mean)
+    pruner.report(aucs_validate, cv_splits_inner)
     standard_error_of_mean = sem(aucs_validate)
 
-    return {"auroc": (mean, standard_error_of_mean)}
+    return {
+        "auroc": (mean, standard_error_of_mean),
+        "completed_folds": len(aucs_validate),
+        "pruned": len(aucs_validate) < cv_splits_inner,
+    }
 
 
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
+def optimise_hyperparameter_group(
+    parameterizations,
+    data,
+    device,
+    pin_memory,
+    stacking_type,
+    pruner=None,
+    batched_folds=1,
+):
+    """
+    Evaluates parameterizations that share the architecture_parameters in one
+    batched training run and returns one result per parameterization.
+    """
+    if pruner is None:
+        pruner = FoldPruner()
+    ie_dim, im_dim, ic_dim = data.dimensions
+    input_sizes = [ie_dim, im_dim, ic_dim]
 
+    def create_model(parameterization):
+        encoding_sizes = [
+            parameterization["h_dim_e_encode"],
+            parameterization["h_dim_m_encode"],
+            parameterization["h_dim_c_encode"],
+        ]
+        dropout_rates = [
+            parameterization["dropout_e"],
+            parameterization["dropout_m"],
+            parameterization["dropout_c"],
+            parameterization["dropout_clf"],
+        ]
+        return StackingModel(input_sizes, encoding_sizes, dropout_rates, stacking_type)
+
+    def create_optimiser(ensemble, member_parameterizations):
+        def lr(name):
+            return member_hyperparameter(member_parameterizations, name)
+
+        return MemberAdagrad(
+            [
+                {"params": ensemble.parameters_of("expression_encoder"), "lr": lr("lr_e")},
+                {"params": ensemble.parameters_of("mutation_encoder"), "lr": lr("lr_m")},
+                {"params": ensemble.parameters_of("cna_encoder"), "lr": lr("lr_c")},
+            ],
+            lr=lr("lr_clf"),
+            weight_decay=member_hyperparameter(member_parameterizations, "weight_decay"),
+        )
 
-def set_best_auroc(new_auroc):
-    global best_auroc
-    if new_auroc > best_auroc:
-        best_auroc = new_auroc
+    def test_fn(model, scaler, validate_data):
+        auc_validate, _ = test(
+            model,
+            scaler,
+            validate_data.array(0),
+            validate_data.array(1),
+            validate_data.array(2),
+            validate_data.labels,
+            device,
+        )
+        return auc_validate
+
+    aucs_validate = train_validate_fold_ensemble(
+        data,
+        cv_splits_inner,
+        batched_folds,
+        parameterizations,
+        create_model,
+        create_optimiser,
+        test_fn,
+        device,
+        pin_memory,
+    )
+    return [
+        fold_ensemble_result(trial_aucs, cv_splits_inner, pruner)
+        for trial_aucs in aucs_validate
+    ]
 
 
 def train_final(
     parameterization,
-    x_train_e,
-    x_train_m,
-    x_train_c,
-    y_train,
+    train_data,
     device,
     pin_memory,
     stacking_type,
@@ -168,11 +250,9 @@ def train_final(
     margin = parameterization["margin"]
 
     train_scaler_gdsc = StandardScaler()
-    x_train_e = train_scaler_gdsc.fit_transform(x_train_e)
+    train_scaler_gdsc.fit(train_data.array(0))
 
-    _, ie_dim = x_train_e.shape
-    _, im_dim = x_train_m.shape
-    _, ic_dim = x_train_c.shape
+    ie_dim, im_dim, ic_dim = train_data.dimensions
 
     loss_fn = get_loss_fn(margin, gamma)
 
@@ -194,28 +274,19 @@ def train_final(
         weight_decay=weight_decay,
     )
 
-    class_sample_count = np.array(
-        [len(np.where(y_train == t)[0]) for t in np.unique(y_train)]
-    )
-    weight = 1.0 / class_sample_count
-    samples_weight = np.array([weight[t] for t in y_train])
-
-    samples_weight = torch.from_numpy(samples_weight)
-    sampler = WeightedRandomSampler(
-        samples_weight.type("torch.DoubleTensor"), len(samples_weight), replacement=True
-    )
-    train_loader = create_data_loader(
-        torch.FloatTensor(x_train_e),
-        torch.FloatTensor(x_train_m),
-        torch.FloatTensor(x_train_c),
-        torch.FloatTensor(y_train),
-        mini_batch,
-        pin_memory,
-        sampler,
+    sampler = create_sampler(train_data.labels)
+    train_loader = create_view_data_loader(
+        train_data, mini_batch, pin_memory, sampler, train_scaler_gdsc
     )
 
     for _ in range(epochs):
         train(
-            train_loader, stacking_model, optimiser, loss_fn, device, gamma
+            train_loader,
+            stacking_model,
+            optimiser,
+            loss_fn,
+            device,
+            gamma,
+            device_resident=True,
         )
     return stacking_model, train_scaler_gdsc
@@ -6,14 +6,17 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 from utils import multi_omics_data
+from utils.model_artifact import save_model_artifact
+from utils.omics_view import OmicsView
 from utils.choose_gpu import get_free_gpu
-from train_super_felt import optimise_super_felt_parameter
+from train_super_felt import optimise_super_felt_parameter, train_final
+from utils.experiment_utils import ax_checkpoint_file, full_budget_objectives
+from utils.results_store import ResultsStore
 from utils.input_arguments import get_cmd_arguments
 
 file_directory = Path(__file__).parent
 with open((file_directory / "../../config/hyperparameter.yaml"), "r") as stream:
     parameter = yaml.safe_load(stream)
-best_auroc = 0
 
 
 def super_felt(
@@ -23,6 +26,11 @@ def super_felt(
     gpu_number,
     search_iterations,
     deactivate_triplet_loss,
+    rebuild_data_cache,
+    parallel_trials,
+    scheduler,
+    resume,
+    export_model,
 ):
     if torch.cuda.is_available():
         if gpu_number is None:
@@ -50,6 +58,7 @@ def super_felt(
     )
     result_path.mkdir(parents=True, exist_ok=True)
     result_file = open(result_path / "results.txt", "w")
+    results_store = ResultsStore(result_path, "super.felt", drug_name, experiment_name)
     (
         gdsc_e,
         gdsc_m,
@@ -60,24 +69,53 @@ def super_felt(
         _,
         _,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        rebuild_cache=rebuild_data_cache,
     )
 
-    global best_auroc
-    best_auroc = 0
+    gdsc_data = OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r)
     best_parameters, experiment = optimise_super_felt_parameter(
         search_iterations,
-        gdsc_e,
-        gdsc_m,
-        gdsc_c,
-        gdsc_r,
+        gdsc_data,
         device,
         deactivate_triplet_loss,
+        random_seed,
+        parallel_trials,
+        scheduler,
+        ax_checkpoint_file(result_path),
+        resume,
     )
+    results_store.add_study(experiment)
+    results_store.flush()
 
-    max_objective = max(
-        np.array([trial.objective_mean for trial in experiment.trials.values()])
-    )
+    if export_model:
+        (
+            encoder_e,
+            encoder_m,
+            encoder_c,
+            classifier,
+            scaler_final,
+        ) = train_final(gdsc_data, best_parameters, device, deactivate_triplet_loss)
+        save_model_artifact(
+            result_path / "model.pt",
+            "super.felt",
+            best_parameters,
+            multi_omics_data.load_feature_names(
+                data_path, drug_name, extern_dataset_name
+            ),
+            scaler_final,
+            {
+                "encoder_e": encoder_e,
+                "encoder_m": encoder_m,
+                "encoder_c": encoder_c,
+                "classifier": classifier,
+            },
+            options={"deactivate_triplet_loss": deactivate_triplet_loss},
+        )
+
+    max_objective = max(full_budget_objectives(experiment))
 
     result_file.write(f"\t\tBest {drug_name} validation Auroc = {max_objective}\n")
     result_file.write(f"\t\t{str(best_parameters) = }\n")
@@ -97,6 +135,11 @@ if __name__ == "__main__":
                 args.gpu_number,
                 args.search_iterations,
                 args.deactivate_triplet_loss,
+                args.rebuild_data_cache,
+                args.parallel_trials,
+                args.scheduler,
+                args.resume,
+                args.export_model,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -107,4 +150,9 @@ if __name__ == "__main__":
             args.gpu_number,
             args.search_iterations,
             args.deactivate_triplet_loss,
+            args.rebuild_data_cache,
+            args.parallel_trials,
+            args.scheduler,
+            args.resume,
+            args.export_model,
         )
@@ -9,8 +9,16 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 from utils.visualisation import save_auroc_plots, save_auroc_with_variance_plots
-from utils.experiment_utils import write_results_to_file
+from utils.experiment_utils import (
+    ax_checkpoint_file,
+    full_budget_objectives,
+    load_outer_fold_result,
+    save_outer_fold_result,
+    write_results_to_file,
+)
+from utils.results_store import ResultsStore
 from utils import multi_omics_data
+from utils.omics_view import OmicsView
 from utils.choose_gpu import get_free_gpu
 from train_super_felt import optimise_super_felt_parameter, compute_super_felt_metrics
 from utils.input_arguments import get_cmd_arguments
@@ -18,7 +26,6 @@ from utils.input_arguments import get_cmd_arguments
 file_directory = Path(__file__).parent
 with open((file_directory / "../../config/hyperparameter.yaml"), "r") as stream:
     parameter = yaml.safe_load(stream)
-best_auroc = 0
 
 
 def super_felt(
@@ -28,6 +35,10 @@ def super_felt(
     gpu_number,
     search_iterations,
     deactivate_triplet_loss,
+    rebuild_data_cache,
+    parallel_trials,
+    scheduler,
+    resume,
 ):
     if torch.cuda.is_available():
         if gpu_number is None:
@@ -55,6 +66,7 @@ def super_felt(
     )
     result_path.mkdir(parents=True, exist_ok=True)
     result_file = open(result_path / "results.txt", "w")
+    results_store = ResultsStore(result_path, "super.felt", drug_name, experiment_name)
     (
         gdsc_e,
         gdsc_m,
@@ -65,8 +77,12 @@ def super_felt(
         extern_c,
         extern_r,
     ) = multi_omics_data.load_drug_data_with_elbow(
-        data_path, drug_name, extern_dataset_name
+        data_path,
+        drug_name,
+        extern_dataset_name,
+        rebuild_cache=rebuild_data_cache,
     )
+    gdsc_data = OmicsView((gdsc_e, gdsc_m, gdsc_c), gdsc_r)
 
     test_auc_list = []
     extern_auc_list = []
@@ -85,55 +101,78 @@ def super_felt(
         total=skf_outer.get_n_splits(),
         desc=" Outer k-fold",
     ):
-        global best_auroc
-        best_auroc = 0
-        x_train_val_e = gdsc_e[train_index_outer]
-        x_test_e = gdsc_e[test_index]
-        x_train_val_m = gdsc_m[train_index_outer]
-        x_test_m = gdsc_m[test_index]
-        x_train_val_c = gdsc_c[train_index_outer]
-        x_test_c = gdsc_c[test_index]
-        y_train_val = gdsc_r[train_index_outer]
-        y_test = gdsc_r[test_index]
-        best_parameters, experiment = optimise_super_felt_parameter(
-            search_iterations,
-            x_train_val_e,
-            x_train_val_m,
-            x_train_val_c,
-            y_train_val,
-            device,
-            deactivate_triplet_loss,
-        )
-        external_AUC, external_AUCPR, test_AUC, test_AUCPR = compute_super_felt_metrics(
-            x_test_e,
-            x_test_m,
-            x_test_c,
-            x_train_val_e,
-            x_train_val_m,
-            x_train_val_c,
+        train_val_data = gdsc_data.subset(train_index_outer)
+        test_data = gdsc_data.subset(test_index)
+        outer_fold_result = None
+        if resume:
+            outer_fold_result = load_outer_fold_result(
+                result_path, iteration, search_iterations
+            )
+        if outer_fold_result is None:
+            best_parameters, experiment = optimise_super_felt_parameter(
+                search_iterations,
+                train_val_data,
+                device,
+                deactivate_triplet_loss,
+                random_seed,
+                parallel_trials,
+                scheduler,
+                ax_checkpoint_file(result_path, iteration),
+                resume,
+            )
+            results_store.add_study(experiment, iteration)
+            external_AUC, external_AUCPR, test_AUC, test_AUCPR = compute_super_felt_metrics(
+                test_data,
+                train_val_data,
+                best_parameters,
+                device,
+                extern_e,
+                extern_m,
+                extern_c,
+                extern_r,
+                deactivate_triplet_loss,
+            )
+            objectives = full_budget_objectives(experiment)
+            save_auroc_plots(objectives, result_path, iteration, search_iterations)
+
+            max_objective = max(full_budget_objectives(experiment))
+            outer_fold_result = (
+                best_parameters,
+                objectives,
+                max_objective,
+                test_AUC,
+                test_AUCPR,
+                external_AUC,
+                external_AUCPR,
+            )
+            save_outer_fold_result(
+                result_path, iteration, search_iterations, outer_fold_result
+            )
+            results_store.add_outer_fold(
+                iteration,
+                search_iterations,
+                best_parameters,
+                max_objective,
+                test_AUC,
+                test_AUCPR,
+                external_AUC,
+                external_AUCPR,
+            )
+            results_store.flush()
+        (
             best_parameters,
-            device,
-            extern_e,
-            extern_m,
-            extern_c,
-            extern_r,
-            y_test,
-            y_train_val,
-            deactivate_triplet_loss,
-        )
+            objectives,
+            max_objective,
+            test_AUC,
+            test_AUCPR,
+            external_AUC,
+            external_AUCPR,
+        ) = outer_fold_result
 
         test_auc_list.append(test_AUC)
         extern_auc_list.append(external_AUC)
         test_auprc_list.append(test_AUCPR)
         extern_auprc_list.append(external_AUCPR)
-        objectives = np.array(
-            [trial.objective_mean for trial in experiment.trials.values()]
-        )
-        save_auroc_plots(objectives, result_path, iteration, search_iterations)
-
-        max_objective = max(
-            np.array([trial.objective_mean for trial in experiment.trials.values()])
-        )
         objectives_list.append(objectives)
 
         test_validation_list.append(max_objective)
@@ -176,6 +215,10 @@ if __name__ == "__main__":
                 args.gpu_number,
                 args.search_iterations,
                 args.deactivate_triplet_loss,
+                args.rebuild_data_cache,
+                args.parallel_trials,
+                args.scheduler,
+                args.resume,
             )
     else:
         extern_dataset = parameter["drugs"][args.drug]
@@ -186,4 +229,8 @@ if __name__ == "__main__":
             args.gpu_number,
             args.search_iterations,
             args.deactivate_triplet_loss,
+            args.rebuild_data_cache,
+            args.parallel_trials,
+            args.scheduler,
+            args.resume,
         )
@@ -1,81 +1,78 @@
+from functools import partial
+
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 import torch
-from ax import optimize
 from scipy.stats import sem
 from sklearn.model_selection import StratifiedKFold
 from torch import optim
 from tqdm import tqdm
 
 from models.super_felt_model import SupervisedEncoder, Classifier, AutoEncoder
-from utils.experiment_utils import create_generation_strategy
+from siamese_triplet.losses import BatchAllTripletLoss
+from utils.experiment_utils import run_optimisation
 from utils.network_training_util import (
     train_encoder,
     train_autoencoder,
     train_classifier,
     create_sampler,
+    create_view_data_loader,
     super_felt_test,
     train_validate_classifier,
 )
+from utils.fold_pruning import FoldPruner
+from utils.phase_timer import phase, phase_timer
+from utils.preprocessing_cache import fit_scaler
 from utils.searchspaces import create_super_felt_search_space
 
 
-best_auroc = -1
 cv_splits_inner = 5
 
 
-def reset_best_auroc():
-    global best_auroc
-    best_auroc = 0
-
-
 def optimise_super_felt_parameter(
     search_iterations,
-    x_train_val_e,
-    x_train_val_m,
-    x_train_val_c,
-    y_train_val,
+    train_val_data,
     device,
     deactivate_triplet_loss,
+    random_seed,
+    parallel_trials=1,
+    scheduler="none",
+    checkpoint_file=None,
+    resume=False,
 ):
-    evaluation_function = lambda parameterization: train_validate_hyperparameter_set(
-        x_train_val_e,
-        x_train_val_m,
-        x_train_val_c,
-        y_train_val,
+    pruner = FoldPruner()
+    evaluation_function = partial(
+        train_validate_hyperparameter_set,
+        train_val_data,
         device,
-        parameterization,
-        deactivate_triplet_loss,
+        deactivate_triplet_loss=deactivate_triplet_loss,
+        pruner=pruner,
     )
-    generation_strategy = create_generation_strategy()
     search_space = create_super_felt_search_space()
-    best_parameters, _, experiment, _ = optimize(
-        total_trials=search_iterations,
-        experiment_name="Super.FELT",
-        objective_name="auroc",
-        parameters=search_space,
-        evaluation_function=evaluation_function,
-        minimize=False,
-        generation_strategy=generation_strategy,
+    best_parameters, experiment = run_optimisation(
+        evaluation_function,
+        search_space,
+        "Super.FELT",
+        search_iterations,
+        random_seed,
+        parallel_trials,
+        pruner,
+        scheduler,
+        checkpoint_file=checkpoint_file,
+        resume=resume,
     )
     return best_parameters, experiment
 
 
 def compute_super_felt_metrics(
-    x_test_e,
-    x_test_m,
-    x_test_c,
-    x_train_val_e,
-    x_train_val_m,
-    x_train_val_c,
+    test_data,
+    train_val_data,
     best_parameters,
     device,
     extern_e,
     extern_m,
     extern_c,
     extern_r,
-    y_test,
-    y_train_val,
     deactivate_triplet_loss,
 ):
     # retrain best
@@ -86,20 +83,17 @@ def compute_super_felt_metrics(
         final_Classifier,
         final_scaler_gdsc,
     ) = train_final(
-        x_train_val_e,
-        x_train_val_m,
-        x_train_val_c,
-        y_train_val,
+        train_val_data,
         best_parameters,
         device,
         deactivate_triplet_loss,
     )
     # Test
     test_AUC, test_AUCPR = super_felt_test(
-        x_test_e,
-        x_test_m,
-        x_test_c,
-        y_test,
+        test_data.array(0),
+        test_data.array(1),
+        test_data.array(2),
+        test_data.labels,
         device,
         final_C_Supervised_Encoder,
         final_Classifier,
@@ -124,14 +118,14 @@ def compute_super_felt_metrics(
 
 
 def train_validate_hyperparameter_set(
-    x_train_val_e,
-    x_train_val_m,
-    x_train_val_c,
-    y_train_val,
+    train_val_data,
     device,
     hyperparameters,
     deactivate_triplet_loss,
+    pruner=None,
 ):
+    if pruner is None:
+        pruner = FoldPruner()
     skf = StratifiedKFold(n_splits=cv_splits_inner)
     all_validation_aurocs = []
     encoder_dropout = hyperparameters["encoder_dropout"]
@@ -158,46 +152,32 @@ def train_validate_hyperparameter_set(
     loss_fn = (
         torch.nn.MSELoss()
         if deactivate_triplet_loss
-        else torch.nn.TripletMarginLoss(margin=margin, p=2)
+        else BatchAllTripletLoss(margin)
     )
     train_encoder_fn = train_autoencoder if deactivate_triplet_loss else train_encoder
 
-    iteration = 1
-
     for train_index, validate_index in tqdm(
-        skf.split(x_train_val_e, y_train_val), total=skf.get_n_splits(), desc="k-fold"
+        skf.split(np.zeros(len(train_val_data)), train_val_data.labels),
+        total=skf.get_n_splits(),
+        desc="k-fold",
     ):
-        X_trainE = x_train_val_e[train_index]
-        x_val_e = x_train_val_e[validate_index]
-        X_trainM = x_train_val_m[train_index]
-        x_val_m = x_train_val_m[validate_index]
-        X_trainC = x_train_val_c[train_index]
-        x_val_c = x_train_val_c[validate_index]
-        Y_train = y_train_val[train_index]
-        y_val = y_train_val[validate_index]
-        sampler = create_sampler(Y_train)
-        scalerGDSC = StandardScaler()
-        X_trainE = scalerGDSC.fit_transform(X_trainE)
-        x_val_e = torch.FloatTensor(scalerGDSC.transform(x_val_e)).to(device)
-        trainDataset = torch.utils.data.TensorDataset(
-            torch.FloatTensor(X_trainE),
-            torch.FloatTensor(X_trainM),
-            torch.FloatTensor(X_trainC),
-            torch.FloatTensor(Y_train.astype(int)),
+        phase_timer.next_fold()
+        with phase("data slicing"):
+            train_data = train_val_data.subset(train_index)
+            validate_data = train_val_data.subset(validate_index)
+        x_val_m = validate_data.array(1)
+        x_val_c = validate_data.array(2)
+        y_val = validate_data.labels
+        sampler = create_sampler(train_data.labels)
+        scalerGDSC = fit_scaler(train_data)
+        x_val_e = torch.FloatTensor(scalerGDSC.transform(validate_data.array(0))).to(
+            device
         )
-
-        train_loader = torch.utils.data.DataLoader(
-            dataset=trainDataset,
-            batch_size=mini_batch_size,
-            shuffle=False,
-            num_workers=8,
-            sampler=sampler,
-            drop_last=True,
+        train_loader = create_view_data_loader(
+            train_data, mini_batch_size, False, sampler, scalerGDSC
         )
 
-        IE_dim = X_trainE.shape[-1]
-        IM_dim = X_trainM.shape[-1]
-        IC_dim = X_trainC.shape[-1]
+        IE_dim, IM_dim, IC_dim = train_val_data.dimensions
 
         encoder = AutoEncoder if deactivate_triplet_loss else SupervisedEncoder
 
@@ -268,33 +248,22 @@ def train_validate_hyperparameter_set(
         )
         all_validation_aurocs.append(val_auroc)
 
-        if iteration < cv_splits_inner:
-            open_folds = cv_splits_inner - iteration
-            remaining_best_results = np.ones(open_folds)
-            best_possible_mean = np.mean(
-                np.concatenate([all_validation_aurocs, remaining_best_results])
-            )
-            if check_best_auroc(best_possible_mean):
-                print("Skip remaining folds.")
-                break
-        iteration += 1
-
-    val_auroc = np.mean(all_validation_aurocs)
-    standard_error_of_mean = sem(all_validation_aurocs)
-
-    return {"auroc": (val_auroc, standard_error_of_mean)}
+        if pruner.should_stop(all_validation_aurocs, cv_splits_inner):
+            print("Skip remaining folds.")
+            break
 
+    val_auroc = pruner.report(all_validation_aurocs, cv_splits_inner)
+    standard_error_of_mean = sem(all_validation_aurocs)
 
-def check_best_auroc(best_reachable_auroc):
-    global best_auroc
-    return best_reachable_auroc < best_auroc
+    return {
+        "auroc": (val_auroc, standard_error_of_mean),
+        "completed_folds": len(all_validation_aurocs),
+        "pruned": len(all_validation_aurocs) < cv_splits_inner,
+    }
 
 
 def train_final(
-    x_train_val_e,
-    x_train_val_m,
-    x_train_val_c,
-    y_train_val,
+    train_val_data,
     best_hyperparameter,
     device,
     deactivate_triplet_loss,
@@ -320,30 +289,17 @@ def train_final(
     loss_fn = (
         torch.nn.MSELoss()
         if deactivate_triplet_loss
-        else torch.nn.TripletMarginLoss(margin=margin, p=2)
+        else BatchAllTripletLoss(margin)
     )
     train_encoder_fn = train_autoencoder if deactivate_triplet_loss else train_encoder
 
-    sampler = create_sampler(y_train_val)
+    sampler = create_sampler(train_val_data.labels)
     final_scaler = StandardScaler()
-    x_train_val_e = final_scaler.fit_transform(x_train_val_e)
-    trainDataset = torch.utils.data.TensorDataset(
-        torch.FloatTensor(x_train_val_e),
-        torch.FloatTensor(x_train_val_m),
-        torch.FloatTensor(x_train_val_c),
-        torch.FloatTensor(y_train_val.astype(int)),
-    )
-    train_loader = torch.utils.data.DataLoader(
-        dataset=trainDataset,
-        batch_size=mb_size,
-        shuffle=False,
-        num_workers=8,
-        sampler=sampler,
-        drop_last=True,
+    final_scaler.fit(train_val_data.array(0))
+    train_loader = create_view_data_loader(
+        train_val_data, mb_size, False, sampler, final_scaler
     )
-    IE_dim = x_train_val_e.shape[-1]
-    IM_dim = x_train_val_m.shape[-1]
-    IC_dim = x_train_val_c.shape[-1]
+    IE_dim, IM_dim, IC_dim = train_val_data.dimensions
 
     encoder = AutoEncoder if deactivate_triplet_loss else SupervisedEncoder
     final_E_encoder = encoder(IE_dim, OE_dim, E_dr).to(device)
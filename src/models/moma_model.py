@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-import numpy as np
 
 
 class Moma(nn.Module):
@@ -140,25 +139,41 @@ class Moma(nn.Module):
             )
 
 
+class LogisticRegressionHead(nn.Module):
+    """
+    Logistic regression over the expression, mutation and CNA outputs of
+    Moma, with the coefficients of a fitted sklearn LogisticRegression.
+    """
+
+    def __init__(self, inputs=3):
+        super(LogisticRegressionHead, self).__init__()
+        self.linear = nn.Linear(inputs, 1)
+
+    def load_logistic_regression(self, logistic_regression):
+        with torch.no_grad():
+            self.linear.weight.copy_(torch.as_tensor(logistic_regression.coef_))
+            self.linear.bias.copy_(torch.as_tensor(logistic_regression.intercept_))
+        return self
+
+    def forward(self, predictions):
+        return torch.sigmoid(self.linear(torch.nan_to_num(predictions))).view(-1)
+
+
+def stack_predictions(predictions):
+    # Moma squeezes its outputs, a single sample gives scalars
+    return torch.stack([prediction.view(-1) for prediction in predictions], dim=-1)
+
+
 class FullMomaModel(nn.Module):
-    def __init__(self, classifier, logistic_regression, device):
+    # Moma calls its softmax module six times and normalises every omics
+    # attention input by its norm, which is 0 on a zero baseline. DeepLift
+    # supports neither.
+    deeplift_supported = False
+
+    def __init__(self, classifier, logistic_regression):
         super(FullMomaModel, self).__init__()
         self.classifier = classifier
         self.logistic_regression = logistic_regression
-        self.device = device
 
     def forward(self, e, m, c):
-        prediction_e, prediction_m, prediction_c = self.classifier(e, m, c)
-        X = np.stack(
-            [
-                prediction_e.detach().cpu(),
-                prediction_m.detach().cpu(),
-                prediction_c.detach().cpu(),
-            ],
-            axis=-1,
-        )
-        X = np.nan_to_num(X)
-        if len(X.shape) == 1:
-            X = X.reshape(1, -1)
-        final_probabilities = self.logistic_regression.predict_proba(X)[:, 1]
-        return torch.FloatTensor(final_probabilities).to(self.device)
+        return self.logistic_regression(stack_predictions(self.classifier(e, m, c)))
@@ -15,20 +15,58 @@ class Classifier(nn.Module):
 
 
 class PcaModel(nn.Module):
-    def __init__(self, pca_e, pca_m, pca_c, classifier, device):
+    """
+    PCA projections of expression, mutation and CNA followed by the
+    classifier. mean_ and components_ of the fitted PCAs are buffers, so the
+    projection runs on the device of the model.
+    """
+
+    def __init__(self, pca_e, pca_m, pca_c, classifier):
         super(PcaModel, self).__init__()
-        self.pca_e = pca_e
-        self.pca_m = pca_m
-        self.pca_c = pca_c
-        self.device = device
+        for omics, pca in (("e", pca_e), ("m", pca_m), ("c", pca_c)):
+            self.register_buffer(
+                f"mean_{omics}", torch.as_tensor(pca.mean_, dtype=torch.float32)
+            )
+            self.register_buffer(
+                f"components_{omics}",
+                torch.as_tensor(pca.components_, dtype=torch.float32),
+            )
         self.classifier = classifier
 
+    def project(self, e, m, c):
+        return [
+            (x - getattr(self, f"mean_{omics}")) @ getattr(self, f"components_{omics}").T
+            for omics, x in (("e", e), ("m", m), ("c", c))
+        ]
+
     def forward(self, e, m, c):
-        features_e = torch.FloatTensor(self.pca_e.transform(e.cpu().detach()))
-        features_m = torch.FloatTensor(self.pca_m.transform(m.cpu().detach()))
-        features_c = torch.FloatTensor(self.pca_c.transform(c.cpu().detach()))
+        return self.classifier(torch.concat(self.project(e, m, c), axis=1))
 
-        input = torch.concat([features_e, features_m, features_c], axis=1).to(
-            self.device
+    def input_weights(self):
+        # in eval mode the model is linear, w . components maps back to the inputs
+        linear = self.classifier.classifier[1]
+        component_weights = torch.split(
+            linear.weight[0],
+            [len(self.components_e), len(self.components_m), len(self.components_c)],
         )
-        return self.classifier(input)
+        return [
+            weights @ components
+            for weights, components in zip(
+                component_weights,
+                (self.components_e, self.components_m, self.components_c),
+            )
+        ]
+
+    def linear_attributions(self, e, m, c, baselines=(0, 0, 0)):
+        """
+        Exact Shapley values of the logit in eval mode,
+        weight * (x - baseline) per input feature. The default zero baselines
+        are the ones of ShapleyValueSampling.
+        """
+        with torch.no_grad():
+            return tuple(
+                (x - baseline) * weights
+                for x, baseline, weights in zip(
+                    (e, m, c), baselines, self.input_weights()
+                )
+            )
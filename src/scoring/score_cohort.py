@@ -0,0 +1,123 @@
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from utils.choose_gpu import create_device
+from utils.model_artifact import ScoringModel, load_model_artifact
+
+
+def read_samples(path):
+    return list(pd.read_csv(path, sep="\t", index_col=0, nrows=0).columns)
+
+
+def read_genes(path):
+    return set(pd.read_csv(path, sep="\t", usecols=[0]).iloc[:, 0].astype(str))
+
+
+def read_sample_chunk(path, column_positions, samples, feature_names, fill_values):
+    """
+    Reads the columns of samples from a genes x samples TSV and returns a
+    samples x features frame in the order of feature_names. Genes missing in
+    the cohort are set to fill_values.
+    """
+    frame = pd.read_csv(
+        path,
+        sep="\t",
+        index_col=0,
+        decimal=",",
+        usecols=[0, *(column_positions[sample] for sample in samples)],
+    ).transpose()
+    frame = frame.loc[:, ~frame.columns.duplicated()]
+    frame.columns = frame.columns.astype(str)
+    frame = frame.reindex(index=samples, columns=feature_names)
+    return frame.fillna(fill_values)
+
+
+def score_cohort(
+    artifact_file,
+    expression_file,
+    mutation_file,
+    cna_file,
+    output_file,
+    chunk_size,
+    device,
+):
+    """
+    Scores the samples found in all three omics files with a model artifact,
+    chunk_size samples at a time, and writes one probability per sample.
+    """
+    artifact = load_model_artifact(artifact_file)
+    model = ScoringModel(artifact).to(device)
+    expression_names = artifact["feature_names"][0]
+    # missing expression genes get the training mean, i.e. a scaled value of 0
+    expression_mean = pd.Series(
+        artifact["scaler"]["mean"][: len(expression_names)].numpy(),
+        index=expression_names,
+    )
+    omics_files = (expression_file, mutation_file, cna_file)
+    sample_columns = [read_samples(omics_file) for omics_file in omics_files]
+    shared_samples = set(sample_columns[1]) & set(sample_columns[2])
+    samples = [sample for sample in sample_columns[0] if sample in shared_samples]
+    column_positions = [
+        {sample: position + 1 for position, sample in enumerate(columns)}
+        for columns in sample_columns
+    ]
+    for omics_file, names in zip(omics_files, artifact["feature_names"]):
+        missing_genes = len(set(names) - read_genes(omics_file))
+        print(f"{omics_file}: {missing_genes} of {len(names)} model genes missing")
+    print(f"Scoring {len(samples)} samples in chunks of {chunk_size}")
+
+    with open(output_file, "w") as output:
+        output.write("sample\tprobability\n")
+        for start in range(0, len(samples), chunk_size):
+            chunk = samples[start : start + chunk_size]
+            expression, mutation, cna = (
+                read_sample_chunk(omics_file, positions, chunk, names, fill_values)
+                for omics_file, positions, names, fill_values in zip(
+                    omics_files,
+                    column_positions,
+                    artifact["feature_names"],
+                    (expression_mean, 0, 0),
+                )
+            )
+            # binarised as in the training data
+            mutation = (mutation != 0).astype(np.float32)
+            cna = (cna != 0).astype(np.float32)
+            with torch.inference_mode():
+                probabilities = model(
+                    *(
+                        torch.as_tensor(
+                            omics.to_numpy(dtype=np.float32), device=device
+                        )
+                        for omics in (expression, mutation, cna)
+                    )
+                )
+            for sample, probability in zip(chunk, probabilities.cpu().tolist()):
+                output.write(f"{sample}\t{probability}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--expression", required=True)
+    parser.add_argument("--mutation", required=True)
+    parser.add_argument("--cna", required=True)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--chunk_size", default=256, type=int)
+    parser.add_argument("--gpu_number", type=int)
+    args = parser.parse_args()
+    device, _ = create_device(args.gpu_number)
+    score_cohort(
+        args.model,
+        args.expression,
+        args.mutation,
+        args.cna,
+        args.output,
+        args.chunk_size,
+        device,
+    )
@@ -0,0 +1,29 @@
+import torch
+import torch.nn as nn
+
+
+class BatchAllTripletLoss(nn.Module):
+    """
+    Triplet margin loss over all (anchor, positive, negative) triplets of a batch, the triplets AllTripletSelector
+    returns. Computed from the pairwise distance matrix with a masked B x B x B tensor instead of gathering three
+    embedding copies per triplet, so the number of triplets never has to be read back to the host. Equals
+    TripletMarginLoss(margin, p=2, eps=eps) on the selected triplets, a batch without triplets has a loss of 0.
+    """
+
+    def __init__(self, margin, eps=1e-6):
+        super(BatchAllTripletLoss, self).__init__()
+        self.margin = margin
+        self.eps = eps
+
+    def forward(self, embeddings, target):
+        target = target.detach().view(-1).to(embeddings.device)
+        # ||a - b + eps|| like pairwise_distance, computed without the matmul expansion
+        distances = torch.cdist(embeddings + self.eps, embeddings, compute_mode="donot_use_mm_for_euclid_dist")
+
+        same_label = target.view(-1, 1) == target.view(1, -1)
+        anchor_positive = torch.triu(same_label, diagonal=1)
+        triplet_mask = anchor_positive.unsqueeze(2) & ~same_label.unsqueeze(1)
+
+        losses = distances.unsqueeze(2) - distances.unsqueeze(1) + self.margin
+        losses = losses.clamp(min=0) * triplet_mask
+        return losses.sum() / triplet_mask.sum().clamp(min=1)
@@ -91,28 +91,28 @@ class AllTripletSelector(TripletSelector):
     """
     Returns all possible triplets
     May be impractical in most cases
+    Triplets are built with broadcast label masks on the device of the embeddings. The number of triplets is only
+    known on the host after a device sync, training losses use the masks directly through BatchAllTripletLoss.
     """
 
     def __init__(self):
         super(AllTripletSelector, self).__init__()
 
     def get_triplets(self, embeddings, labels):
-        labels = labels.cpu().data.numpy()
-        triplets = []
-        for label in set(labels):
-            label_mask = (labels == label)
-            label_indices = np.where(label_mask)[0]
-            if len(label_indices) < 2:
-                continue
-            negative_indices = np.where(np.logical_not(label_mask))[0]
-            anchor_positives = list(combinations(label_indices, 2))  # All anchor-positive pairs
+        return all_triplets(labels.detach().view(-1).to(embeddings.device))
 
-            # Add all negatives for all positive pairs
-            temp_triplets = [[anchor_positive[0], anchor_positive[1], neg_ind] for anchor_positive in anchor_positives
-                             for neg_ind in negative_indices]
-            triplets += temp_triplets
 
-        return torch.LongTensor(np.array(triplets))
+def all_triplets(labels):
+    """
+    All (anchor, positive, negative) index triplets with anchor < positive, ordered by label, anchor, positive and
+    negative like the itertools based selection.
+    """
+    same_label = labels.view(-1, 1) == labels.view(1, -1)
+    anchor_positive = torch.triu(same_label, diagonal=1)
+    triplet_mask = anchor_positive.unsqueeze(2) & ~same_label.unsqueeze(1)
+    triplets = triplet_mask.nonzero()
+    _, label_order = torch.sort(labels[triplets[:, 0]], stable=True)
+    return triplets[label_order]
 
 
 def hardest_negative(loss_values):
@@ -179,16 +179,75 @@ class FunctionNegativeTripletSelector(TripletSelector):
         return torch.LongTensor(triplets)
 
 
-def HardestNegativeTripletSelector(margin, cpu=False): return FunctionNegativeTripletSelector(margin=margin,
-                                                                                 negative_selection_fn=hardest_negative,
-                                                                                 cpu=cpu)
+def hardest_negatives(loss_values, negative_mask):
+    loss_values = loss_values.masked_fill(~negative_mask, float("-inf"))
+    max_loss, hard_negatives = loss_values.max(dim=1)
+    return hard_negatives, max_loss > 0
+
+
+def random_hard_negatives(loss_values, negative_mask):
+    return random_masked_choice(negative_mask & (loss_values > 0))
+
+
+def semihard_negatives(loss_values, negative_mask, margin):
+    return random_masked_choice(negative_mask & (loss_values > 0) & (loss_values < margin))
 
 
-def RandomNegativeTripletSelector(margin, cpu=False): return FunctionNegativeTripletSelector(margin=margin,
-                                                                                negative_selection_fn=random_hard_negative,
+def random_masked_choice(mask):
+    random_scores = torch.rand(mask.shape, device=mask.device).masked_fill(~mask, -1)
+    return random_scores.argmax(dim=1), mask.any(dim=1)
+
+
+class BatchedNegativeTripletSelector(TripletSelector):
+    """
+    Batched FunctionNegativeTripletSelector. The triplet loss of every anchor-positive pair against every sample is
+    computed once as a [N_pairs x N] matrix and negatives are picked with masked tensor operations on the device,
+    so it can replace AllTripletSelector.
+    negative_selection_fn takes the loss matrix and the negative mask and returns the negative index and whether a
+    negative was found for every anchor-positive pair
+    """
+
+    def __init__(self, margin, negative_selection_fn, cpu=False):
+        super(BatchedNegativeTripletSelector, self).__init__()
+        self.cpu = cpu
+        self.margin = margin
+        self.negative_selection_fn = negative_selection_fn
+
+    def get_triplets(self, embeddings, labels):
+        if self.cpu:
+            embeddings = embeddings.cpu()
+        distance_matrix = pdist(embeddings.detach())
+        labels = labels.detach().view(-1).to(distance_matrix.device)
+
+        same_label = labels.view(-1, 1) == labels.view(1, -1)
+        anchor_positives = torch.triu(same_label, diagonal=1).nonzero()
+        _, label_order = torch.sort(labels[anchor_positives[:, 0]], stable=True)
+        anchor_positives = anchor_positives[label_order]
+        anchors, positives = anchor_positives[:, 0], anchor_positives[:, 1]
+
+        ap_distances = distance_matrix[anchors, positives]
+        loss_values = ap_distances.unsqueeze(1) - distance_matrix[anchors] + self.margin
+        negative_mask = ~same_label[anchors]
+        negatives, found = self.negative_selection_fn(loss_values, negative_mask)
+
+        triplets = torch.stack((anchors, positives, negatives), dim=1)[found]
+        if len(triplets) == 0 and len(anchor_positives) > 0 and negative_mask[-1].any():
+            # like FunctionNegativeTripletSelector, fall back to the last anchor-positive pair and its first negative
+            negatives = negative_mask[-1].nonzero()[:1, 0]
+            triplets = torch.cat((anchor_positives[-1], negatives)).view(1, -1)
+        return triplets
+
+
+def HardestNegativeTripletSelector(margin, cpu=False): return BatchedNegativeTripletSelector(margin=margin,
+                                                                                negative_selection_fn=hardest_negatives,
                                                                                 cpu=cpu)
 
 
-def SemihardNegativeTripletSelector(margin, cpu=False): return FunctionNegativeTripletSelector(margin=margin,
-                                                                                  negative_selection_fn=lambda x: semihard_negative(x, margin),
-                                                                                  cpu=cpu)
+def RandomNegativeTripletSelector(margin, cpu=False): return BatchedNegativeTripletSelector(margin=margin,
+                                                                               negative_selection_fn=random_hard_negatives,
+                                                                               cpu=cpu)
+
+
+def SemihardNegativeTripletSelector(margin, cpu=False): return BatchedNegativeTripletSelector(margin=margin,
+                                                                                 negative_selection_fn=lambda x, mask: semihard_negatives(x, mask, margin),
+                                                                                 cpu=cpu)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules import each other from the src folder, like the experiment scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent))
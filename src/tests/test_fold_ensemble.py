@@ -0,0 +1,117 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("sklearn")
+pytest.importorskip("scipy")
+
+from models.moli_model import Moli
+from utils.fold_ensemble import FoldEnsemble, MemberAdagrad
+
+input_sizes = [6, 5, 4]
+output_sizes = [4, 3, 2]
+
+
+def test_member_adagrad_matches_adagrad_per_member():
+    torch.manual_seed(0)
+    learning_rates = [0.1, 0.01, 0.5]
+    weight_decays = [0.0, 0.01, 0.1]
+    stacked = torch.randn(3, 4, 5, requires_grad=True)
+    members = [
+        stacked[member].detach().clone().requires_grad_() for member in range(3)
+    ]
+    optimiser = MemberAdagrad(
+        [stacked],
+        lr=torch.tensor(learning_rates),
+        weight_decay=torch.tensor(weight_decays),
+    )
+    member_optimisers = [
+        torch.optim.Adagrad([member], lr=lr, weight_decay=weight_decay)
+        for member, lr, weight_decay in zip(members, learning_rates, weight_decays)
+    ]
+    for _ in range(5):
+        gradients = torch.randn(3, 4, 5)
+        stacked.grad = gradients.clone()
+        optimiser.step()
+        for member, member_optimiser, gradient in zip(
+            members, member_optimisers, gradients
+        ):
+            member.grad = gradient.clone()
+            member_optimiser.step()
+    for member_number, member in enumerate(members):
+        torch.testing.assert_close(stacked[member_number].detach(), member.detach())
+
+
+def create_models(number_of_models):
+    torch.manual_seed(1)
+    return [
+        Moli(input_sizes, output_sizes, [0.0, 0.0, 0.0, 0.0])
+        for _ in range(number_of_models)
+    ]
+
+
+def create_batches(number_of_models, batch_size=8):
+    omics = [torch.randn(number_of_models, batch_size, size) for size in input_sizes]
+    target = torch.tensor([0.0, 1.0] * (batch_size // 2)).repeat(number_of_models, 1)
+    return omics, target
+
+
+def test_ensemble_forward_matches_its_members():
+    models = create_models(3)
+    reference_models = copy.deepcopy(models)
+    ensemble = FoldEnsemble(models)
+    ensemble.eval()
+    omics, _ = create_batches(3)
+    predictions, features = ensemble.forward_with_features(*omics)
+    for member, model in enumerate(reference_models):
+        model.eval()
+        expected_prediction, expected_features = model.forward_with_features(
+            *(omic[member] for omic in omics)
+        )
+        torch.testing.assert_close(predictions[member], expected_prediction)
+        torch.testing.assert_close(features[member], expected_features)
+
+
+def test_ensemble_training_matches_separate_training():
+    learning_rates = [0.1, 0.05]
+    models = create_models(2)
+    reference_models = copy.deepcopy(models)
+    ensemble = FoldEnsemble(models)
+    ensemble.train()
+    optimiser = MemberAdagrad(
+        ensemble.parameters_of(), lr=torch.tensor(learning_rates)
+    )
+    reference_optimisers = [
+        torch.optim.Adagrad(model.parameters(), lr=lr)
+        for model, lr in zip(reference_models, learning_rates)
+    ]
+    loss_fn = torch.nn.BCEWithLogitsLoss()
+    torch.manual_seed(2)
+    for _ in range(3):
+        omics, target = create_batches(2)
+        optimiser.zero_grad()
+        predictions, _ = ensemble.forward_with_features(*omics)
+        loss = sum(
+            loss_fn(torch.squeeze(predictions[member]), target[member])
+            for member in range(2)
+        )
+        loss.backward()
+        optimiser.step()
+
+        for member, (model, reference_optimiser) in enumerate(
+            zip(reference_models, reference_optimisers)
+        ):
+            model.train()
+            reference_optimiser.zero_grad()
+            prediction, _ = model.forward_with_features(
+                *(omic[member] for omic in omics)
+            )
+            loss_fn(torch.squeeze(prediction), target[member]).backward()
+            reference_optimiser.step()
+
+    for model, reference_model in zip(ensemble.unstack(), reference_models):
+        # the trained members also hold the dropout rates as buffers
+        state = model.state_dict()
+        for name, expected in reference_model.state_dict().items():
+            torch.testing.assert_close(state[name], expected, msg=name)
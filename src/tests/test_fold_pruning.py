@@ -0,0 +1,74 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.fold_pruning import FoldPruner
+
+cv_splits = 5
+
+
+def test_first_trial_is_never_pruned():
+    pruner = FoldPruner(optimistic_fold_score=1.0)
+    assert not pruner.should_stop([0.1], cv_splits)
+    assert pruner.report([0.5] * cv_splits, cv_splits) == pytest.approx(0.5)
+    assert pruner.incumbent_mean == pytest.approx(0.5)
+
+
+def test_optimistic_bound_prunes_only_hopeless_trials():
+    pruner = FoldPruner(optimistic_fold_score=1.0)
+    pruner.report([0.8] * cv_splits, cv_splits)
+    # 0.2 + 4 * 1.0 averages 0.84, still above the incumbent
+    assert not pruner.should_stop([0.2], cv_splits)
+    # 0.2 + 0.1 + 3 * 1.0 averages 0.66
+    assert pruner.should_stop([0.2, 0.1], cv_splits)
+    # a trial with all folds is never stopped
+    assert not pruner.should_stop([0.1] * cv_splits, cv_splits)
+
+
+def test_lower_fold_score_prunes_earlier():
+    pruner = FoldPruner(optimistic_fold_score=0.9)
+    pruner.report([0.8] * cv_splits, cv_splits)
+    # 0.3 + 4 * 0.9 averages 0.78
+    assert pruner.should_stop([0.3], cv_splits)
+
+
+def test_incumbent_folds_bound_unseen_folds():
+    pruner = FoldPruner(optimistic_fold_score=1.0, use_incumbent_folds=True)
+    pruner.report([0.9, 0.7, 0.7, 0.7, 0.7], cv_splits)
+    np.testing.assert_allclose(
+        pruner.remaining_fold_bounds([0.75], cv_splits), [0.75, 0.75, 0.75, 0.75]
+    )
+    # 0.75 + 4 * 0.75 averages 0.75, above the incumbent mean 0.74
+    assert not pruner.should_stop([0.75], cv_splits)
+    # 0.6 + 4 * 0.7 averages 0.68
+    assert pruner.should_stop([0.6], cv_splits)
+
+
+def test_pruned_trial_never_becomes_the_incumbent():
+    pruner = FoldPruner(optimistic_fold_score=0.95, use_incumbent_folds=True)
+    pruner.report([0.7] * cv_splits, cv_splits)
+    # a partial-fold mean above the incumbent is returned, but not kept
+    assert pruner.report([0.9, 0.8], cv_splits) == pytest.approx(0.85)
+    assert pruner.incumbent_mean == pytest.approx(0.7)
+    np.testing.assert_allclose(pruner.incumbent["fold_aurocs"], [0.7] * cv_splits)
+
+    pruner.report([0.75] * cv_splits, cv_splits)
+    assert pruner.incumbent_mean == pytest.approx(0.75)
+
+
+def test_summary_counts_pruned_trials():
+    pruner = FoldPruner()
+    pruner.report([0.7] * cv_splits, cv_splits)
+    pruner.report([0.2, 0.1], cv_splits)
+    assert pruner.summary() == (
+        "Fold pruning skipped 3 inner folds, 1 of 2 trials pruned"
+    )
+
+
+def test_resume_keeps_the_incumbent_mean():
+    pruner = FoldPruner()
+    pruner.resume(0.8)
+    assert pruner.incumbent_mean == 0.8
+    assert pruner.incumbent["fold_aurocs"] is None
+    pruner.reset()
+    assert pruner.incumbent_mean == 0.0
@@ -0,0 +1,132 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("sklearn")
+pytest.importorskip("captum")
+pytest.importorskip("Bio")
+
+from captum.attr import ShapleyValues
+from sklearn.decomposition import PCA
+
+from models.pca_model import Classifier, PcaModel
+from utils.interpretability import compute_omics_shapley_values
+
+input_sizes = [5, 4, 3]
+
+
+class InteractingModel(torch.nn.Module):
+    # a nonlinear model with interactions between the omics types
+    def __init__(self):
+        super(InteractingModel, self).__init__()
+        torch.manual_seed(0)
+        self.layers = torch.nn.Sequential(
+            torch.nn.Linear(sum(input_sizes), 8),
+            torch.nn.Tanh(),
+            torch.nn.Linear(8, 1),
+        )
+
+    def forward(self, expression, mutation, cna):
+        return self.layers(torch.cat((expression, mutation, cna), dim=1))
+
+
+class ConcatenatedModel(torch.nn.Module):
+    def __init__(self, model):
+        super(ConcatenatedModel, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(*torch.split(x, input_sizes, dim=1))
+
+
+def create_inputs(samples=6):
+    torch.manual_seed(1)
+    return tuple(torch.randn(samples, size) for size in input_sizes)
+
+
+def test_omics_shapley_values_are_efficient():
+    model = InteractingModel().eval()
+    X = create_inputs()
+    shapley_values = compute_omics_shapley_values(X, model)
+    with torch.no_grad():
+        output = model(*X).view(-1)
+        baseline_output = model(*(torch.zeros_like(x) for x in X)).view(-1)
+    np.testing.assert_allclose(
+        shapley_values.sum(axis=1),
+        (output - baseline_output).numpy(),
+        rtol=1e-5,
+        atol=1e-6,
+    )
+
+
+def test_omics_shapley_values_match_captum():
+    model = InteractingModel().eval()
+    X = create_inputs()
+    shapley_values = compute_omics_shapley_values(X, model)
+    # every omics type is one feature group of an exact permutation Shapley value
+    feature_mask = tuple(
+        torch.full((1, size), omics, dtype=torch.long)
+        for omics, size in enumerate(input_sizes)
+    )
+    attributions = ShapleyValues(model).attribute(X, feature_mask=feature_mask)
+    expected = np.stack(
+        [attribution[:, 0].detach().numpy() for attribution in attributions], axis=1
+    )
+    np.testing.assert_allclose(shapley_values, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_single_input_matches_split_inputs():
+    model = InteractingModel().eval()
+    X = create_inputs()
+    np.testing.assert_allclose(
+        compute_omics_shapley_values(
+            torch.cat(X, dim=1), ConcatenatedModel(model), input_sizes
+        ),
+        compute_omics_shapley_values(X, model),
+        rtol=1e-5,
+        atol=1e-6,
+    )
+
+
+def create_pca_model():
+    rng = np.random.default_rng(2)
+    pcas = [
+        PCA(n_components=2).fit(rng.standard_normal((20, size)))
+        for size in input_sizes
+    ]
+    torch.manual_seed(3)
+    return PcaModel(*pcas, Classifier(6, 0.5)).eval(), pcas
+
+
+def test_pca_model_projects_like_sklearn():
+    model, pcas = create_pca_model()
+    X = create_inputs()
+    for projection, pca, x in zip(model.project(*X), pcas, X):
+        np.testing.assert_allclose(
+            projection.numpy(), pca.transform(x.numpy()), rtol=1e-5, atol=1e-5
+        )
+
+
+def test_pca_linear_attributions_are_exact_shapley_values():
+    model, _ = create_pca_model()
+    X = create_inputs()
+    attributions = torch.cat(model.linear_attributions(*X), dim=1)
+    with torch.no_grad():
+        output = model(*X).view(-1)
+        baseline_output = model(*(torch.zeros_like(x) for x in X)).view(-1)
+    torch.testing.assert_close(
+        attributions.sum(dim=1), output - baseline_output, rtol=1e-5, atol=1e-5
+    )
+    # a linear model has no interactions, one feature at a time is exact
+    for feature in range(attributions.shape[1]):
+        single_feature = torch.zeros(1, attributions.shape[1])
+        single_feature[0, feature] = 1
+        masked = [
+            x * mask
+            for x, mask in zip(X, torch.split(single_feature, input_sizes, dim=1))
+        ]
+        with torch.no_grad():
+            contribution = model(*masked).view(-1) - baseline_output
+        torch.testing.assert_close(
+            attributions[:, feature], contribution, rtol=1e-5, atol=1e-5
+        )
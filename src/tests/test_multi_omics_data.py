@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("torch")
+pytest.importorskip("sklearn")
+
+from utils.multi_omics_data import (
+    compute_source_key,
+    get_source_files,
+    load_drug_data,
+    read_drug_data,
+    remove_stale_caches,
+)
+from utils.synthetic_data import generate_drug_data
+
+drug = "Cisplatin"
+dataset = "TCGA"
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    generate_drug_data(
+        tmp_path, drug, dataset, train_samples=40, extern_samples=10, genes=30
+    )
+    return tmp_path
+
+
+def cache_entries(data_path):
+    return sorted(path.name for path in (data_path / "cache").iterdir())
+
+
+def test_cached_data_equals_parsed_data(data_path):
+    parsed = read_drug_data(data_path, drug, dataset)
+    built = load_drug_data(data_path, drug, dataset, return_data_frames=True)
+    hit = load_drug_data(data_path, drug, dataset, return_data_frames=True)
+    assert len(cache_entries(data_path)) == 1
+    for expected, *cached in zip(parsed, built, hit):
+        for value in cached:
+            if isinstance(expected, pd.DataFrame):
+                # the cache keeps values and labels, not dtypes or axis names
+                pd.testing.assert_frame_equal(
+                    value,
+                    expected,
+                    check_dtype=False,
+                    check_index_type=False,
+                    check_column_type=False,
+                    check_names=False,
+                )
+            else:
+                np.testing.assert_array_equal(value, expected)
+
+
+def test_source_key_changes_with_a_source_file(data_path):
+    source_files = get_source_files(data_path, drug, dataset)
+    key = compute_source_key(source_files)
+    assert compute_source_key(source_files) == key
+
+    response_file = source_files["response_train"]
+    stat = os.stat(response_file)
+    os.utime(response_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert compute_source_key(source_files) != key
+
+
+def test_rebuild_replaces_the_stale_entry(data_path):
+    load_drug_data(data_path, drug, dataset)
+    old_entries = cache_entries(data_path)
+    response_file = get_source_files(data_path, drug, dataset)["response_train"]
+    stat = os.stat(response_file)
+    os.utime(response_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    load_drug_data(data_path, drug, dataset)
+    new_entries = cache_entries(data_path)
+    assert len(new_entries) == 1
+    assert new_entries != old_entries
+
+
+def test_stale_cache_removal_keeps_entries_being_written(tmp_path):
+    prefix = f"{drug}.{dataset}.preprocessed."
+    (tmp_path / f"{prefix}0123").mkdir()
+    (tmp_path / f"{prefix}4567.tmp-123").mkdir()
+    (tmp_path / f"{drug}.{dataset}.elbow.89ab").mkdir()
+
+    remove_stale_caches(tmp_path, prefix)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"{drug}.{dataset}.elbow.89ab",
+        f"{prefix}4567.tmp-123",
+    ]
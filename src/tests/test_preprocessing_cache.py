@@ -0,0 +1,87 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("sklearn")
+
+from sklearn.decomposition import PCA
+
+from utils.omics_view import OmicsView
+from utils.preprocessing_cache import (
+    clear_fold_cache,
+    fit_scaler,
+    number_of_components,
+    pca_projection,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_fold_cache():
+    clear_fold_cache()
+    yield
+    clear_fold_cache()
+
+
+def create_view(seed=0, samples=60, genes=25):
+    rng = np.random.default_rng(seed)
+    expression = rng.standard_normal((samples, genes)) * rng.uniform(0.5, 3, genes)
+    mutation = (rng.random((samples, genes)) < 0.2).astype(float)
+    cna = (rng.random((samples, genes)) < 0.3).astype(float)
+    response = np.arange(samples) % 2
+    return OmicsView((expression, mutation, cna), response)
+
+
+def test_number_of_components_matches_sklearn():
+    data = create_view().array(0)
+    pca = PCA().fit(data)
+    variances = [0.1, 0.5, 0.9, 0.95, 0.99]
+    # exact cumulative ratios are the edge case of the searchsorted rule
+    cumulative_ratios = np.cumsum(pca.explained_variance_ratio_)
+    variances += [float(ratio) for ratio in cumulative_ratios[:5]]
+    for variance in variances:
+        expected = PCA(n_components=variance).fit(data).n_components_
+        assert number_of_components(pca, variance) == expected
+
+
+@pytest.mark.parametrize("explained_variance", [0.5, 0.9, 0.95])
+def test_pca_projection_matches_a_truncated_fit(explained_variance):
+    view = create_view()
+    train_view = view.subset(np.arange(0, 45))
+    validate_view = view.subset(np.arange(45, 60))
+    scaler = fit_scaler(train_view)
+
+    pca, train_projection, validate_projection = pca_projection(
+        train_view, validate_view, 0, explained_variance, scaler
+    )
+    expected_pca = PCA(n_components=explained_variance).fit(
+        scaler.transform(train_view.array(0))
+    )
+    assert pca.n_components_ == expected_pca.n_components_
+    np.testing.assert_allclose(
+        train_projection,
+        expected_pca.transform(scaler.transform(train_view.array(0))),
+        atol=1e-4,
+    )
+    np.testing.assert_allclose(
+        validate_projection,
+        expected_pca.transform(scaler.transform(validate_view.array(0))),
+        atol=1e-4,
+    )
+    np.testing.assert_allclose(
+        pca.transform(scaler.transform(validate_view.array(0))),
+        validate_projection,
+        atol=1e-4,
+    )
+
+
+def test_fold_cache_separates_data_sets():
+    view = create_view(seed=0)
+    other_view = create_view(seed=1)
+    train_index = np.arange(0, 45)
+
+    scaler = fit_scaler(view.subset(train_index))
+    assert fit_scaler(view.subset(train_index)) is scaler
+    # same fold rows of another data set
+    other_scaler = fit_scaler(other_view.subset(train_index))
+    assert other_scaler is not scaler
+    assert not np.allclose(other_scaler.mean_, scaler.mean_)
@@ -0,0 +1,111 @@
+import json
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("ax")
+
+from ax.service.ax_client import AxClient
+
+from utils.experiment_utils import (
+    complete_trial,
+    full_budget_objectives,
+    get_best_parameters,
+)
+from utils.results_store import ResultsStore
+
+
+def run_study(results):
+    ax_client = AxClient(verbose_logging=False)
+    ax_client.create_experiment(
+        name="results_store",
+        parameters=[
+            {
+                "name": "epochs",
+                "type": "range",
+                "bounds": [2, 20],
+                "value_type": "int",
+            },
+            {"name": "lr", "type": "range", "bounds": [0.01, 0.1]},
+        ],
+        objective_name="auroc",
+        minimize=False,
+    )
+    for result in results:
+        _, trial_index = ax_client.get_next_trial()
+        complete_trial(ax_client, trial_index, result)
+    return ax_client.experiment
+
+
+def stored_rows(result_path):
+    with closing(sqlite3.connect(result_path / "results.sqlite")) as connection:
+        connection.row_factory = sqlite3.Row
+        return [
+            dict(row)
+            for row in connection.execute("SELECT * FROM trials ORDER BY trial_index")
+        ]
+
+
+results = [
+    {"auroc": (0.7, 0.01), "completed_folds": 5, "pruned": False, "epochs": 12},
+    {"auroc": (0.9, 0.02), "completed_folds": 2, "pruned": True, "epochs": 12},
+    {"auroc": (0.95, 0.03), "completed_folds": 5, "stopped_rung": 0, "epochs": 4},
+    {"auroc": (0.8, 0.01), "completed_folds": 5, "pruned": False, "epochs": 30},
+]
+
+
+def test_study_round_trip(tmp_path):
+    experiment = run_study(results)
+    store = ResultsStore(tmp_path, "moli", "Cisplatin", "test")
+    store.add_study(experiment, outer_fold=0)
+    store.flush()
+
+    rows = stored_rows(tmp_path)
+    assert [row["status"] for row in rows] == [
+        "completed",
+        "pruned",
+        "stopped",
+        "completed",
+    ]
+    for row, result, trial in zip(rows, results, experiment.trials.values()):
+        assert (row["model"], row["drug"], row["experiment"]) == (
+            "moli",
+            "Cisplatin",
+            "test",
+        )
+        assert row["outer_fold"] == 0
+        assert json.loads(row["parameters"]) == trial.arm.parameters
+        assert row["auroc"] == pytest.approx(result["auroc"][0])
+        assert row["sem"] == pytest.approx(result["auroc"][1])
+        assert row["epochs"] == result["epochs"]
+        assert row["completed_folds"] == result["completed_folds"]
+        assert row["pruned"] == int(result["completed_folds"] < 5)
+
+    # a resumed study only appends new trials
+    store.add_study(experiment, outer_fold=0)
+    store.flush()
+    assert len(stored_rows(tmp_path)) == len(results)
+
+
+def test_partial_objectives_are_no_final_objectives():
+    experiment = run_study(results)
+    assert sorted(full_budget_objectives(experiment)) == pytest.approx([0.7, 0.8])
+    assert get_best_parameters(experiment) == experiment.trials[3].arm.parameters
+
+
+def test_stores_without_status_gain_the_column(tmp_path):
+    database_file = tmp_path / "results.sqlite"
+    with closing(sqlite3.connect(database_file)) as connection, connection:
+        connection.execute(
+            "CREATE TABLE trials (model TEXT, drug TEXT, experiment TEXT, "
+            "outer_fold INTEGER, trial_index INTEGER, parameters TEXT, auroc REAL, "
+            "sem REAL, wall_time REAL, epochs INTEGER, completed_folds INTEGER, "
+            "pruned INTEGER, recorded_at TEXT)"
+        )
+    store = ResultsStore(tmp_path, "moli", "Cisplatin", "test")
+    store.add_study(run_study(results[:1]))
+    store.flush()
+    assert stored_rows(tmp_path)[0]["status"] == "completed"
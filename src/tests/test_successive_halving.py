@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("yaml")
+
+from utils.successive_halving import SuccessiveHalvingScheduler
+
+
+def test_promote_keeps_the_top_third_of_a_rung():
+    scheduler = SuccessiveHalvingScheduler(reduction_factor=3, number_of_rungs=3)
+    # the first result of a rung is always promoted
+    assert scheduler.promote(0, 0.6)
+    assert not scheduler.promote(0, 0.5)
+    assert not scheduler.promote(0, 0.55)
+    assert scheduler.promote(0, 0.7)
+    # 0.6 and 0.7 are better, 2 of 5 results is not below 5 / 3
+    assert not scheduler.promote(0, 0.58)
+    assert scheduler.promote(0, 0.65)
+    assert scheduler.promote(0, 0.8)
+    # rungs keep separate results
+    assert scheduler.promote(1, 0.1)
+
+
+def test_scale_epochs_respects_the_minimum():
+    scheduler = SuccessiveHalvingScheduler(min_epochs=2)
+    parameterization = {"epochs": 18, "e_epochs": 3, "lr": 0.1}
+    assert scheduler.scale_epochs(parameterization, 1 / 9) == {
+        "epochs": 2,
+        "e_epochs": 2,
+        "lr": 0.1,
+    }
+    assert scheduler.scale_epochs(parameterization, 1 / 3) == {
+        "epochs": 6,
+        "e_epochs": 2,
+        "lr": 0.1,
+    }
+    assert scheduler.scale_epochs(parameterization, 1) == parameterization
+
+
+def recording_evaluation(aurocs, calls):
+    def evaluation_function(parameterization, pruner=None):
+        calls.append((parameterization["epochs"], pruner is not None))
+        return {"auroc": (aurocs[parameterization["epochs"]], 0.0)}
+
+    return evaluation_function
+
+
+def test_promoted_trial_reports_the_epochs_of_all_rungs():
+    scheduler = SuccessiveHalvingScheduler(min_epochs=1)
+    calls = []
+    result = scheduler.evaluate(
+        recording_evaluation({2: 0.6, 6: 0.7, 18: 0.8}, calls), {"epochs": 18}
+    )
+    assert result["auroc"] == (0.8, 0.0)
+    assert result["epochs"] == 2 + 6 + 18
+    assert "stopped_rung" not in result
+    # reduced runs get a pruner of their own, the full run the study's pruner
+    assert calls == [(2, True), (6, True), (18, False)]
+
+
+def test_unpromoted_trial_is_stopped_on_its_rung():
+    scheduler = SuccessiveHalvingScheduler(min_epochs=1)
+    scheduler.promote(0, 0.9)
+    calls = []
+    result = scheduler.evaluate(
+        recording_evaluation({2: 0.5, 6: 0.7, 18: 0.8}, calls), {"epochs": 18}
+    )
+    assert result["stopped_rung"] == 0
+    assert result["epochs"] == 2
+    assert calls == [(2, True)]
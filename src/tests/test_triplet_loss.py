@@ -0,0 +1,70 @@
+from itertools import combinations
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from siamese_triplet.losses import BatchAllTripletLoss
+from siamese_triplet.utils import AllTripletSelector
+
+
+def itertools_triplets(labels):
+    # the selection of the original AllTripletSelector
+    labels = labels.numpy()
+    triplets = []
+    for label in sorted(set(labels)):
+        label_mask = labels == label
+        label_indices = np.where(label_mask)[0]
+        if len(label_indices) < 2:
+            continue
+        negative_indices = np.where(np.logical_not(label_mask))[0]
+        anchor_positives = list(combinations(label_indices, 2))
+        triplets += [
+            [anchor, positive, negative]
+            for anchor, positive in anchor_positives
+            for negative in negative_indices
+        ]
+    return torch.LongTensor(np.array(triplets).reshape(-1, 3))
+
+
+labels_cases = [
+    torch.tensor([0.0, 1.0, 1.0, 0.0, 1.0, 0.0, 0.0, 1.0]),
+    torch.tensor([1.0, 0.0, 0.0, 0.0, 0.0]),
+    torch.tensor([0.0, 1.0]),
+]
+
+
+@pytest.mark.parametrize("labels", labels_cases)
+def test_all_triplets_match_the_itertools_selection(labels):
+    triplets = AllTripletSelector().get_triplets(torch.randn(len(labels), 3), labels)
+    torch.testing.assert_close(triplets, itertools_triplets(labels))
+
+
+@pytest.mark.parametrize("labels", labels_cases[:2])
+def test_batch_all_loss_matches_triplet_margin_loss(labels):
+    torch.manual_seed(0)
+    embeddings = torch.randn(len(labels), 4, dtype=torch.float64, requires_grad=True)
+    reference_embeddings = embeddings.detach().clone().requires_grad_()
+    margin = 0.5
+
+    loss = BatchAllTripletLoss(margin)(embeddings, labels)
+    triplets = itertools_triplets(labels)
+    reference_loss = torch.nn.TripletMarginLoss(margin=margin, p=2)(
+        reference_embeddings[triplets[:, 0]],
+        reference_embeddings[triplets[:, 1]],
+        reference_embeddings[triplets[:, 2]],
+    )
+    torch.testing.assert_close(loss, reference_loss)
+
+    loss.backward()
+    reference_loss.backward()
+    torch.testing.assert_close(embeddings.grad, reference_embeddings.grad)
+
+
+def test_batch_all_loss_without_triplets_is_zero():
+    embeddings = torch.randn(2, 4, requires_grad=True)
+    loss = BatchAllTripletLoss(0.5)(embeddings, labels_cases[2])
+    assert loss.item() == 0.0
+    loss.backward()
+    assert torch.count_nonzero(embeddings.grad) == 0
@@ -1,13 +1,33 @@
+import os
+import pickle
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+
+import numpy as np
+import torch
+import torch.multiprocessing
 from ax import Models
+from ax.core.base_trial import TrialStatus
+from ax.exceptions.generation_strategy import MaxParallelismReachedException
 from ax.modelbridge.generation_strategy import GenerationStrategy, GenerationStep
+from ax.service.ax_client import AxClient
+from ax.service.utils.best_point import (
+    get_best_parameters_from_model_predictions,
+    get_best_raw_objective_point,
+)
 
 from utils.network_training_util import calculate_mean_and_std_auc
+from utils.phase_timer import phase_timer
+from utils.successive_halving import create_scheduler
 
 
-def create_generation_strategy():
+def create_generation_strategy(random_seed=None, max_parallelism=5):
+    # seeded Sobol, the trials of a study no longer vary between runs
     generation_strategy = GenerationStrategy(
         steps=[
-            GenerationStep(model=Models.SOBOL, num_trials=-1, max_parallelism=5,
+            GenerationStep(model=Models.SOBOL, num_trials=-1, max_parallelism=max_parallelism,
+            model_kwargs={"seed": random_seed},
             model_gen_kwargs = {"optimizer_kwargs": {"joint_optimize": True}}),
         ],
         name="Sobol",
@@ -15,6 +35,327 @@ def create_generation_strategy():
     return generation_strategy
 
 
+def run_optimisation(
+    evaluation_function,
+    search_space,
+    experiment_name,
+    search_iterations,
+    random_seed,
+    parallel_trials=1,
+    pruner=None,
+    scheduler="none",
+    trial_batch_size=1,
+    group_evaluation_function=None,
+    architecture_parameters=(),
+    checkpoint_file=None,
+    resume=False,
+):
+    """
+    With a checkpoint_file, the Ax client is saved after every completed
+    trial. resume continues from an existing checkpoint and only runs the
+    trials missing to search_iterations.
+    """
+    if resume and checkpoint_file is not None and Path(checkpoint_file).exists():
+        ax_client = load_checkpoint(checkpoint_file, pruner)
+    else:
+        ax_client = AxClient(
+            generation_strategy=create_generation_strategy(
+                random_seed, max(5, trial_batch_size)
+            ),
+            verbose_logging=False,
+        )
+        ax_client.create_experiment(
+            name=experiment_name,
+            parameters=search_space,
+            objective_name="auroc",
+            minimize=False,
+        )
+    phase_timer.reset()
+    scheduler = create_scheduler(scheduler)
+    if scheduler is not None:
+        evaluation_function = partial(scheduler.evaluate, evaluation_function)
+    # trials that were running at the crash are evaluated again first
+    for trial_index, parameterization in interrupted_trials(ax_client):
+        seed_trial(random_seed, trial_index)
+        complete_trial(
+            ax_client,
+            trial_index,
+            timed_evaluation(evaluation_function, parameterization, trial_index),
+            checkpoint_file,
+        )
+    search_iterations = max(0, search_iterations - len(ax_client.experiment.trials))
+    if trial_batch_size > 1 and group_evaluation_function is not None:
+        # trials of a group run as one batched model, without scheduler and
+        # trial worker processes
+        run_batched_trials(
+            ax_client,
+            group_evaluation_function,
+            architecture_parameters,
+            search_iterations,
+            random_seed,
+            trial_batch_size,
+            checkpoint_file,
+        )
+    elif parallel_trials > 1:
+        with torch.multiprocessing.get_context("spawn").Manager() as manager:
+            # pruner and scheduler are part of the evaluation function and are
+            # pickled to the workers as manager proxies
+            if pruner is not None:
+                pruner.share(manager)
+            if scheduler is not None:
+                scheduler.share(manager)
+            try:
+                run_parallel_trials(
+                    ax_client,
+                    evaluation_function,
+                    search_iterations,
+                    random_seed,
+                    parallel_trials,
+                    checkpoint_file,
+                )
+            finally:
+                if pruner is not None:
+                    pruner.unshare()
+    else:
+        for _ in range(search_iterations):
+            parameterization, trial_index = ax_client.get_next_trial()
+            seed_trial(random_seed, trial_index)
+            complete_trial(
+                ax_client,
+                trial_index,
+                timed_evaluation(evaluation_function, parameterization, trial_index),
+                checkpoint_file,
+            )
+    if pruner is not None:
+        print(pruner.summary())
+    print(phase_timer.summary())
+    phase_timer.write_trace()
+    experiment = ax_client.experiment
+    return get_best_parameters(experiment), experiment
+
+
+def get_best_parameters(experiment):
+    # same selection as ax.optimize: model predictions first, then raw objective
+    if any(
+        trial.status == TrialStatus.EARLY_STOPPED
+        for trial in experiment.trials.values()
+    ):
+        # objectives of early stopped trials are reduced-epoch or partial-fold
+        # results, the best point is chosen among full-budget trials only
+        return max(
+            completed_trials(experiment), key=lambda trial: trial.objective_mean
+        ).arm.parameters
+    model_predictions = get_best_parameters_from_model_predictions(
+        experiment=experiment, models_enum=Models
+    )
+    if model_predictions is not None:
+        return model_predictions[0]
+    best_parameters, _ = get_best_raw_objective_point(experiment=experiment)
+    return best_parameters
+
+
+def completed_trials(experiment):
+    return [trial for trial in experiment.trials.values() if trial.status.is_completed]
+
+
+def full_budget_objectives(experiment):
+    # objectives of completed trials, without trials stopped early on a rung
+    # or pruned
+    return np.array([trial.objective_mean for trial in completed_trials(experiment)])
+
+
+def interrupted_trials(ax_client):
+    return [
+        (trial.index, trial.arm.parameters)
+        for trial in ax_client.experiment.trials.values()
+        if trial.status.is_running
+    ]
+
+
+def timed_evaluation(evaluation_function, parameterization, trial_index):
+    # the phase times of a trial end up in its run metadata
+    with phase_timer.trial(trial_index):
+        result = evaluation_function(parameterization)
+    return dict(result, phase_times=phase_timer.phase_times(trial_index))
+
+
+def complete_trial(ax_client, trial_index, result, checkpoint_file=None):
+    # entries besides the objective, e.g. completed_folds, are run metadata
+    run_metadata = {name: value for name, value in result.items() if name != "auroc"}
+    if run_metadata:
+        ax_client.experiment.trials[trial_index].update_run_metadata(run_metadata)
+    if "stopped_rung" in result or result.get("pruned", False):
+        # a reduced-epoch or partial-fold objective is kept as data, but is no
+        # final objective
+        ax_client.update_trial_data(trial_index, raw_data={"auroc": result["auroc"]})
+        ax_client.stop_trial_early(trial_index)
+    else:
+        ax_client.complete_trial(trial_index, raw_data={"auroc": result["auroc"]})
+    if checkpoint_file is not None:
+        save_checkpoint(ax_client, checkpoint_file)
+
+
+def save_checkpoint(ax_client, checkpoint_file):
+    # written next to the checkpoint and renamed, a crash never leaves a
+    # partially written checkpoint behind
+    temporary_file = Path(f"{checkpoint_file}.tmp")
+    ax_client.save_to_json_file(str(temporary_file))
+    os.replace(temporary_file, checkpoint_file)
+
+
+def load_checkpoint(checkpoint_file, pruner=None):
+    ax_client = AxClient.load_from_json_file(str(checkpoint_file), verbose_logging=False)
+    if pruner is not None:
+        pruner.resume(max(full_budget_objectives(ax_client.experiment), default=0.0))
+    return ax_client
+
+
+def seed_trial(random_seed, trial_index):
+    torch.manual_seed(random_seed + trial_index)
+    np.random.seed(random_seed + trial_index)
+
+
+def run_parallel_trials(
+    ax_client,
+    evaluation_function,
+    search_iterations,
+    random_seed,
+    parallel_trials,
+    checkpoint_file=None,
+):
+    """
+    Runs up to parallel_trials trials at once in spawn worker processes.
+
+    Results can differ from the sequential run with the same seed. A trial
+    only sees the fold pruner incumbent and successive halving rung scores of
+    the trials finished before its folds, which depends on completion order.
+    Ax also generates the next Sobol points before earlier trials have
+    completed. Without pruning and scheduler, the objective of a trial
+    depends only on its parameters and trial-index seed.
+    """
+    # worker processes receive the evaluation function once; tensors inside it
+    # are moved to shared memory when pickled instead of being copied per worker
+    context = torch.multiprocessing.get_context("spawn")
+    threads_per_trial = max(1, (os.cpu_count() or 1) // parallel_trials)
+    submitted_trials = 0
+    running_trials = {}
+    with ProcessPoolExecutor(
+        max_workers=parallel_trials,
+        mp_context=context,
+        initializer=initialise_trial_worker,
+        initargs=(evaluation_function, threads_per_trial),
+    ) as executor:
+        while submitted_trials < search_iterations or running_trials:
+            while (
+                submitted_trials < search_iterations
+                and len(running_trials) < parallel_trials
+            ):
+                try:
+                    parameterization, trial_index = ax_client.get_next_trial()
+                except MaxParallelismReachedException:
+                    break
+                future = executor.submit(
+                    evaluate_trial,
+                    parameterization,
+                    trial_index,
+                    random_seed,
+                )
+                running_trials[future] = trial_index
+                submitted_trials += 1
+            finished_trials, _ = wait(running_trials, return_when=FIRST_COMPLETED)
+            for future in finished_trials:
+                trial_index = running_trials.pop(future)
+                result = future.result()
+                phase_timer.merge(trial_index, result["phase_times"])
+                complete_trial(ax_client, trial_index, result, checkpoint_file)
+
+
+def run_batched_trials(
+    ax_client,
+    group_evaluation_function,
+    architecture_parameters,
+    search_iterations,
+    random_seed,
+    trial_batch_size,
+    checkpoint_file=None,
+):
+    completed_trials = 0
+    while completed_trials < search_iterations:
+        trials, _ = ax_client.get_next_trials(
+            max_trials=min(trial_batch_size, search_iterations - completed_trials)
+        )
+        for group in group_trials(trials, architecture_parameters):
+            trial_indices = list(group)
+            seed_trial(random_seed, trial_indices[0])
+            # the phases of a group are recorded for its first trial
+            with phase_timer.trial(trial_indices[0]):
+                results = group_evaluation_function(list(group.values()))
+            phase_times = phase_timer.phase_times(trial_indices[0])
+            for trial_index, result in zip(trial_indices, results):
+                complete_trial(
+                    ax_client,
+                    trial_index,
+                    dict(result, phase_times=phase_times),
+                    checkpoint_file,
+                )
+        completed_trials += len(trials)
+
+
+def group_trials(trials, architecture_parameters):
+    # trials with equal layer shapes and batch schedule train as one model
+    groups = {}
+    for trial_index, parameterization in trials.items():
+        signature = tuple(parameterization[name] for name in architecture_parameters)
+        groups.setdefault(signature, {})[trial_index] = parameterization
+    return list(groups.values())
+
+
+trial_worker = {}
+
+
+def initialise_trial_worker(evaluation_function, threads_per_trial):
+    torch.set_num_threads(threads_per_trial)
+    trial_worker["evaluation_function"] = evaluation_function
+
+
+def evaluate_trial(parameterization, trial_index, random_seed):
+    seed_trial(random_seed, trial_index)
+    return timed_evaluation(
+        trial_worker["evaluation_function"], parameterization, trial_index
+    )
+
+
+def ax_checkpoint_file(result_path, iteration=None):
+    if iteration is None:
+        return Path(result_path, "ax_client.json")
+    return Path(result_path, f"ax_client_{iteration}.json")
+
+
+def save_outer_fold_result(result_path, iteration, search_iterations, result):
+    outer_fold_file = Path(result_path, f"outer_fold_{iteration}.pkl")
+    temporary_file = Path(f"{outer_fold_file}.tmp")
+    with open(temporary_file, "wb") as result_file:
+        pickle.dump(
+            {"search_iterations": search_iterations, "result": result}, result_file
+        )
+    os.replace(temporary_file, outer_fold_file)
+
+
+def load_outer_fold_result(result_path, iteration, search_iterations):
+    """
+    Result tuple of a finished outer fold, None if the fold has to be
+    optimised (again) because it is missing or ran fewer search_iterations.
+    """
+    outer_fold_file = Path(result_path, f"outer_fold_{iteration}.pkl")
+    if not outer_fold_file.exists():
+        return None
+    with open(outer_fold_file, "rb") as result_file:
+        outer_fold_result = pickle.load(result_file)
+    if outer_fold_result["search_iterations"] < search_iterations:
+        return None
+    return outer_fold_result["result"]
+
+
 def write_results_to_file(
     drug_name,
     extern_auc_list,
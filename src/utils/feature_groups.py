@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+
+omics_names = ("Expression", "Mutation", "CNA")
+
+
+def read_gene_sets(gene_set_file):
+    """
+    Reads a GMT file, one gene set per line: name, description and the
+    genes, separated by tabs. Returns the gene sets in file order.
+    """
+    gene_sets = {}
+    with open(gene_set_file) as gmt_file:
+        for line in gmt_file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) > 2:
+                gene_sets[fields[0]] = [gene for gene in fields[2:] if gene]
+    return gene_sets
+
+
+class FeatureGroups:
+    """
+    Assignment of the concatenated expression, mutation and CNA features to
+    groups, the players of a group-level Shapley value. Groups never span two
+    omics types and are numbered in omics order, expression groups first.
+    """
+
+    def __init__(self, groups, names, input_sizes):
+        self.groups = np.asarray(groups)
+        self.names = np.asarray(names)
+        self.input_sizes = list(input_sizes)
+        self.sizes = np.bincount(self.groups, minlength=len(self.names))
+        boundaries = np.cumsum([0] + self.input_sizes)
+        self.groups_per_omics = [
+            len(np.unique(self.groups[start:end]))
+            for start, end in zip(boundaries[:-1], boundaries[1:])
+        ]
+
+    @classmethod
+    def by_omics(cls, input_sizes):
+        groups = np.repeat(np.arange(len(input_sizes)), input_sizes)
+        return cls(groups, omics_names[: len(input_sizes)], input_sizes)
+
+    @classmethod
+    def by_gene_set(cls, genes_per_omics, gene_sets):
+        # a gene of several gene sets joins the first one, the remaining
+        # genes of an omics type form one group
+        gene_set_of_gene = {}
+        for gene_set, genes in gene_sets.items():
+            for gene in genes:
+                gene_set_of_gene.setdefault(gene, gene_set)
+        groups = []
+        names = []
+        for omics, genes in zip(omics_names, genes_per_omics):
+            group_names = [
+                gene_set_of_gene.get(str(gene), "other genes") for gene in genes
+            ]
+            omics_groups = {}
+            for group_name in group_names:
+                omics_groups.setdefault(group_name, len(names) + len(omics_groups))
+            names.extend(f"{omics} {group_name}" for group_name in omics_groups)
+            groups.extend(omics_groups[group_name] for group_name in group_names)
+        return cls(groups, names, [len(genes) for genes in genes_per_omics])
+
+    def feature_mask(self, number_of_inputs):
+        # captum feature_mask of inputs that are split by omics type, or of
+        # one concatenated input
+        mask = torch.as_tensor(self.groups, dtype=torch.long).unsqueeze(0)
+        if number_of_inputs == 1:
+            return (mask,)
+        return torch.split(mask, self.input_sizes, dim=1)
+
+    def collapse(self, attributions):
+        # masked attributions repeat the value of a group on all its features
+        _, first_features = np.unique(self.groups, return_index=True)
+        return attributions[:, first_features]
+
+    def aggregate(self, attributions):
+        # sum of per-feature attributions, exact for additive attributions
+        indicator = np.zeros(
+            (len(self.groups), len(self.names)), dtype=attributions.dtype
+        )
+        indicator[np.arange(len(self.groups)), self.groups] = 1
+        return attributions @ indicator
+
+
+def create_feature_groups(group_by, gene_set_file, genes_per_omics):
+    """
+    Feature groups of the --feature_groups option, None for single genes.
+    """
+    if group_by == "gene":
+        return None
+    if group_by == "omics":
+        return FeatureGroups.by_omics([len(genes) for genes in genes_per_omics])
+    if group_by == "gene_set":
+        if gene_set_file is None:
+            raise ValueError("Grouping by gene set needs a --gene_set_file")
+        return FeatureGroups.by_gene_set(
+            genes_per_omics, read_gene_sets(gene_set_file)
+        )
+    raise ValueError(f"Unknown feature grouping {group_by}")
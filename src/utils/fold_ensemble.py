@@ -0,0 +1,267 @@
+import copy
+
+import numpy as np
+import torch
+from scipy.stats import sem
+from sklearn.model_selection import StratifiedKFold
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+
+from utils.network_training_util import (
+    create_sampler,
+    create_view_data_loader,
+    get_loss_fn,
+)
+from utils.phase_timer import phase
+from utils.preprocessing_cache import fit_scaler
+
+
+class ForwardWithFeatures(nn.Module):
+    def __init__(self, model):
+        super(ForwardWithFeatures, self).__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        return self.model.forward_with_features(*inputs)
+
+
+class TensorDropout(nn.Module):
+    """
+    Dropout whose rate is a buffer, so that stacked members can drop out with
+    different rates.
+    """
+
+    def __init__(self, p):
+        super(TensorDropout, self).__init__()
+        self.register_buffer("p", torch.tensor(float(p)))
+
+    def forward(self, x):
+        if not self.training:
+            return x
+        keep = (torch.rand_like(x) >= self.p).to(x.dtype)
+        return x * keep / (1 - self.p)
+
+
+def use_tensor_dropout(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Dropout):
+            setattr(module, name, TensorDropout(child.p))
+        else:
+            use_tensor_dropout(child)
+    return module
+
+
+class FoldEnsemble:
+    """
+    Identically shaped models, one per trial, inner fold and seed, whose
+    parameters are stacked along a leading member dimension.
+    forward_with_features runs all members in one vmapped call, so the members
+    train in lock-step.
+    """
+
+    def __init__(self, models):
+        self.members = [
+            ForwardWithFeatures(use_tensor_dropout(model)) for model in models
+        ]
+        self.parameters, self.buffers = stack_module_state(self.members)
+        self.base_model = copy.deepcopy(self.members[0]).to("meta")
+
+    def __len__(self):
+        return len(self.members)
+
+    def parameters_of(self, module_name=None):
+        prefix = "model." if module_name is None else f"model.{module_name}."
+        return [
+            parameter
+            for name, parameter in self.parameters.items()
+            if name.startswith(prefix)
+        ]
+
+    def train(self):
+        self.base_model.train()
+
+    def eval(self):
+        self.base_model.eval()
+
+    def forward_with_features(self, *inputs):
+        def member_forward(parameters, buffers, *member_inputs):
+            return functional_call(
+                self.base_model, (parameters, buffers), member_inputs
+            )
+
+        return vmap(member_forward, randomness="different")(
+            self.parameters, self.buffers, *inputs
+        )
+
+    def unstack(self):
+        # writes the trained members back into the original models
+        for member_number, member in enumerate(self.members):
+            state = {
+                name: tensor[member_number].detach()
+                for name, tensor in {**self.parameters, **self.buffers}.items()
+            }
+            member.load_state_dict(state)
+        return [member.model for member in self.members]
+
+
+class MemberAdagrad(torch.optim.Optimizer):
+    """
+    Adagrad over stacked parameters. lr and weight_decay of a group are either
+    numbers or tensors with one value per member.
+    """
+
+    def __init__(self, params, lr=1e-2, weight_decay=0, eps=1e-10):
+        super(MemberAdagrad, self).__init__(
+            params, dict(lr=lr, weight_decay=weight_decay, eps=eps)
+        )
+
+    @staticmethod
+    def member_values(value, parameter):
+        value = torch.as_tensor(value, dtype=parameter.dtype, device=parameter.device)
+        return value.view(-1, *([1] * (parameter.dim() - 1)))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        for group in self.param_groups:
+            for parameter in group["params"]:
+                if parameter.grad is None:
+                    continue
+                state = self.state[parameter]
+                if not state:
+                    state["sum"] = torch.zeros_like(parameter)
+                lr = self.member_values(group["lr"], parameter)
+                weight_decay = self.member_values(group["weight_decay"], parameter)
+                grad = parameter.grad + weight_decay * parameter
+                state["sum"].addcmul_(grad, grad)
+                parameter.sub_(lr * grad / (state["sum"].sqrt() + group["eps"]))
+
+
+def member_hyperparameter(member_parameterizations, name):
+    return torch.tensor(
+        [parameterization[name] for parameterization in member_parameterizations]
+    )
+
+
+def train_fold_ensemble(ensemble, train_loaders, optimiser, loss_fns, device, gammas):
+    ensemble.train()
+    for batches in zip(*(train_loader.batches() for train_loader in train_loaders)):
+        data = [
+            torch.stack([batch[number].to(device) for batch in batches])
+            for number in range(len(batches[0]))
+        ]
+        *omics, target = data
+        # members with a single class batch skip the step, as in train
+        mixed_classes = (target.amin(dim=1) != target.amax(dim=1)).tolist()
+        if not any(mixed_classes):
+            continue
+        optimiser.zero_grad()
+        with phase("forward"):
+            predictions, features = ensemble.forward_with_features(*omics)
+            loss = 0
+            for member, mixed_class in enumerate(mixed_classes):
+                if not mixed_class:
+                    continue
+                if gammas[member] > 0:
+                    loss = loss + loss_fns[member](
+                        (predictions[member], features[member]), target[member]
+                    )
+                else:
+                    loss = loss + loss_fns[member](
+                        torch.squeeze(predictions[member]), target[member]
+                    )
+        with phase("backward"):
+            loss.backward()
+            optimiser.step()
+
+
+def train_validate_fold_ensemble(
+    data,
+    cv_splits,
+    seeds_per_fold,
+    parameterizations,
+    create_model,
+    create_optimiser,
+    test_fn,
+    device,
+    pin_memory,
+):
+    """
+    Trains the models of all parameterizations on all inner folds,
+    seeds_per_fold per fold, as one FoldEnsemble and returns the validation
+    AUROCs as a [parameterizations x folds x seeds] array. All
+    parameterizations must share the layer shapes, mini_batch and epochs.
+    """
+    mini_batch = parameterizations[0]["mini_batch"]
+    epochs = parameterizations[0]["epochs"]
+    skf = StratifiedKFold(n_splits=cv_splits)
+    folds = []
+    for train_index, validate_index in skf.split(np.zeros(len(data)), data.labels):
+        with phase("data slicing"):
+            train_data = data.subset(train_index)
+            validate_data = data.subset(validate_index)
+        folds.append((train_data, validate_data, fit_scaler(train_data)))
+
+    loss_fns = [
+        get_loss_fn(parameterization["margin"], parameterization["gamma"])
+        for parameterization in parameterizations
+    ]
+    members = [
+        (trial, fold_number)
+        for trial in range(len(parameterizations))
+        for fold_number in range(len(folds))
+        for _ in range(seeds_per_fold)
+    ]
+    member_parameterizations = [parameterizations[trial] for trial, _ in members]
+    # every fold is uploaded once and shared by all members training on it,
+    # each member draws its own epoch order
+    fold_loaders = [
+        create_view_data_loader(train_data, mini_batch, pin_memory, None, scaler).to(
+            device
+        )
+        for train_data, _, scaler in folds
+    ]
+    train_loaders = [
+        fold_loaders[fold_number].with_sampler(
+            create_sampler(folds[fold_number][0].labels)
+        )
+        for _, fold_number in members
+    ]
+    ensemble = FoldEnsemble(
+        [
+            create_model(parameterization).to(device)
+            for parameterization in member_parameterizations
+        ]
+    )
+    optimiser = create_optimiser(ensemble, member_parameterizations)
+    for _ in range(epochs):
+        train_fold_ensemble(
+            ensemble,
+            train_loaders,
+            optimiser,
+            [loss_fns[trial] for trial, _ in members],
+            device,
+            [parameterization["gamma"] for parameterization in member_parameterizations],
+        )
+
+    models = ensemble.unstack()
+    aucs_validate = []
+    for model, (_, fold_number) in zip(models, members):
+        _, validate_data, scaler = folds[fold_number]
+        aucs_validate.append(test_fn(model, scaler, validate_data))
+    return np.reshape(
+        aucs_validate, (len(parameterizations), len(folds), seeds_per_fold)
+    )
+
+
+def fold_ensemble_result(aucs_validate, cv_splits, pruner):
+    fold_aucs = aucs_validate.mean(axis=1)
+    mean = pruner.report(fold_aucs, cv_splits)
+    if aucs_validate.shape[1] > 1:
+        # seeds add variance of the initialisation to the fold variance
+        standard_error_of_mean = sem(aucs_validate, axis=None)
+    else:
+        standard_error_of_mean = sem(fold_aucs)
+    return {
+        "auroc": (mean, standard_error_of_mean),
+        "completed_folds": aucs_validate.shape[0],
+    }
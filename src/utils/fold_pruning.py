@@ -0,0 +1,124 @@
+from contextlib import nullcontext
+
+import numpy as np
+
+
+# settings of pruners created without arguments, set by --optimistic_fold_score
+# and --use_incumbent_folds
+pruning_defaults = {"optimistic_fold_score": 1.0, "use_incumbent_folds": False}
+
+
+def configure_pruning(optimistic_fold_score=1.0, use_incumbent_folds=False):
+    pruning_defaults.update(
+        {
+            "optimistic_fold_score": optimistic_fold_score,
+            "use_incumbent_folds": use_incumbent_folds,
+        }
+    )
+
+
+class FoldPruner:
+    """
+    Fold-level pruning of the inner cross-validation of a trial.
+
+    Holds the incumbent of a study, the trial with the best mean validation
+    AUROC over all inner folds, and stops a trial once the best mean it can
+    still reach is below the incumbent mean. Unseen folds are assumed to score
+    optimistic_fold_score. With use_incumbent_folds, an unseen fold is bounded
+    by the larger of the incumbent's AUROC on that fold and the best fold of
+    the trial so far, which prunes far more often than the constant bound.
+    This bound is a heuristic, not a guaranteed upper bound: a trial can score
+    higher on a fold than both, so it may prune a trial that would have beaten
+    the incumbent. Only optimistic_fold_score=1.0 without incumbent folds
+    never prunes such a trial.
+
+    Only trials that completed all folds can become the incumbent. The mean of
+    a pruned trial covers the folds it ran and is no objective.
+
+    The number of skipped folds is recorded for every trial. After share(), the
+    state lives in a multiprocessing manager and is consistent across threads
+    and trial worker processes.
+    """
+
+    def __init__(self, optimistic_fold_score=None, use_incumbent_folds=None):
+        if optimistic_fold_score is None:
+            optimistic_fold_score = pruning_defaults["optimistic_fold_score"]
+        if use_incumbent_folds is None:
+            use_incumbent_folds = pruning_defaults["use_incumbent_folds"]
+        self.optimistic_fold_score = optimistic_fold_score
+        self.use_incumbent_folds = use_incumbent_folds
+        self.incumbent = {"mean": 0.0, "fold_aurocs": None}
+        self.skipped_folds = []
+        self.lock = nullcontext()
+
+    def share(self, manager):
+        with self.lock:
+            incumbent = dict(self.incumbent)
+            skipped_folds = list(self.skipped_folds)
+        self.incumbent = manager.dict(incumbent)
+        self.skipped_folds = manager.list(skipped_folds)
+        self.lock = manager.Lock()
+
+    def unshare(self):
+        with self.lock:
+            incumbent = dict(self.incumbent)
+            skipped_folds = list(self.skipped_folds)
+        self.incumbent = incumbent
+        self.skipped_folds = skipped_folds
+        self.lock = nullcontext()
+
+    def reset(self):
+        with self.lock:
+            self.incumbent.update({"mean": 0.0, "fold_aurocs": None})
+            del self.skipped_folds[:]
+
+    def resume(self, mean):
+        # the fold AUROCs of a resumed study are unknown, only its mean is kept
+        with self.lock:
+            self.incumbent.update({"mean": mean, "fold_aurocs": None})
+
+    @property
+    def incumbent_mean(self):
+        return self.incumbent["mean"]
+
+    def remaining_fold_bounds(self, fold_aurocs, cv_splits):
+        open_folds = cv_splits - len(fold_aurocs)
+        bounds = np.full(open_folds, self.optimistic_fold_score)
+        incumbent_fold_aurocs = self.incumbent["fold_aurocs"]
+        if self.use_incumbent_folds and incumbent_fold_aurocs is not None:
+            trial_best_fold = max(fold_aurocs, default=0.0)
+            incumbent_bounds = np.maximum(
+                incumbent_fold_aurocs[len(fold_aurocs) :], trial_best_fold
+            )
+            bounds = np.minimum(bounds, incumbent_bounds)
+        return bounds
+
+    def should_stop(self, fold_aurocs, cv_splits):
+        if len(fold_aurocs) >= cv_splits:
+            return False
+        best_possible_mean = np.mean(
+            np.concatenate([fold_aurocs, self.remaining_fold_bounds(fold_aurocs, cv_splits)])
+        )
+        return best_possible_mean < self.incumbent_mean
+
+    def summary(self):
+        with self.lock:
+            skipped_folds = list(self.skipped_folds)
+        return (
+            f"Fold pruning skipped {sum(skipped_folds)} inner folds, "
+            f"{sum(folds > 0 for folds in skipped_folds)} of "
+            f"{len(skipped_folds)} trials pruned"
+        )
+
+    def report(self, fold_aurocs, cv_splits):
+        mean = float(np.mean(fold_aurocs))
+        with self.lock:
+            self.skipped_folds.append(cv_splits - len(fold_aurocs))
+            if len(fold_aurocs) >= cv_splits and mean > self.incumbent["mean"]:
+                self.incumbent.update(
+                    {
+                        "mean": mean,
+                        "fold_aurocs": [float(auroc) for auroc in fold_aurocs],
+                    }
+                )
+        return mean
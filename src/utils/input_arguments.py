@@ -1,7 +1,10 @@
 import argparse
 
+from utils.fold_pruning import configure_pruning
+from utils.phase_timer import phase_timer
 
-def get_cmd_arguments():
+
+def get_cmd_arguments(batched_training=False):
     parser = argparse.ArgumentParser()
     parser.add_argument('--search_iterations', default=200, type=int)
     parser.add_argument('--experiment_name', required=True)
@@ -12,4 +15,38 @@ def get_cmd_arguments():
     parser.add_argument('--convert_ids', action='store_true')
     parser.add_argument('--add_triplet_loss', action='store_true')
     parser.add_argument('--stacking_type', default='less_stacking', choices=['all', 'less_stacking', 'only_single'])
-    return parser.parse_args()
+    parser.add_argument('--rebuild_data_cache', action='store_true')
+    parser.add_argument('--parallel_trials', default=1, type=int,
+                        help='trials run concurrently; with fold pruning or successive halving, results depend on '
+                             'completion order and can differ from a sequential run')
+    parser.add_argument('--scheduler', default='none', choices=['none', 'successive_halving'])
+    parser.add_argument('--batched_folds', default=0, type=int,
+                        help='train all inner folds of a trial, this many seeds per fold, as one vmapped ensemble; '
+                             'moli, stacking and early integration only')
+    parser.add_argument('--trial_batch_size', default=1, type=int,
+                        help='trials Ax generates at once, trials sharing their layer shapes are trained as one '
+                             'ensemble; moli, stacking and early integration only')
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--export_model', action='store_true')
+    parser.add_argument('--attribution_workers', default=1, type=int)
+    parser.add_argument('--shard_size', default=16, type=int)
+    parser.add_argument('--attribute_test', action='store_true')
+    parser.add_argument('--feature_groups', default='gene', choices=['gene', 'omics', 'gene_set'])
+    parser.add_argument('--gene_set_file')
+    parser.add_argument('--attribution_method', default='shapley_sampling', choices=['shapley_sampling', 'omics_shapley', 'integrated_gradients',
+                                                                                     'gradient_shap', 'deeplift'],
+                        help='deeplift is not supported for moma')
+    parser.add_argument('--compare_with_shapley', action='store_true')
+    parser.add_argument('--optimistic_fold_score', default=1.0, type=float,
+                        help='AUROC assumed for inner folds a trial has not run yet; below 1.0 prunes more, but '
+                             'may prune trials that would have become the incumbent')
+    parser.add_argument('--use_incumbent_folds', action='store_true',
+                        help="bound unseen folds by the incumbent's fold AUROCs, a heuristic and no guaranteed bound")
+    parser.add_argument('--timing_trace')
+    parser.add_argument('--timing_synchronize', action='store_true')
+    args = parser.parse_args()
+    if not batched_training and (args.batched_folds > 0 or args.trial_batch_size > 1):
+        parser.error('--batched_folds and --trial_batch_size are not supported by this script')
+    phase_timer.configure(args.timing_trace, args.timing_synchronize)
+    configure_pruning(args.optimistic_fold_score, args.use_incumbent_folds)
+    return args
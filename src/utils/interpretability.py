@@ -1,25 +1,55 @@
+import hashlib
+import itertools
+import json
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from math import factorial
+from pathlib import Path
+
 import torch
+import torch.multiprocessing
 import numpy as np
 import os
 import pandas as pd
 from Bio import Entrez
+from captum.attr import (
+    DeepLift,
+    GradientShap,
+    IntegratedGradients,
+    ShapleyValueSampling,
+)
+from scipy.stats import spearmanr
 
 Entrez.email = os.environ.get("MAIL")
 
 
-def compute_importances_values_single_input(X, explainer):
+def compute_importances_values_single_input(X, explainer, feature_groups=None):
+    feature_mask = None
+    if feature_groups is not None:
+        feature_mask = feature_groups.feature_mask(1)[0].to(X.device)
     all_attributions = explainer.attribute(
         X,
+        feature_mask=feature_mask,
         perturbations_per_eval=10,
         n_samples=50,
         show_progress=True,
     )
-    return all_attributions.cpu().numpy()
+    result_attributions = all_attributions.cpu().numpy()
+    if feature_groups is not None:
+        result_attributions = feature_groups.collapse(result_attributions)
+    return result_attributions
 
 
-def compute_importances_values_multiple_inputs(X, explainer):
+def compute_importances_values_multiple_inputs(X, explainer, feature_groups=None):
+    feature_mask = None
+    if feature_groups is not None:
+        feature_mask = tuple(
+            mask.to(x.device)
+            for mask, x in zip(feature_groups.feature_mask(len(X)), X)
+        )
     all_attributions = explainer.attribute(
         X,
+        feature_mask=feature_mask,
         perturbations_per_eval=10,
         n_samples=50,
         show_progress=True,
@@ -30,10 +60,329 @@ def compute_importances_values_multiple_inputs(X, explainer):
     result_attributions = np.concatenate(
         [expression_attributions, mutation_attributions, cna_attributions], axis=1
     )
+    if feature_groups is not None:
+        result_attributions = feature_groups.collapse(result_attributions)
     return result_attributions
 
 
-def save_importance_results(importances, feature_names, path, dataset):
+attribution_worker = {}
+
+
+def initialise_attribution_worker(model, threads_per_worker, feature_groups=None):
+    torch.set_num_threads(threads_per_worker)
+    attribution_worker["model"] = model
+    attribution_worker["explainer"] = ShapleyValueSampling(model)
+    attribution_worker["feature_groups"] = feature_groups
+
+
+def attribute_shard(inputs, random_seed, n_samples, perturbations_per_eval):
+    torch.manual_seed(random_seed)
+    device = next(attribution_worker["model"].parameters()).device
+    feature_groups = attribution_worker["feature_groups"]
+    feature_mask = None
+    if feature_groups is not None:
+        feature_mask = tuple(
+            mask.to(device) for mask in feature_groups.feature_mask(len(inputs))
+        )
+    all_attributions = attribution_worker["explainer"].attribute(
+        tuple(x.to(device) for x in inputs),
+        feature_mask=feature_mask,
+        perturbations_per_eval=perturbations_per_eval,
+        n_samples=n_samples,
+    )
+    result_attributions = np.concatenate(
+        [attributions.cpu().numpy() for attributions in all_attributions], axis=1
+    )
+    if feature_groups is not None:
+        result_attributions = feature_groups.collapse(result_attributions)
+    return result_attributions
+
+
+def fingerprint(tensors):
+    fingerprint = hashlib.sha1()
+    for tensor in tensors:
+        fingerprint.update(tensor.detach().cpu().numpy().tobytes())
+    return fingerprint.hexdigest()
+
+
+def prepare_shard_path(shard_path, manifest):
+    # shards of a different configuration cannot be resumed
+    manifest_file = shard_path / "manifest.json"
+    if manifest_file.exists():
+        with open(manifest_file) as stored_manifest:
+            if json.load(stored_manifest) == manifest:
+                return
+        print(f"Shard configuration changed, removing shards in {shard_path}")
+        shutil.rmtree(shard_path)
+    shard_path.mkdir(parents=True, exist_ok=True)
+    with open(manifest_file, "w") as stored_manifest:
+        json.dump(manifest, stored_manifest)
+
+
+def save_shard(shard_file, attributions):
+    temporary_file = shard_file.with_name(f"{shard_file.stem}.tmp.npy")
+    np.save(temporary_file, attributions)
+    os.replace(temporary_file, shard_file)
+
+
+def compute_sharded_importances(
+    X,
+    model,
+    shard_path,
+    workers=1,
+    shard_size=16,
+    n_samples=50,
+    perturbations_per_eval=10,
+    random_seed=42,
+    feature_groups=None,
+):
+    """
+    Shapley value sampling attributions of the samples in X, a tensor or a
+    tuple of tensors, concatenated over the inputs. The samples are split
+    into shards of shard_size, and each shard is attributed in one of
+    workers processes with its own copy of model and a share of the CPU
+    threads. Finished shards are saved in shard_path, a restarted run only
+    attributes the missing shards, as long as the model weights, the samples
+    and the sampling settings are unchanged. With feature_groups, every
+    group is one player and the attributions have one column per group.
+    """
+    if isinstance(X, torch.Tensor):
+        X = (X,)
+    X = tuple(x.detach().cpu() for x in X)
+    samples = len(X[0])
+    shard_path = Path(shard_path)
+    prepare_shard_path(
+        shard_path,
+        {
+            "model": fingerprint(model.state_dict().values()),
+            "data": fingerprint(X),
+            "samples": samples,
+            "shard_size": shard_size,
+            "n_samples": n_samples,
+            "perturbations_per_eval": perturbations_per_eval,
+            "random_seed": random_seed,
+            "feature_groups": None
+            if feature_groups is None
+            else fingerprint(feature_groups.feature_mask(1)),
+        },
+    )
+    shard_files = [
+        shard_path / f"shard_{shard:05d}.npy"
+        for shard in range((samples + shard_size - 1) // shard_size)
+    ]
+    open_shards = [
+        shard for shard, shard_file in enumerate(shard_files) if not shard_file.exists()
+    ]
+    print(f"{len(shard_files) - len(open_shards)} of {len(shard_files)} shards done")
+
+    def shard_arguments(shard):
+        start = shard * shard_size
+        inputs = tuple(x[start : start + shard_size] for x in X)
+        return inputs, random_seed + shard, n_samples, perturbations_per_eval
+
+    if workers > 1:
+        context = torch.multiprocessing.get_context("spawn")
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=initialise_attribution_worker,
+            initargs=(model, threads_per_worker, feature_groups),
+        ) as executor:
+            running_shards = {
+                executor.submit(attribute_shard, *shard_arguments(shard)): shard
+                for shard in open_shards
+            }
+            while running_shards:
+                finished_shards, _ = wait(running_shards, return_when=FIRST_COMPLETED)
+                for future in finished_shards:
+                    shard = running_shards.pop(future)
+                    save_shard(shard_files[shard], future.result())
+    else:
+        initialise_attribution_worker(
+            model, torch.get_num_threads(), feature_groups
+        )
+        for shard in open_shards:
+            save_shard(shard_files[shard], attribute_shard(*shard_arguments(shard)))
+    return np.concatenate([np.load(shard_file) for shard_file in shard_files], axis=0)
+
+
+gradient_methods = {
+    "integrated_gradients": IntegratedGradients,
+    "gradient_shap": GradientShap,
+    "deeplift": DeepLift,
+}
+
+
+def compute_gradient_importances(
+    X, model, attribution_method, batch_size=64, n_steps=50, n_samples=20
+):
+    """
+    Attributions of the samples in X, a tensor or a tuple of tensors, with
+    a gradient method of gradient_methods and zero baselines like the
+    sampled Shapley values. Samples are attributed in batches of batch_size,
+    integrated gradients also evaluates its n_steps interpolations in batches
+    of batch_size. Returns the attributions concatenated over the inputs and
+    the absolute convergence deltas.
+    """
+    if attribution_method == "deeplift" and not getattr(
+        model, "deeplift_supported", True
+    ):
+        raise ValueError(
+            f"DeepLift does not support {type(model).__name__}, choose "
+            "integrated_gradients or gradient_shap"
+        )
+    if isinstance(X, torch.Tensor):
+        X = (X,)
+    explainer = gradient_methods[attribution_method](model)
+    all_attributions = []
+    all_deltas = []
+    for start in range(0, len(X[0]), batch_size):
+        inputs = tuple(x[start : start + batch_size].detach() for x in X)
+        baselines = tuple(torch.zeros_like(x[:1]) for x in inputs)
+        if attribution_method == "integrated_gradients":
+            arguments = {"n_steps": n_steps, "internal_batch_size": batch_size}
+        elif attribution_method == "gradient_shap":
+            arguments = {"n_samples": n_samples}
+        else:
+            arguments = {}
+            baselines = tuple(torch.zeros_like(x) for x in inputs)
+        attributions, deltas = explainer.attribute(
+            inputs, baselines=baselines, return_convergence_delta=True, **arguments
+        )
+        all_attributions.append(
+            np.concatenate(
+                [attribution.detach().cpu().numpy() for attribution in attributions],
+                axis=1,
+            )
+        )
+        all_deltas.append(deltas.detach().abs().cpu().numpy().reshape(-1))
+    return np.concatenate(all_attributions, axis=0), np.concatenate(all_deltas)
+
+
+def compare_attributions(reference, attributions, top_features=100):
+    # rank agreement of mean absolute attributions on the top reference features
+    reference_importances = np.mean(np.abs(reference), axis=0)
+    importances = np.mean(np.abs(attributions), axis=0)
+    top_reference = np.argsort(reference_importances)[::-1][:top_features]
+    top_attributions = np.argsort(importances)[::-1][:top_features]
+    correlation = spearmanr(
+        reference_importances[top_reference], importances[top_reference]
+    ).correlation
+    return {
+        "top_features": len(top_reference),
+        "spearman_correlation": float(correlation),
+        "top_features_overlap": len(np.intersect1d(top_reference, top_attributions))
+        / len(top_reference),
+    }
+
+
+def compute_importances(
+    X,
+    model,
+    attribution_method,
+    shard_path,
+    workers=1,
+    shard_size=16,
+    feature_groups=None,
+    report_file=None,
+    compare_with_shapley=False,
+):
+    """
+    Attributions of X with attribution_method, sampled Shapley values or a
+    gradient method. Gradient methods write their convergence deltas to
+    report_file and, with compare_with_shapley, the rank correlation with
+    sampled Shapley values on the top features. Attributions of
+    feature_groups are summed per group for gradient methods, which are
+    additive.
+    """
+    if attribution_method == "shapley_sampling":
+        return compute_sharded_importances(
+            X, model, shard_path, workers, shard_size, feature_groups=feature_groups
+        )
+    attributions, deltas = compute_gradient_importances(X, model, attribution_method)
+    if feature_groups is not None:
+        attributions = feature_groups.aggregate(attributions)
+    report = {
+        "attribution_method": attribution_method,
+        "mean_absolute_delta": float(np.mean(deltas)),
+        "max_absolute_delta": float(np.max(deltas)),
+    }
+    if compare_with_shapley:
+        shapley_attributions = compute_sharded_importances(
+            X, model, shard_path, workers, shard_size, feature_groups=feature_groups
+        )
+        report.update(compare_attributions(shapley_attributions, attributions))
+    print(report)
+    if report_file is not None:
+        with open(report_file, "w") as stored_report:
+            json.dump(report, stored_report)
+    return attributions
+
+
+def compute_linear_importances_multiple_inputs(X, model, feature_groups=None):
+    # closed form attributions of models that are linear in their inputs
+    all_attributions = model.linear_attributions(*X)
+    result_attributions = np.concatenate(
+        [attributions.cpu().numpy() for attributions in all_attributions], axis=1
+    )
+    if feature_groups is not None:
+        # Shapley values of a linear model add up within a group
+        result_attributions = feature_groups.aggregate(result_attributions)
+    return result_attributions
+
+
+def compute_omics_shapley_values(X, model, input_sizes=None):
+    """
+    Exact Shapley values of the omics types of every sample, with expression,
+    mutation and CNA as the three players and zero baselines like the
+    sampled attributions. Every coalition is one batched forward pass, 8 in
+    total. A single concatenated input X is split into omics types by
+    input_sizes. Returns an array of samples x 3.
+    """
+    single_input = isinstance(X, torch.Tensor)
+    players = 3
+    outputs = {}
+    with torch.no_grad():
+        for coalition in itertools.product((False, True), repeat=players):
+            if single_input:
+                mask = torch.cat(
+                    [
+                        torch.full((size,), float(present), device=X.device)
+                        for size, present in zip(input_sizes, coalition)
+                    ]
+                )
+                output = model(X * mask)
+            else:
+                output = model(
+                    *(
+                        x if present else torch.zeros_like(x)
+                        for x, present in zip(X, coalition)
+                    )
+                )
+            outputs[coalition] = output.view(-1)
+
+    shapley_values = torch.zeros(len(outputs[coalition]), players)
+    for player in range(players):
+        for coalition, output in outputs.items():
+            if coalition[player]:
+                continue
+            joined = tuple(
+                present or other == player for other, present in enumerate(coalition)
+            )
+            size = sum(coalition)
+            weight = (
+                factorial(size) * factorial(players - size - 1) / factorial(players)
+            )
+            shapley_values[:, player] += weight * (outputs[joined] - output).cpu()
+    return shapley_values.numpy()
+
+
+def save_importance_results(
+    importances, feature_names, path, dataset, feature_groups=None
+):
+    if feature_groups is not None:
+        feature_names = feature_groups.names
     mean_importances = np.mean(importances, axis=0)
     sd_importances = np.std(importances, axis=0)
 
@@ -46,6 +395,8 @@ def save_importance_results(importances, feature_names, path, dataset):
         "mean importances": absolute_highest_importances_mean,
         "sd_importances": absolute_highest_importance_sd,
     }
+    if feature_groups is not None:
+        data["group_size"] = feature_groups.sizes[absolute_sorted_indices]
     df = pd.DataFrame(data)
     df.to_csv(str(path / dataset) + ".csv")
 
@@ -0,0 +1,232 @@
+import torch
+from torch import nn
+
+from models.early_integration_model import EarlyIntegration
+from models.moli_model import Moli
+from models.moma_model import FullMomaModel, LogisticRegressionHead, Moma
+from models.omiEmbed_model import VaeClassifierModel
+from models.pca_model import Classifier as PcaClassifier
+from models.stacking_model import StackingModel
+from models.super_felt_model import (
+    AutoEncoder,
+    Classifier as SuperFeltClassifier,
+    SupervisedEncoder,
+)
+
+artifact_version = 1
+
+
+def plain_value(value):
+    # numpy scalars of a parameterization are stored as python numbers
+    return value.item() if hasattr(value, "item") else value
+
+
+def save_model_artifact(
+    artifact_file,
+    model_name,
+    parameterization,
+    feature_names,
+    scaler,
+    networks,
+    head=None,
+    options=None,
+):
+    """
+    Saves a trained model as one file: the parameterization, the gene order of
+    every omics type, the expression scaler, the state dicts of networks and
+    a head of plain tensors, e.g. the PCA projections. The file only holds tensors, numbers and strings and
+    loads with torch.load(weights_only=True), without sklearn objects.
+    """
+    artifact = {
+        "version": artifact_version,
+        "model": model_name,
+        "parameterization": {
+            name: plain_value(value) for name, value in parameterization.items()
+        },
+        "options": options or {},
+        "feature_names": [[str(name) for name in names] for names in feature_names],
+        "scaler": {
+            "mean": torch.as_tensor(scaler.mean_, dtype=torch.float32),
+            "scale": torch.as_tensor(scaler.scale_, dtype=torch.float32),
+        },
+        "networks": {
+            name: {key: value.cpu() for key, value in network.state_dict().items()}
+            for name, network in networks.items()
+        },
+        "head": {
+            name: torch.as_tensor(value, dtype=torch.float32)
+            for name, value in (head or {}).items()
+        },
+    }
+    torch.save(artifact, artifact_file)
+
+
+def load_model_artifact(artifact_file):
+    artifact = torch.load(artifact_file, map_location="cpu", weights_only=True)
+    if artifact["version"] != artifact_version:
+        raise ValueError(
+            f"Model artifact version {artifact['version']} is not supported"
+        )
+    return artifact
+
+
+def pca_head(pca_e, pca_m, pca_c):
+    head = {}
+    for omics, pca in (("e", pca_e), ("m", pca_m), ("c", pca_c)):
+        head[f"pca_{omics}_mean"] = pca.mean_
+        head[f"pca_{omics}_components"] = pca.components_
+    return head
+
+
+def create_networks(model_name, parameterization, options, input_sizes, head):
+    # same constructors as train_final of each model
+    if model_name == "moli":
+        return {
+            "model": Moli(
+                input_sizes,
+                [
+                    parameterization["h_dim1"],
+                    parameterization["h_dim2"],
+                    parameterization["h_dim3"],
+                ],
+                [
+                    parameterization["dropout_rate_e"],
+                    parameterization["dropout_rate_m"],
+                    parameterization["dropout_rate_c"],
+                    parameterization["dropout_rate_clf"],
+                ],
+            )
+        }
+    if model_name == "stacking":
+        return {
+            "model": StackingModel(
+                input_sizes,
+                [
+                    parameterization["h_dim_e_encode"],
+                    parameterization["h_dim_m_encode"],
+                    parameterization["h_dim_c_encode"],
+                ],
+                [
+                    parameterization["dropout_e"],
+                    parameterization["dropout_m"],
+                    parameterization["dropout_c"],
+                    parameterization["dropout_clf"],
+                ],
+                options["stacking_type"],
+            )
+        }
+    if model_name == "early_integration":
+        return {
+            "model": EarlyIntegration(
+                sum(input_sizes),
+                parameterization["h_dim"],
+                parameterization["dropout_rate"],
+            )
+        }
+    if model_name == "moma":
+        return {
+            "model": FullMomaModel(
+                Moma(
+                    *input_sizes,
+                    parameterization["h_dim_classifier"],
+                    parameterization["modules"],
+                ),
+                LogisticRegressionHead(),
+            )
+        }
+    if model_name == "omiEmbed":
+        return {
+            "model": VaeClassifierModel(
+                tuple(input_sizes),
+                parameterization["dropout"],
+                parameterization["latent_space_dim"],
+                parameterization["dim_1B"],
+                parameterization["dim_1A"],
+                parameterization["dim_1C"],
+                parameterization["class_dim_1"],
+                parameterization["leaky_slope"],
+            )
+        }
+    if model_name == "pca":
+        components = sum(
+            len(head[f"pca_{omics}_components"]) for omics in ("e", "m", "c")
+        )
+        return {"model": PcaClassifier(components, parameterization["dropout"])}
+    if model_name == "super.felt":
+        encoder = (
+            AutoEncoder if options["deactivate_triplet_loss"] else SupervisedEncoder
+        )
+        output_sizes = [
+            parameterization["e_dimension"],
+            parameterization["m_dimension"],
+            parameterization["c_dimension"],
+        ]
+        networks = {
+            f"encoder_{omics}": encoder(
+                input_size, output_size, parameterization["encoder_dropout"]
+            )
+            for omics, input_size, output_size in zip(
+                ("e", "m", "c"), input_sizes, output_sizes
+            )
+        }
+        networks["classifier"] = SuperFeltClassifier(
+            sum(output_sizes), parameterization["classifier_dropout"]
+        )
+        return networks
+    raise ValueError(f"Unknown model {model_name}")
+
+
+class ScoringModel(nn.Module):
+    """
+    Inference model of an artifact. Takes raw expression, mutation and CNA
+    tensors in the feature order of the artifact, scales the expression and
+    returns response probabilities.
+    """
+
+    def __init__(self, artifact):
+        super(ScoringModel, self).__init__()
+        self.model_name = artifact["model"]
+        self.feature_names = artifact["feature_names"]
+        input_sizes = [len(names) for names in self.feature_names]
+        networks = create_networks(
+            self.model_name,
+            artifact["parameterization"],
+            artifact["options"],
+            input_sizes,
+            artifact["head"],
+        )
+        for name, network in networks.items():
+            network.load_state_dict(artifact["networks"][name])
+        self.networks = nn.ModuleDict(networks)
+        self.register_buffer("scaler_mean", artifact["scaler"]["mean"])
+        self.register_buffer("scaler_scale", artifact["scaler"]["scale"])
+        for name, value in artifact["head"].items():
+            self.register_buffer(name, value)
+        self.eval()
+
+    def forward(self, expression, mutation, cna):
+        if self.model_name == "early_integration":
+            # the early integration scaler covers all concatenated omics
+            concatenated = torch.cat([expression, mutation, cna], dim=1)
+            concatenated = (concatenated - self.scaler_mean) / self.scaler_scale
+            return torch.sigmoid(self.networks["model"](concatenated)).view(-1)
+        expression = (expression - self.scaler_mean) / self.scaler_scale
+        if self.model_name == "moma":
+            # FullMomaModel already returns probabilities
+            return self.networks["model"](expression, mutation, cna)
+        if self.model_name == "pca":
+            projected = [
+                (omics - getattr(self, f"pca_{name}_mean"))
+                @ getattr(self, f"pca_{name}_components").T
+                for name, omics in (("e", expression), ("m", mutation), ("c", cna))
+            ]
+            logits = self.networks["model"](torch.cat(projected, dim=1))
+        elif self.model_name == "super.felt":
+            logits = self.networks["classifier"](
+                self.networks["encoder_e"].encode(expression),
+                self.networks["encoder_m"].encode(mutation),
+                self.networks["encoder_c"].encode(cna),
+            )
+        else:
+            logits = self.networks["model"](expression, mutation, cna)
+        return torch.sigmoid(logits).view(-1)
@@ -1,32 +1,76 @@
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 from sklearn.feature_selection import VarianceThreshold
 
 from utils.network_training_util import read_and_transpose_csv, feature_selection
 
+cache_version = 1
+data_names = (
+    "gdsc_e",
+    "gdsc_m",
+    "gdsc_c",
+    "gdsc_r",
+    "extern_e",
+    "extern_m",
+    "extern_c",
+    "extern_r",
+)
+
+
 def get_non_zero_variance_gen_indices(data):
     selector = VarianceThreshold(0)
     return selector.fit(data).get_support(indices=True)
 
-def load_drug_data(data_path, drug, dataset, return_data_frames=False):
-    drug = drug.split('_')[0]
+
+def get_source_files(data_path, drug, dataset):
     cna_binary_path = data_path / 'CNA_binary'
     response_path = data_path / 'response'
     sna_binary_path = data_path / 'SNA_binary'
     expressions_homogenized_path = data_path / 'exprs_homogenized'
-    expression_train = read_and_transpose_csv(expressions_homogenized_path
-                                              / f'GDSC_exprs.{drug}.eb_with.{dataset}_exprs.{drug}.tsv')
-    response_train = pd.read_csv(response_path / f"GDSC_response.{drug}.tsv",
+    return {
+        "expression_train": expressions_homogenized_path / f'GDSC_exprs.{drug}.eb_with.{dataset}_exprs.{drug}.tsv',
+        "response_train": response_path / f"GDSC_response.{drug}.tsv",
+        "mutation_train": sna_binary_path / f"GDSC_mutations.{drug}.tsv",
+        "cna_train": cna_binary_path / f"GDSC_CNA.{drug}.tsv",
+        "expression_extern": expressions_homogenized_path / f"{dataset}_exprs.{drug}.eb_with.GDSC_exprs.{drug}.tsv",
+        "mutation_extern": sna_binary_path / f"{dataset}_mutations.{drug}.tsv",
+        "cna_extern": cna_binary_path / f"{dataset}_CNA.{drug}.tsv",
+        "response_extern": response_path / f"{dataset}_response.{drug}.tsv",
+    }
+
+
+def load_drug_data(data_path, drug, dataset, return_data_frames=False, rebuild_cache=False):
+    drug = drug.split('_')[0]
+    data = load_cached_data(
+        data_path,
+        drug,
+        dataset,
+        "preprocessed",
+        lambda: read_drug_data(data_path, drug, dataset),
+        rebuild_cache,
+    )
+    return convert_cached_data(data, return_data_frames)
+
+
+def read_drug_data(data_path, drug, dataset):
+    source_files = get_source_files(data_path, drug, dataset)
+    expression_train = read_and_transpose_csv(source_files["expression_train"])
+    response_train = pd.read_csv(source_files["response_train"],
                                  sep="\t", index_col=0, decimal=',')
-    mutation_train = read_and_transpose_csv(sna_binary_path / f"GDSC_mutations.{drug}.tsv")
-    cna_train = read_and_transpose_csv(cna_binary_path / f"GDSC_CNA.{drug}.tsv")
+    mutation_train = read_and_transpose_csv(source_files["mutation_train"])
+    cna_train = read_and_transpose_csv(source_files["cna_train"])
     cna_train = cna_train.loc[:, ~cna_train.columns.duplicated()]
 
-    expression_extern = read_and_transpose_csv(expressions_homogenized_path /
-                                               f"{dataset}_exprs.{drug}.eb_with.GDSC_exprs.{drug}.tsv")
-    mutation_extern = read_and_transpose_csv(sna_binary_path / f"{dataset}_mutations.{drug}.tsv")
-    cna_extern = read_and_transpose_csv(cna_binary_path / f"{dataset}_CNA.{drug}.tsv")
+    expression_extern = read_and_transpose_csv(source_files["expression_extern"])
+    mutation_extern = read_and_transpose_csv(source_files["mutation_extern"])
+    cna_extern = read_and_transpose_csv(source_files["cna_extern"])
     cna_extern = cna_extern.loc[:, ~cna_extern.columns.duplicated()]
-    response_extern = pd.read_csv(response_path / f"{dataset}_response.{drug}.tsv",
+    response_extern = pd.read_csv(source_files["response_extern"],
                                   sep="\t", index_col=0, decimal=',')
 
     response_train.loc[response_train.response == 'R'] = 0
@@ -69,32 +113,125 @@ def load_drug_data(data_path, drug, dataset, return_data_frames=False):
 
     y_train = response_train.response.to_numpy(dtype=int)
     y_extern = response_extern.response.to_numpy(dtype=int)
-    if return_data_frames:
-        return expression_train, mutation_train, cna_train, y_train, expression_extern, \
-               mutation_extern, cna_extern, y_extern
-    else:
-        return expression_train.to_numpy(), mutation_train.to_numpy(), cna_train.to_numpy(), y_train, \
-           expression_extern.to_numpy(), mutation_extern.to_numpy(), cna_extern.to_numpy(), y_extern
+    return expression_train, mutation_train, cna_train, y_train, expression_extern, \
+        mutation_extern, cna_extern, y_extern
+
+
+def load_drug_data_with_elbow(data_path, drug, dataset, return_data_frames=False, rebuild_cache=False):
+    data = load_cached_data(
+        data_path,
+        drug.split('_')[0],
+        dataset,
+        "elbow",
+        lambda: select_elbow_features(data_path, drug, dataset, rebuild_cache),
+        rebuild_cache,
+    )
+    return convert_cached_data(data, return_data_frames)
 
 
-def load_drug_data_with_elbow(data_path, drug, dataset, return_data_frames=False):
+def load_feature_names(data_path, drug, dataset, rebuild_cache=False):
+    gdsc_e, gdsc_m, gdsc_c, *_ = load_drug_data_with_elbow(data_path, drug, dataset, True, rebuild_cache)
+    return [list(gdsc_e.columns), list(gdsc_m.columns), list(gdsc_c.columns)]
+
+
+def select_elbow_features(data_path, drug, dataset, rebuild_cache):
     gdsc_e, gdsc_m, gdsc_c, gdsc_r, extern_e, extern_m, extern_c, extern_r \
-                = load_drug_data(data_path, drug, dataset, True)
+                = load_drug_data(data_path, drug, dataset, True, rebuild_cache)
 
     gdsc_e, gdsc_m, gdsc_c = feature_selection(gdsc_e, gdsc_m, gdsc_c)
     expression_intersection_genes_index = gdsc_e.columns.intersection(extern_e.columns)
     mutation_intersection_genes_index = gdsc_m.columns.intersection(extern_m.columns)
     cna_intersection_genes_index = gdsc_c.columns.intersection(extern_c.columns)
-    if return_data_frames:
-        extern_e = extern_e.loc[:, expression_intersection_genes_index]
-        extern_m = extern_m.loc[:, mutation_intersection_genes_index]
-        extern_c = extern_c.loc[:, cna_intersection_genes_index]
-    else:
-        extern_e = extern_e.loc[:, expression_intersection_genes_index].to_numpy()
-        extern_m = extern_m.loc[:, mutation_intersection_genes_index].to_numpy()
-        extern_c = extern_c.loc[:, cna_intersection_genes_index].to_numpy()
-        gdsc_e = gdsc_e.to_numpy()
-        gdsc_m = gdsc_m.to_numpy()
-        gdsc_c = gdsc_c.to_numpy()
+    extern_e = extern_e.loc[:, expression_intersection_genes_index]
+    extern_m = extern_m.loc[:, mutation_intersection_genes_index]
+    extern_c = extern_c.loc[:, cna_intersection_genes_index]
 
     return gdsc_e, gdsc_m, gdsc_c, gdsc_r, extern_e, extern_m, extern_c, extern_r
+
+
+def convert_cached_data(data, return_data_frames):
+    if return_data_frames:
+        return data
+    return tuple(
+        np.asarray(value.to_numpy() if isinstance(value, pd.DataFrame) else value)
+        for value in data
+    )
+
+
+def compute_source_key(source_files):
+    key = hashlib.sha256(f"version {cache_version}".encode())
+    for name, path in sorted(source_files.items()):
+        stat = os.stat(path)
+        key.update(f"{name} {Path(path).name} {stat.st_mtime_ns} {stat.st_size}".encode())
+    return key.hexdigest()[:16]
+
+
+def load_cached_data(data_path, drug, dataset, variant, build_data, rebuild_cache=False):
+    source_key = compute_source_key(get_source_files(data_path, drug, dataset))
+    cache_root = Path(data_path) / "cache"
+    cache_prefix = f"{drug}.{dataset}.{variant}."
+    cache_path = cache_root / f"{cache_prefix}{source_key}"
+
+    if cache_path.is_dir() and not rebuild_cache:
+        print(f"Data cache hit for {drug} {dataset} ({variant}): {cache_path}")
+        return read_cache(cache_path)
+
+    reason = "rebuild requested" if rebuild_cache else "miss"
+    print(f"Data cache {reason} for {drug} {dataset} ({variant}), building it")
+    data = build_data()
+    try:
+        remove_stale_caches(cache_root, cache_prefix)
+        write_cache(cache_path, data)
+    except OSError as error:
+        print(f"Could not write data cache {cache_path}: {error}")
+        return data
+    return read_cache(cache_path)
+
+
+def remove_stale_caches(cache_root, cache_prefix):
+    if not cache_root.is_dir():
+        return
+    for stale_path in cache_root.glob(f"{cache_prefix}*"):
+        # temporary directories belong to processes still writing an entry
+        if ".tmp-" in stale_path.name:
+            continue
+        shutil.rmtree(stale_path, ignore_errors=True)
+
+
+def write_cache(cache_path, data):
+    temporary_path = cache_path.with_name(f"{cache_path.name}.tmp-{os.getpid()}")
+    temporary_path.mkdir(parents=True, exist_ok=True)
+    for name, value in zip(data_names, data):
+        if isinstance(value, pd.DataFrame):
+            np.save(temporary_path / f"{name}.npy", np.ascontiguousarray(value.to_numpy()))
+            np.save(temporary_path / f"{name}.index.npy", convert_labels(value.index))
+            np.save(temporary_path / f"{name}.columns.npy", convert_labels(value.columns))
+        else:
+            np.save(temporary_path / f"{name}.npy", np.asarray(value))
+    try:
+        os.rename(temporary_path, cache_path)
+    except OSError:
+        # another process finished the same cache entry first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+
+def convert_labels(labels):
+    labels = np.asarray(labels)
+    if labels.dtype == object:
+        labels = labels.astype(str)
+    return labels
+
+
+def read_cache(cache_path):
+    data = []
+    for name in data_names:
+        # copy-on-write memory map: pages are only read when used and never written back
+        values = np.load(cache_path / f"{name}.npy", mmap_mode="c")
+        columns_path = cache_path / f"{name}.columns.npy"
+        if columns_path.exists():
+            index = np.load(cache_path / f"{name}.index.npy")
+            columns = np.load(columns_path)
+            data.append(pd.DataFrame(values, index=index, columns=columns, copy=False))
+        else:
+            data.append(np.asarray(values))
+    return tuple(data)
@@ -8,57 +8,90 @@ import pandas as pd
 from torch.utils.data import WeightedRandomSampler
 from tqdm import trange
 
-from siamese_triplet.utils import AllTripletSelector
+from siamese_triplet.losses import BatchAllTripletLoss
+from utils.omics_view import OmicsBatchIterator, OmicsViewDataset, as_float_tensor
+from utils.phase_timer import phase, phase_timer
 
 sigmoid = torch.nn.Sigmoid()
 
 
-def train(train_loader, model, optimiser, loss_fn, device, gamma):
-    y_true = []
-    predictions = []
+def train(
+    train_loader,
+    model,
+    optimiser,
+    loss_fn,
+    device,
+    gamma,
+    device_resident=False,
+    compute_auroc=False,
+):
     model.train()
-    for (data_e, data_m, data_c, target) in train_loader:
-        if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-            optimiser.zero_grad()
-            y_true.extend(target)
-
-            data_e = data_e.to(device)
-            data_m = data_m.to(device)
-            data_c = data_c.to(device)
-            target = target.to(device)
-
+    if device_resident:
+        train_loader = train_loader.to(device)
+    if compute_auroc:
+        # preallocated on the device, read back once after the epoch
+        maximal_samples = len(train_loader) * train_loader.batch_size
+        y_true = torch.empty(maximal_samples, device=device)
+        predictions = torch.empty(maximal_samples, device=device)
+        number_of_samples = 0
+    for (data_e, data_m, data_c, target) in mixed_class_batches(train_loader):
+        optimiser.zero_grad()
+
+        data_e = data_e.to(device)
+        data_m = data_m.to(device)
+        data_c = data_c.to(device)
+        target = target.to(device)
+
+        with phase("forward"):
             prediction = model.forward_with_features(data_e, data_m, data_c)
             if gamma > 0:
                 loss = loss_fn(prediction, target)
             else:
                 loss = loss_fn(torch.squeeze(prediction[0]), target)
-            prediction = sigmoid(prediction[0])
 
-            predictions.extend(prediction.cpu().detach())
+        if compute_auroc:
+            batch_size = len(target)
+            batch_slice = slice(number_of_samples, number_of_samples + batch_size)
+            y_true[batch_slice] = target.detach().view(-1)
+            predictions[batch_slice] = sigmoid(prediction[0]).detach().view(-1)
+            number_of_samples += batch_size
+        with phase("backward"):
             loss.backward()
             optimiser.step()
-    y_true = torch.FloatTensor(y_true)
-    predictions = torch.FloatTensor(predictions)
-    auroc = roc_auc_score(y_true, predictions)
-    return auroc
+    if not compute_auroc:
+        return None
+    y_true = y_true[:number_of_samples].cpu()
+    predictions = predictions[:number_of_samples].cpu()
+    with phase("auroc"):
+        return roc_auc_score(y_true, predictions)
+
+
+def mixed_class_batches(train_loader):
+    if isinstance(train_loader, OmicsBatchIterator):
+        # single class batches are skipped while sampling the epoch
+        yield from phase_timer.timed_batches(
+            train_loader.batches(skip_single_class=True)
+        )
+        return
+    for data in phase_timer.timed_batches(train_loader):
+        target = data[-1]
+        if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
+            yield data
 
 
-class BceWithTripletsToss:
-    def __init__(self, gamma, triplet_selector, trip_criterion):
+class BceWithBatchAllTripletLoss:
+    def __init__(self, gamma, trip_criterion):
         self.gamma = gamma
         self.trip_criterion = trip_criterion
-        self.triplet_selector = triplet_selector
         self.bce_with_logits = torch.nn.BCEWithLogitsLoss()
-        super(BceWithTripletsToss, self).__init__()
 
     def __call__(self, predictions, target):
         prediction = torch.squeeze(predictions[0])
         zt = predictions[1]
-        triplets = self.triplet_selector.get_triplets(zt, target)
         target = torch.squeeze(target.view(-1, 1))
-        loss = self.gamma * self.trip_criterion(
-            zt[triplets[:, 0], :], zt[triplets[:, 1], :], zt[triplets[:, 2], :]
-        ) + self.bce_with_logits(prediction, target)
+        loss = self.gamma * self.trip_criterion(zt, target) + self.bce_with_logits(
+            prediction, target
+        )
         return loss
 
 
@@ -89,22 +122,48 @@ def test(moli_model, scaler, x_test_e, x_test_m, x_test_c, test_y, device):
     moli_model.eval()
     predictions = moli_model.forward_with_features(x_test_e, x_test_m, x_test_c)
     probabilities = sigmoid(predictions[0])
-    auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
-    auprc_validate = average_precision_score(
-        test_y, probabilities.cpu().detach().numpy()
-    )
+    with phase("auroc"):
+        auc_validate = roc_auc_score(test_y, probabilities.cpu().detach().numpy())
+        auprc_validate = average_precision_score(
+            test_y, probabilities.cpu().detach().numpy()
+        )
     return auc_validate, auprc_validate
 
 
 def create_data_loader(
-    x_test_e, x_test_m, x_test_c, test_y, train_batch_size, pin_memory, sampler=None
+    x_test_e,
+    x_test_m,
+    x_test_c,
+    test_y,
+    train_batch_size,
+    pin_memory,
+    sampler=None,
+    in_process=True,
 ):
-    dataset = torch.utils.data.TensorDataset(
-        torch.FloatTensor(x_test_e),
-        torch.FloatTensor(x_test_m),
-        torch.FloatTensor(x_test_c),
-        torch.FloatTensor(test_y),
+    tensors = (
+        as_float_tensor(x_test_e),
+        as_float_tensor(x_test_m),
+        as_float_tensor(x_test_c),
+        as_float_tensor(test_y),
     )
+    if in_process:
+        return OmicsBatchIterator(tensors, train_batch_size, sampler, True, pin_memory)
+    dataset = torch.utils.data.TensorDataset(*tensors)
+    return create_loader(dataset, train_batch_size, pin_memory, sampler)
+
+
+def create_view_data_loader(
+    view, train_batch_size, pin_memory, sampler=None, scaler=None, in_process=True
+):
+    if in_process:
+        return OmicsBatchIterator.from_view(
+            view, train_batch_size, sampler, True, pin_memory, scaler
+        )
+    dataset = OmicsViewDataset(view, scaler)
+    return create_loader(dataset, train_batch_size, pin_memory, sampler)
+
+
+def create_loader(dataset, train_batch_size, pin_memory, sampler=None):
     loader = torch.utils.data.DataLoader(
         dataset=dataset,
         batch_size=train_batch_size,
@@ -119,9 +178,7 @@ def create_data_loader(
 
 def get_loss_fn(margin, gamma):
     if gamma > 0:
-        triplet_selector = AllTripletSelector()
-        trip_criterion = torch.nn.TripletMarginLoss(margin=margin, p=2)
-        return BceWithTripletsToss(gamma, triplet_selector, trip_criterion)
+        return BceWithBatchAllTripletLoss(gamma, BatchAllTripletLoss(margin))
     else:
         return torch.nn.BCEWithLogitsLoss()
 
@@ -162,24 +219,22 @@ def train_encoder(
     train_loader,
     trip_loss_fun,
     omic_number,
+    device_resident=False,
 ):
-    triplet_selector = AllTripletSelector()
     encoder.train()
+    if device_resident:
+        train_loader = train_loader.to(device)
     for _ in trange(epochs):
-        for data in train_loader:
+        for data in mixed_class_batches(train_loader):
             single_omic_data = data[omic_number]
             target = data[-1]
-            if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                optimizer.zero_grad()
-                single_omic_data = single_omic_data.to(device)
+            optimizer.zero_grad()
+            single_omic_data = single_omic_data.to(device)
 
+            with phase("forward"):
                 encoded_data = encoder(single_omic_data)
-                triplets = triplet_selector.get_triplets(encoded_data, target)
-                loss = trip_loss_fun(
-                    encoded_data[triplets[:, 0], :],
-                    encoded_data[triplets[:, 1], :],
-                    encoded_data[triplets[:, 2], :],
-                )
+                loss = trip_loss_fun(encoded_data, target)
+            with phase("backward"):
                 loss.backward()
                 optimizer.step()
     encoder.eval()
@@ -193,18 +248,21 @@ def train_autoencoder(
     train_loader,
     reconstruction_loss,
     omic_number,
+    device_resident=False,
 ):
     autoencoder.train()
+    if device_resident:
+        train_loader = train_loader.to(device)
     for _ in trange(epochs):
-        for data in train_loader:
+        for data in mixed_class_batches(train_loader):
             single_omic_data = data[omic_number]
-            target = data[-1]
-            if torch.mean(target) != 0.0 and torch.mean(target) != 1.0:
-                optimizer.zero_grad()
-                single_omic_data = single_omic_data.to(device)
+            optimizer.zero_grad()
+            single_omic_data = single_omic_data.to(device)
 
+            with phase("forward"):
                 reconstructed_data = autoencoder(single_omic_data)
                 loss = reconstruction_loss(reconstructed_data, single_omic_data)
+            with phase("backward"):
                 loss.backward()
                 optimizer.step()
     autoencoder.eval()
@@ -245,7 +303,8 @@ def train_validate_classifier(
         encoded_val_C = c_encoder.encode(torch.FloatTensor(x_val_c).to(device))
         test_Pred = classifier(encoded_val_E, encoded_val_M, encoded_val_C).cpu()
         test_y_pred = sigmoid(test_Pred)
-        val_auroc = roc_auc_score(y_val, test_y_pred.detach().numpy())
+        with phase("auroc"):
+            val_auroc = roc_auc_score(y_val, test_y_pred.detach().numpy())
 
     return val_auroc
 
@@ -270,15 +329,17 @@ def train_classifier(
             dataC = dataC.to(device)
             target = target.to(device)
 
-            encoded_e = e_encoder.encode(dataE)
-            encoded_m = m_encoder.encode(dataM)
-            encoded_c = c_encoder.encode(dataC)
-            predictions = classifier(encoded_e, encoded_m, encoded_c)
-            cl_loss = bce_loss_function(
-                torch.squeeze(predictions), torch.squeeze(target)
-            )
-            cl_loss.backward()
-            classifier_optimizer.step()
+            with phase("forward"):
+                encoded_e = e_encoder.encode(dataE)
+                encoded_m = m_encoder.encode(dataM)
+                encoded_c = c_encoder.encode(dataC)
+                predictions = classifier(encoded_e, encoded_m, encoded_c)
+                cl_loss = bce_loss_function(
+                    torch.squeeze(predictions), torch.squeeze(target)
+                )
+            with phase("backward"):
+                cl_loss.backward()
+                classifier_optimizer.step()
     classifier.eval()
 
 
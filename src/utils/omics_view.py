@@ -0,0 +1,237 @@
+import copy
+import itertools
+import os
+
+import numpy as np
+import torch
+import torch.utils.data
+
+from utils.phase_timer import phase
+
+
+def as_float_tensor(values):
+    if isinstance(values, torch.Tensor):
+        return values.float()
+    values = np.asarray(values)
+    if values.dtype == np.float32 and values.flags["C_CONTIGUOUS"]:
+        # shares memory with the array, e.g. a memory map of the data cache
+        return torch.from_numpy(values)
+    return torch.from_numpy(np.ascontiguousarray(values, dtype=np.float32))
+
+
+view_tokens = itertools.count()
+
+
+class OmicsView:
+    """
+    Rows of the full omics matrices selected by an index tensor.
+
+    The matrices are converted to contiguous float32 tensors once; subsets only
+    compose index tensors, so cross-validation folds never copy the data. A
+    view and its subsets share a token that is unique within the run; together
+    with the index it identifies a fold of one data set.
+    """
+
+    def __init__(self, omics, response, index=None, token=None):
+        self.omics = tuple(as_float_tensor(omic) for omic in omics)
+        self.response = as_float_tensor(response)
+        if index is None:
+            index = torch.arange(len(self.response))
+        self.index = torch.as_tensor(index, dtype=torch.long)
+        if token is None:
+            token = (os.getpid(), next(view_tokens))
+        self.token = token
+
+    def __len__(self):
+        return len(self.index)
+
+    def subset(self, positions):
+        positions = torch.as_tensor(positions, dtype=torch.long)
+        return OmicsView(
+            self.omics, self.response, self.index[positions], self.token
+        )
+
+    @property
+    def labels(self):
+        return self.response[self.index].long().numpy()
+
+    @property
+    def dimensions(self):
+        return tuple(omic.shape[-1] for omic in self.omics)
+
+    def omic(self, omic_number):
+        return torch.index_select(self.omics[omic_number], 0, self.index)
+
+    def array(self, omic_number):
+        return self.omic(omic_number).numpy()
+
+
+class OmicsViewDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset reading the rows of an OmicsView from the full tensors.
+    The expression omic is standardised per row with the scaler fitted on the
+    training view, instead of materialising a scaled copy of the fold.
+    """
+
+    def __init__(self, view, scaler=None):
+        self.view = view
+        if scaler is None:
+            self.mean = None
+            self.scale = None
+        else:
+            self.mean = torch.as_tensor(scaler.mean_, dtype=torch.float32)
+            self.scale = torch.as_tensor(scaler.scale_, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, position):
+        row = self.view.index[position]
+        omics = [omic[row] for omic in self.view.omics]
+        if self.mean is not None:
+            omics[0] = (omics[0] - self.mean) / self.scale
+        return (*omics, self.view.response[row])
+
+
+class OmicsBatchIterator:
+    """
+    In-process replacement for a DataLoader over tensors that are already in
+    memory. The positions of an epoch are drawn at once (with the weights of a
+    WeightedRandomSampler, if given) and every batch is gathered with
+    index_select, so no worker processes are forked per epoch.
+
+    The last tensor holds the labels. batches(skip_single_class=True) skips
+    batches containing a single class while sampling the epoch.
+    """
+
+    def __init__(
+        self,
+        tensors,
+        batch_size,
+        sampler=None,
+        drop_last=True,
+        pin_memory=False,
+        index=None,
+        mean=None,
+        scale=None,
+    ):
+        self.tensors = tuple(tensors)
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory
+        if index is None:
+            index = torch.arange(len(self.tensors[0]))
+        self.index = index
+        self.mean = mean
+        self.scale = scale
+
+    @classmethod
+    def from_view(
+        cls, view, batch_size, sampler=None, drop_last=True, pin_memory=False, scaler=None
+    ):
+        mean, scale = None, None
+        if scaler is not None:
+            mean = torch.as_tensor(scaler.mean_, dtype=torch.float32)
+            scale = torch.as_tensor(scaler.scale_, dtype=torch.float32)
+        return cls(
+            (*view.omics, view.response),
+            batch_size,
+            sampler,
+            drop_last,
+            pin_memory,
+            view.index,
+            mean,
+            scale,
+        )
+
+    @property
+    def device(self):
+        return self.tensors[0].device
+
+    def to(self, device):
+        """
+        Uploads the scaled rows of the fold once; afterwards batches are
+        gathered on the device. Calling it again is a no-op.
+        """
+        device = torch.device(device)
+        if self.device == device:
+            return self
+        with phase("loader to device"):
+            rows = self.index.to(self.device)
+            self.tensors = tuple(tensor.to(device) for tensor in self.gather(rows))
+        self.index = torch.arange(len(rows), device=device)
+        self.mean = None
+        self.scale = None
+        self.pin_memory = False
+        return self
+
+    def with_sampler(self, sampler):
+        # another epoch order over the same, possibly uploaded, tensors
+        batch_iterator = copy.copy(self)
+        batch_iterator.sampler = sampler
+        return batch_iterator
+
+    def __len__(self):
+        number_of_samples = self.number_of_samples()
+        if self.drop_last:
+            return number_of_samples // self.batch_size
+        return -(-number_of_samples // self.batch_size)
+
+    def number_of_samples(self):
+        if self.sampler is None:
+            return len(self.index)
+        return self.sampler.num_samples
+
+    def epoch_positions(self):
+        if self.sampler is None:
+            return torch.arange(len(self.index))
+        # same draw as WeightedRandomSampler.__iter__
+        return torch.multinomial(
+            self.sampler.weights,
+            self.sampler.num_samples,
+            self.sampler.replacement,
+            generator=self.sampler.generator,
+        )
+
+    def __iter__(self):
+        return self.batches()
+
+    def batches(self, skip_single_class=False):
+        rows = self.index[self.epoch_positions().to(self.index.device)]
+        batch_starts = range(0, len(self) * self.batch_size, self.batch_size)
+        if len(batch_starts) == 0:
+            return
+        if skip_single_class:
+            keep_batches = self.mixed_class_batches(rows).tolist()
+        else:
+            keep_batches = [True] * len(batch_starts)
+        for start, keep_batch in zip(batch_starts, keep_batches):
+            if keep_batch:
+                yield self.gather(rows[start : start + self.batch_size])
+
+    def mixed_class_batches(self, rows):
+        # one host synchronisation per epoch instead of one per batch
+        labels = torch.index_select(self.tensors[-1], 0, rows)
+        full_batches = len(labels) // self.batch_size
+        if full_batches > 0:
+            full_labels = labels[: full_batches * self.batch_size].view(
+                full_batches, -1
+            )
+            mixed_classes = full_labels.amin(dim=1) != full_labels.amax(dim=1)
+        else:
+            # fewer samples than one batch
+            mixed_classes = torch.zeros(0, dtype=torch.bool, device=labels.device)
+        last_labels = labels[full_batches * self.batch_size :]
+        if not self.drop_last and len(last_labels) > 0:
+            last_mixed = (last_labels.amin() != last_labels.amax()).view(1)
+            mixed_classes = torch.cat((mixed_classes, last_mixed))
+        return mixed_classes
+
+    def gather(self, rows):
+        batch = [torch.index_select(tensor, 0, rows) for tensor in self.tensors]
+        if self.mean is not None:
+            batch[0] = (batch[0] - self.mean) / self.scale
+        if self.pin_memory:
+            batch = [tensor.pin_memory() for tensor in batch]
+        return tuple(batch)
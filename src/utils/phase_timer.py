@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+class PhaseTimer:
+    """
+    Wall time of the phases of a trial, e.g. data slicing, scaler fitting,
+    batch loading, forward, backward and auroc, aggregated
+    per trial, inner fold and phase.
+
+    Timing costs two perf_counter calls per phase and is always on. CUDA
+    kernels run asynchronously, so forward and backward of GPU runs are only
+    attributed correctly with synchronize, which adds a device sync to every
+    phase. With a trace_file, every phase is also kept as a complete event and
+    written as Chrome trace JSON (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.trace_events = []
+        self.trace_file = None
+        self.synchronize = False
+        self.current_trial = None
+        self.current_fold = None
+
+    def configure(self, trace_file=None, synchronize=False):
+        self.trace_file = trace_file
+        self.synchronize = synchronize
+
+    def reset(self):
+        # trial indices restart with every study, trace events are kept
+        self.totals.clear()
+        self.counts.clear()
+
+    def merge(self, trial_index, phase_times):
+        # phase totals of a trial that ran in a worker process
+        for name, total in phase_times.items():
+            self.totals[(trial_index, None, name)] += total
+            self.counts[(trial_index, None, name)] += 1
+
+    @contextmanager
+    def trial(self, trial_index):
+        self.current_trial = trial_index
+        self.current_fold = None
+        try:
+            yield
+        finally:
+            self.current_trial = None
+            self.current_fold = None
+
+    def next_fold(self):
+        self.current_fold = 0 if self.current_fold is None else self.current_fold + 1
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            key = (self.current_trial, self.current_fold, name)
+            self.totals[key] += end - start
+            self.counts[key] += 1
+            if self.trace_file is not None:
+                self.trace_events.append(
+                    {
+                        "name": name,
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {"trial": self.current_trial, "fold": self.current_fold},
+                    }
+                )
+
+    def timed_batches(self, batches, name="batch loading"):
+        # the first batch of a DataLoader includes the start of its workers
+        iterator = iter(batches)
+        while True:
+            with self.phase(name):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            yield batch
+
+    def phase_times(self, trial_index=None):
+        phase_times = defaultdict(float)
+        for (trial, _, name), total in self.totals.items():
+            if trial_index is None or trial == trial_index:
+                phase_times[name] += total
+        return dict(phase_times)
+
+    def fold_times(self, trial_index):
+        fold_times = defaultdict(float)
+        for (trial, fold, _), total in self.totals.items():
+            if trial == trial_index and fold is not None:
+                fold_times[fold] += total
+        return dict(fold_times)
+
+    def summary(self):
+        phase_times = self.phase_times()
+        phase_counts = defaultdict(int)
+        for (_, _, name), count in self.counts.items():
+            phase_counts[name] += count
+        overall = sum(phase_times.values()) or 1.0
+        lines = [f"{'phase':<20}{'calls':>10}{'seconds':>12}{'share':>8}"]
+        for name, total in sorted(phase_times.items(), key=lambda item: -item[1]):
+            lines.append(
+                f"{name:<20}{phase_counts[name]:>10}{total:>12.2f}{total / overall:>8.1%}"
+            )
+        return "\n".join(lines)
+
+    def write_trace(self):
+        if self.trace_file is None:
+            return
+        with open(self.trace_file, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events}, trace_file)
+
+
+phase_timer = PhaseTimer()
+phase = phase_timer.phase
@@ -0,0 +1,109 @@
+import copy
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+
+from utils.phase_timer import phase
+
+cache_size = 64
+fold_cache = OrderedDict()
+
+
+def fold_key(view):
+    # the row index identifies outer and inner fold, the view token the data
+    # set; tensor addresses are reused after a drug's data is freed
+    return view.token, view.index.numpy().tobytes()
+
+
+def cached(key, compute):
+    if key in fold_cache:
+        fold_cache.move_to_end(key)
+        return fold_cache[key]
+    value = compute()
+    if len(fold_cache) >= cache_size:
+        fold_cache.popitem(last=False)
+    fold_cache[key] = value
+    return value
+
+
+def clear_fold_cache():
+    fold_cache.clear()
+
+
+def fit_scaler(train_view):
+    """
+    StandardScaler of the expression omic, fitted once per training fold and
+    shared by every trial on that fold.
+    """
+    with phase("scaler fitting"):
+        return cached(
+            ("scaler", fold_key(train_view)),
+            lambda: StandardScaler().fit(train_view.array(0)),
+        )
+
+
+def scaled_omic(view, omic_number, scaler=None):
+    if scaler is None:
+        return view.array(omic_number)
+    return scaler.transform(view.array(omic_number))
+
+
+def fit_full_pca(train_view, omic_number, scaler=None):
+    """
+    Full-rank PCA of one omic of a training fold. Truncating its components to
+    an explained variance equals fitting PCA(n_components=variance).
+    """
+    with phase("pca fitting"):
+        return cached(
+            ("pca", omic_number, scaler is not None, fold_key(train_view)),
+            lambda: PCA().fit(scaled_omic(train_view, omic_number, scaler)),
+        )
+
+
+def number_of_components(pca, explained_variance):
+    # same rule as PCA with a float n_components
+    ratio_cumsum = np.cumsum(pca.explained_variance_ratio_, dtype=np.float64)
+    return min(
+        int(np.searchsorted(ratio_cumsum, explained_variance, side="right")) + 1,
+        len(ratio_cumsum),
+    )
+
+
+def truncate_pca(pca, explained_variance):
+    n_components = number_of_components(pca, explained_variance)
+    truncated_pca = copy.copy(pca)
+    truncated_pca.n_components = explained_variance
+    truncated_pca.n_components_ = n_components
+    truncated_pca.components_ = pca.components_[:n_components]
+    truncated_pca.explained_variance_ = pca.explained_variance_[:n_components]
+    truncated_pca.explained_variance_ratio_ = pca.explained_variance_ratio_[
+        :n_components
+    ]
+    truncated_pca.singular_values_ = pca.singular_values_[:n_components]
+    return truncated_pca
+
+
+def pca_projection(
+    train_view, validate_view, omic_number, explained_variance, scaler=None
+):
+    """
+    PCA truncated to the explained variance together with the projected
+    training and validation rows. The full projections are cached per fold, a
+    trial only slices the leading components.
+    """
+    pca = fit_full_pca(train_view, omic_number, scaler)
+    transformed_train, transformed_validate = cached(
+        ("projection", omic_number, scaler is not None, fold_key(train_view), fold_key(validate_view)),
+        lambda: (
+            pca.transform(scaled_omic(train_view, omic_number, scaler)),
+            pca.transform(scaled_omic(validate_view, omic_number, scaler)),
+        ),
+    )
+    n_components = number_of_components(pca, explained_variance)
+    return (
+        truncate_pca(pca, explained_variance),
+        transformed_train[:, :n_components],
+        transformed_validate[:, :n_components],
+    )
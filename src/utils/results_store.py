@@ -0,0 +1,163 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+from ax.core.base_trial import TrialStatus
+
+from utils.successive_halving import trained_epochs
+
+create_tables = """
+CREATE TABLE IF NOT EXISTS trials (
+    model TEXT,
+    drug TEXT,
+    experiment TEXT,
+    outer_fold INTEGER,
+    trial_index INTEGER,
+    parameters TEXT,
+    auroc REAL,
+    sem REAL,
+    wall_time REAL,
+    epochs INTEGER,
+    completed_folds INTEGER,
+    pruned INTEGER,
+    recorded_at TEXT,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS outer_folds (
+    model TEXT,
+    drug TEXT,
+    experiment TEXT,
+    outer_fold INTEGER,
+    search_iterations INTEGER,
+    best_parameters TEXT,
+    validation_auroc REAL,
+    test_auroc REAL,
+    test_auprc REAL,
+    extern_auroc REAL,
+    extern_auprc REAL,
+    recorded_at TEXT
+);
+"""
+
+
+class ResultsStore:
+    """
+    Append-only SQLite store of a driver run in result_path/results.sqlite,
+    with one row per trial and one per outer fold. Rows are buffered and
+    written in a single transaction per flush, trials are read from the Ax
+    experiment once a study is finished, so nothing is written while training.
+    The status of a trial is completed, pruned after some inner folds, or
+    stopped on a successive halving rung.
+    """
+
+    def __init__(self, result_path, model, drug, experiment, cv_splits_inner=5):
+        self.database_file = Path(result_path, "results.sqlite")
+        self.run = (model, drug, experiment)
+        self.cv_splits_inner = cv_splits_inner
+        self.trial_rows = []
+        self.outer_fold_rows = []
+        with closing(sqlite3.connect(self.database_file)) as connection, connection:
+            connection.executescript(create_tables)
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(trials)")]
+            if "status" not in columns:
+                # stores written before trials had a status
+                connection.execute("ALTER TABLE trials ADD COLUMN status TEXT")
+
+    def stored_trials(self, outer_fold):
+        with closing(sqlite3.connect(self.database_file)) as connection, connection:
+            rows = connection.execute(
+                "SELECT trial_index FROM trials WHERE model = ? AND drug = ? "
+                "AND experiment = ? AND outer_fold IS ?",
+                (*self.run, outer_fold),
+            ).fetchall()
+        return {trial_index for trial_index, in rows}
+
+    def add_study(self, experiment, outer_fold=None):
+        """
+        Buffers all completed and early stopped trials of an Ax experiment that
+        are not stored yet, a resumed study only appends its new trials.
+        """
+        stored_trials = self.stored_trials(outer_fold)
+        data = experiment.lookup_data().df
+        data = data[data["metric_name"] == "auroc"].set_index("trial_index")
+        recorded_at = datetime.now().isoformat()
+        for trial_index, trial in experiment.trials.items():
+            finished = trial.status.is_completed or (
+                trial.status == TrialStatus.EARLY_STOPPED
+            )
+            if not finished or trial_index in stored_trials:
+                continue
+            parameters = trial.arm.parameters
+            run_metadata = trial.run_metadata or {}
+            completed_folds = run_metadata.get("completed_folds", self.cv_splits_inner)
+            wall_time = None
+            if trial.time_run_started is not None and trial.time_completed is not None:
+                wall_time = (trial.time_completed - trial.time_run_started).total_seconds()
+            if "stopped_rung" in run_metadata:
+                status = "stopped"
+            elif completed_folds < self.cv_splits_inner:
+                status = "pruned"
+            else:
+                status = "completed"
+            self.trial_rows.append(
+                (
+                    *self.run,
+                    outer_fold,
+                    trial_index,
+                    json.dumps(parameters),
+                    float(data.loc[trial_index, "mean"]),
+                    float(data.loc[trial_index, "sem"]),
+                    wall_time,
+                    run_metadata.get("epochs", trained_epochs(parameters)),
+                    completed_folds,
+                    int(completed_folds < self.cv_splits_inner),
+                    recorded_at,
+                    status,
+                )
+            )
+
+    def add_outer_fold(
+        self,
+        outer_fold,
+        search_iterations,
+        best_parameters,
+        validation_auroc,
+        test_auroc,
+        test_auprc,
+        extern_auroc,
+        extern_auprc,
+    ):
+        self.outer_fold_rows.append(
+            (
+                *self.run,
+                outer_fold,
+                search_iterations,
+                json.dumps(best_parameters),
+                float(validation_auroc),
+                float(test_auroc),
+                float(test_auprc),
+                float(extern_auroc),
+                float(extern_auprc),
+                datetime.now().isoformat(),
+            )
+        )
+
+    def flush(self):
+        if not self.trial_rows and not self.outer_fold_rows:
+            return
+        with closing(sqlite3.connect(self.database_file)) as connection, connection:
+            connection.executemany(
+                "INSERT INTO trials (model, drug, experiment, outer_fold, trial_index, "
+                "parameters, auroc, sem, wall_time, epochs, completed_folds, pruned, "
+                "recorded_at, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.trial_rows,
+            )
+            connection.executemany(
+                "INSERT INTO outer_folds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.outer_fold_rows,
+            )
+        self.trial_rows = []
+        self.outer_fold_rows = []
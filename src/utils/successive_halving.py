@@ -0,0 +1,88 @@
+import math
+from contextlib import nullcontext
+from pathlib import Path
+
+import yaml
+
+from utils.fold_pruning import FoldPruner
+
+with open((Path(__file__).parent / "../config/hyperparameter.yaml"), "r") as stream:
+    parameter = yaml.safe_load(stream)
+
+
+class SuccessiveHalvingScheduler:
+    """
+    Asynchronous successive halving over the epoch parameters of a trial.
+
+    A configuration is first trained with its epochs scaled down to
+    1 / reduction_factor ** (number_of_rungs - 1) of the sampled values and is
+    only promoted to the next rung if its AUROC is in the top
+    1 / reduction_factor of all results seen on that rung so far. The result of
+    the highest rung reached is returned; a configuration stopped below the
+    full epochs carries stopped_rung, and its trial is marked early stopped
+    instead of completed. Reduced-epoch runs use a pruner of their own and
+    never change the incumbent of the study's fold pruner. Every rung trains
+    from scratch, the epochs of a result are the sum over all rungs it ran.
+    """
+
+    def __init__(self, reduction_factor=3, number_of_rungs=3, min_epochs=None):
+        self.reduction_factor = reduction_factor
+        self.number_of_rungs = number_of_rungs
+        self.min_epochs = parameter["epoch_lower"] if min_epochs is None else min_epochs
+        self.rung_scores = [[] for _ in range(number_of_rungs - 1)]
+        self.lock = nullcontext()
+
+    def share(self, manager):
+        # rung results are visible to all trial worker processes
+        self.rung_scores = [manager.list() for _ in range(self.number_of_rungs - 1)]
+        self.lock = manager.Lock()
+
+    def evaluate(self, evaluation_function, parameterization):
+        last_rung = self.number_of_rungs - 1
+        previous_parameterization = None
+        result = None
+        epochs = 0
+        for rung in range(self.number_of_rungs):
+            fraction = self.reduction_factor ** (rung - last_rung)
+            rung_parameterization = self.scale_epochs(parameterization, fraction)
+            full_budget = rung_parameterization == parameterization
+            if rung_parameterization != previous_parameterization:
+                if full_budget:
+                    result = evaluation_function(rung_parameterization)
+                else:
+                    result = evaluation_function(
+                        rung_parameterization, pruner=FoldPruner()
+                    )
+                epochs += trained_epochs(rung_parameterization)
+                result = dict(result, epochs=epochs)
+                previous_parameterization = rung_parameterization
+            if full_budget:
+                return result
+            if not self.promote(rung, result["auroc"][0]):
+                return dict(result, stopped_rung=rung)
+        return result
+
+    def scale_epochs(self, parameterization, fraction):
+        scaled_parameterization = dict(parameterization)
+        for name, value in parameterization.items():
+            if "epochs" in name:
+                scaled_epochs = max(self.min_epochs, math.ceil(value * fraction))
+                scaled_parameterization[name] = min(value, scaled_epochs)
+        return scaled_parameterization
+
+    def promote(self, rung, auroc):
+        with self.lock:
+            self.rung_scores[rung].append(auroc)
+            scores = list(self.rung_scores[rung])
+            better_results = sum(score > auroc for score in scores)
+            return better_results < len(scores) / self.reduction_factor
+
+
+def trained_epochs(parameterization):
+    return sum(value for name, value in parameterization.items() if "epochs" in name)
+
+
+def create_scheduler(scheduler):
+    if scheduler == "successive_halving":
+        return SuccessiveHalvingScheduler()
+    return None
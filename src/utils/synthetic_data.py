@@ -0,0 +1,86 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.multi_omics_data import get_source_files
+
+
+def generate_drug_data(
+    data_path,
+    drug,
+    dataset,
+    train_samples=600,
+    extern_samples=80,
+    genes=5000,
+    mutation_rate=0.05,
+    cna_rate=0.3,
+    response_rate=0.3,
+    signal_genes=20,
+    random_seed=42,
+    overwrite=False,
+):
+    """
+    Writes synthetic expression, SNA_binary, CNA_binary and response TSVs of
+    one drug below data_path, in the layout load_drug_data reads. Genes are
+    rows and samples columns. Binary omics have per-gene rates drawn around
+    mutation_rate and cna_rate, so that both sides of the elbow variance
+    thresholds are populated. The response of a sample depends on
+    signal_genes genes of every omics type, the validation AUROCs of a sweep
+    are therefore above chance. Existing files are only replaced with
+    overwrite, data_path must not hold the real data sets.
+    """
+    data_path = Path(data_path)
+    drug = drug.split("_")[0]
+    rng = np.random.default_rng(random_seed)
+    gene_names = [f"GENE{gene}" for gene in range(genes)]
+    expression_scale = rng.uniform(0.5, 3.0, genes)
+    mutation_rates = rng.uniform(0, 2 * mutation_rate, genes).clip(0, 1)
+    cna_rates = rng.uniform(0, 2 * cna_rate, genes).clip(0, 1)
+    signal = rng.choice(genes, signal_genes, replace=False)
+    weights = rng.standard_normal((3, signal_genes))
+
+    def generate_samples(prefix, samples, expression_shift):
+        sample_names = [f"{prefix}_{sample}" for sample in range(samples)]
+        expression = (
+            rng.standard_normal((samples, genes)) * expression_scale
+            + expression_shift
+        )
+        mutation = (rng.random((samples, genes)) < mutation_rates).astype(int)
+        cna = (rng.random((samples, genes)) < cna_rates).astype(int)
+        score = (
+            expression[:, signal] / expression_scale[signal] @ weights[0]
+            + mutation[:, signal] @ weights[1] * 2
+            + cna[:, signal] @ weights[2]
+            + rng.standard_normal(samples) * np.sqrt(signal_genes)
+        )
+        sensitive = score > np.quantile(score, 1 - response_rate)
+        response = pd.DataFrame(
+            {"response": np.where(sensitive, "S", "R")},
+            index=pd.Index(sample_names, name="sample_name"),
+        )
+
+        def omics_frame(values):
+            return pd.DataFrame(values.T, index=gene_names, columns=sample_names)
+
+        return (
+            omics_frame(expression),
+            omics_frame(mutation),
+            omics_frame(cna),
+            response,
+        )
+
+    source_files = get_source_files(data_path, drug, dataset)
+    existing_files = [path for path in source_files.values() if path.exists()]
+    if existing_files and not overwrite:
+        raise FileExistsError(
+            f"{existing_files[0]} exists, synthetic data would overwrite it"
+        )
+    train = generate_samples("GDSC", train_samples, 0.0)
+    extern = generate_samples(dataset, extern_samples, 0.1)
+    for split, frames in (("train", train), ("extern", extern)):
+        for name, frame in zip(("expression", "mutation", "cna", "response"), frames):
+            source_file = source_files[f"{name}_{split}"]
+            source_file.parent.mkdir(parents=True, exist_ok=True)
+            frame.to_csv(source_file, sep="\t", decimal=",")
+    return source_files
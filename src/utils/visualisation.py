@@ -89,7 +89,18 @@ def visualize_importances(
     convert_ids=False,
     number_of_expression_features=0,
     number_of_mutation_features=0,
+    feature_groups=None,
+    omics_shapley_values=None,
 ):
+    if feature_groups is not None:
+        # importances of feature groups, which are named and not gene ids
+        feature_names = feature_groups.names
+        convert_ids = False
+        (
+            number_of_expression_features,
+            number_of_mutation_features,
+            _,
+        ) = feature_groups.groups_per_omics
 
     number_of_most_important_features += 1
     mean_importances = np.mean(importances, axis=0)
@@ -182,6 +193,10 @@ def visualize_importances(
         "mean_mutation_importance": float(mean_mutation_importance),
         "mean_cna_importance": float(mean_cna_importance),
     }
+    if omics_shapley_values is not None:
+        importances_per_omics.update(
+            plot_omics_shapley_values(omics_shapley_values, path, file_name)
+        )
 
     with open(path / f"importances_per_omics_{file_name}.json", "w") as file:
         json.dump(importances_per_omics, file)
@@ -297,3 +312,34 @@ def plot_omics_importance(
         mutation_importance,
         cna_importance,
     )
+
+
+def plot_omics_shapley_values(omics_shapley_values, path, file_name):
+    # exact omics-level Shapley values, normalised like the summed ones
+    expression_importance, mutation_importance, cna_importance = plot_omics_importance(
+        np.mean(np.abs(omics_shapley_values), axis=0),
+        1,
+        1,
+        path,
+        file_name + "_omics_importance_exact",
+        np.sum,
+    )
+    mean_expression, mean_mutation, mean_cna = np.mean(omics_shapley_values, axis=0)
+    return {
+        "exact_expression_importance": float(expression_importance),
+        "exact_mutation_importance": float(mutation_importance),
+        "exact_cna_importance": float(cna_importance),
+        "exact_mean_expression_shapley_value": float(mean_expression),
+        "exact_mean_mutation_shapley_value": float(mean_mutation),
+        "exact_mean_cna_shapley_value": float(mean_cna),
+    }
+
+
+def save_omics_shapley_values(omics_shapley_values, path, file_name):
+    importances_per_omics = plot_omics_shapley_values(
+        omics_shapley_values, path, file_name
+    )
+    # own file, importances_per_omics_{file_name}.json holds the summed
+    # per-feature importances of a regular run
+    with open(path / f"omics_shapley_{file_name}.json", "w") as file:
+        json.dump(importances_per_omics, file)